@@ -1,18 +1,51 @@
 #!/bin/bash
 
 echo $GITOUT_DIR
+
+# Kill a process and its descendants
+kill_tree() {
+    local children=`pgrep -P $1`
+    kill $1 2>/dev/null
+    for child in $children; do
+        kill_tree $child
+    done
+}
+
+# Exit with the given status, first stopping any commits that are running in
+# the background (and the stats code that they are running)
+die() {
+    for job in `jobs -p`; do
+        kill_tree $job
+    done
+    exit $1
+}
+
 if [ "$GITOUT_DIR" = "" ]; then
     GITOUT_DIR="gitout"
 fi
-if [ "$COMMIT_SKIP_FILE" = "" ]; then
-    COMMIT_SKIP_FILE=$GITOUT_DIR/gitaggregate/activities.json
+# Several comma separated stats modules (--stats-module) can be run together,
+# each file being parsed once for all of them, with a comma separated
+# GITOUT_DIR (and COMMIT_SKIP_FILE) for each. The logs and running commits are
+# kept in the first.
+IFS=, read -ra gitout_dirs <<< "$GITOUT_DIR"
+IFS=, read -ra commit_skip_files <<< "$COMMIT_SKIP_FILE"
+GITOUT_DIR=${gitout_dirs[0]}
+for i in ${!gitout_dirs[@]}; do
+    if [ "${commit_skip_files[$i]}" = "" ]; then
+        commit_skip_files[$i]=${gitout_dirs[$i]}/gitaggregate/activities.json
+    fi
+done
+if [ "$GITAGGREGATE_BATCH" = "" ]; then
+    GITAGGREGATE_BATCH=10
 fi
 
 # Make the all the gitout directories
 mkdir -p $GITOUT_DIR/logs
-mkdir -p $GITOUT_DIR/commits
-mkdir -p $GITOUT_DIR/gitaggregate
-mkdir -p $GITOUT_DIR/gitaggregate-dated
+for dir in ${gitout_dirs[@]}; do
+    mkdir -p $dir/commits
+    mkdir -p $dir/gitaggregate
+    mkdir -p $dir/gitaggregate-dated
+done
 
 
 # Build a JSON file of metadata for each CKAN publisher, and file that they have publishe. 
@@ -20,14 +53,13 @@ mkdir -p $GITOUT_DIR/gitaggregate-dated
 cd helpers
 python ckan.py
 cd ..
-cp helpers/ckan.json $GITOUT_DIR
-
+for dir in ${gitout_dirs[@]}; do
+    cp helpers/ckan.json $dir
+done
 
-# Clear output directory
-rm -r out
 
 # Bring the IATI raw data up-to-date
-cd data || exit $?
+cd data || die $?
 # Checkout automatic, and make sure it is clean and up to date
 git checkout automatic
 git reset --hard
@@ -43,76 +75,232 @@ sed -i '$d' gitdate.json
 git log --format="format:%H|%ai" | tail -n1 | awk -F '|' '{ print "\""$1"\": \""$2"\"" } ' >> gitdate.json
 echo '}' >> gitdate.json
 # Perform this dance because piping to ../ behaves differently with symlinks
-cd .. || exit $?
+cd .. || die $?
 mv data/gitdate.json .
-cp gitdate.json $GITOUT_DIR
+for dir in ${gitout_dirs[@]}; do
+    cp gitdate.json $dir
+done
 
 
 # Store current and all commit hashes as variables
-cd data || exit $?
+cd data || die $?
 # Get the latest commit hash
 current_hash=`git rev-parse HEAD`
 # Get all commit hashes
 commits=`git log --format=format:%H`
-cd .. || exit $?
+cd .. || die $?
 
 
-# Loop over commits and run stats code
-for commit in $commits; do
-    if grep -q $commit $COMMIT_SKIP_FILE; then
-        echo Skipping $commit
-    elif [ $GITOUT_SKIP_INCOMMITSDIR ] && [ -d $GITOUT_DIR/commits/$commit ]; then
-        echo Skipping $commit
+# Whether a commit's output directory is the --previous-output of a commit
+# that is still running
+in_use() {
+    cat $GITOUT_DIR/running/*.previous 2>/dev/null | grep -qxF "$1"
+}
+
+# Add the commits in the commits directory of each gitout directory to its
+# gitaggregate output, dated and undated, in one pass, then remove them
+gitaggregate_commits() {
+    for i in ${!gitout_dirs[@]}; do
+        local dir=${gitout_dirs[$i]}
+        GITOUT_DIR=$dir python statsrunner/gitaggregate.py both || die $?
+        GITOUT_DIR=$dir python statsrunner/gitaggregate-publisher.py both || die $?
+        for commit_dir in $dir/commits/*; do
+            [ -d $commit_dir ] || continue
+            # Outputs that running commits are reading are left until a later call
+            if in_use $commit_dir; then
+                continue
+            fi
+            # If the commit is the latest commit then, move the resulting stats to the 'current' directory
+            if [ ! `basename $commit_dir` = $current_hash ]; then
+                # With INCREMENTAL, the last commit's output is kept for the next one
+                if [ ! "$commit_dir" = "${previous_outputs[$i]}" ]; then
+                    rm -r $commit_dir
+                fi
+            elif ! in_use $dir/current; then
+                rm -rf $dir/current
+                # Since we're not currently creating symlinks, we can just do a plain move here
+                mv $dir/commits/$current_hash $dir/current
+                (cd $dir && tar -czf current.tar.gz current) || die $?
+                if [ "${previous_outputs[$i]}" = "$commit_dir" ]; then
+                    previous_outputs[$i]=$dir/current
+                fi
+            fi
+        done
+    done
+}
+batch_size=0
+
+# With INCREMENTAL, each commit reuses the per file output of the commit
+# processed before it (or the current output from the last run of git.sh)
+# for the files that haven't changed
+previous_outputs=()
+for i in ${!gitout_dirs[@]}; do
+    if [ "$INCREMENTAL" != "" ] && [ -d ${gitout_dirs[$i]}/current ]; then
+        previous_outputs[$i]=${gitout_dirs[$i]}/current
+    fi
+done
+
+# The output directory of a running commit, for each gitout directory
+running_output() {
+    local commit=$1 i=$2
+    if [ ${#gitout_dirs[@]} = 1 ]; then
+        echo $GITOUT_DIR/running/$commit
     else
-        echo "Running stats code for commit: $commit"
-        
-        # Get the data to the specified commit
-        cd data || exit $?
-        git checkout $commit
-        git clean -df
+        echo $GITOUT_DIR/running/$commit/$i
+    fi
+}
+
+# Join the arguments with commas
+join_commas() {
+    local IFS=,
+    echo "$*"
+}
+
+# Up to BACKFILL_COMMITS commits are run at once, each in its own output
+# directory in $GITOUT_DIR/running, and sharing BACKFILL_PROCESSES processes
+if [ "$BACKFILL_COMMITS" = "" ]; then
+    BACKFILL_COMMITS=1
+fi
+if [ "$BACKFILL_PROCESSES" = "" ]; then
+    multi_args=""
+else
+    multi=$((BACKFILL_PROCESSES / BACKFILL_COMMITS))
+    [ $multi -ge 1 ] || multi=1
+    multi_args="--multi $multi"
+fi
+rm -rf $GITOUT_DIR/running
+mkdir -p $GITOUT_DIR/running
+stats_args="$@"
 
-        commit_date=`git log --format="format:%ai" | head -n 1`
+# Run the stats code for a commit, in the background, writing its exit status
+# to $GITOUT_DIR/running/$commit.status when it is done
+run_commit() {
+    local commit=$1
+    echo "Running stats code for commit: $commit"
+    (
+        # The data is read at the commit from git's object store, so the
+        # working tree doesn't need to be checked out
+        cd data || exit $?
+        commit_date=`git log -1 --format="format:%ai" $commit`
         cd .. || exit $?
+        loop_args="--commit $commit"
 
-        # Disable this because it doesn't work for date dependent stuff.........
-        #mkdir -p $GITOUT_DIR/hash
-        #python statsrunner/hashlink.py || exit 1
-        # (and also this on the next line: --new)
+        # Reuse results for files that haven't changed since a previous commit
+        if [ "$CACHE_DIR" != "" ]; then
+            loop_args="$loop_args --cache-dir $CACHE_DIR"
+        fi
 
         # Run the stats commands and save output to log files
-        python calculate_stats.py $@ --today "$commit_date" loop > $GITOUT_DIR/logs/${commit}_loop.log || exit 1
-        python calculate_stats.py $@ --today "$commit_date" aggregate > $GITOUT_DIR/logs/${commit}_aggregate.log || exit 1
+        # The per file output is only needed by invert, for the current commit
         if [ $commit = $current_hash ]; then
-		python calculate_stats.py $@ --today "$commit_date" invert > $GITOUT_DIR/logs/${commit}_invert.log
+            loop_args="$loop_args --aggregated-file"
+        fi
+        if [ "$INCREMENTAL" != "" ]; then
+            loop_args="$loop_args --aggregated-file --keep-incremental"
+            # Only if there is a previous output for every gitout directory
+            if [ ${#previous_outputs[@]} = ${#gitout_dirs[@]} ]; then
+                loop_args="$loop_args --previous-output `join_commas ${previous_outputs[@]}`"
+            fi
+        fi
+        outputs=()
+        for i in ${!gitout_dirs[@]}; do
+            outputs[$i]=`running_output $commit $i`
+        done
+        output=`join_commas ${outputs[@]}`
+        python calculate_stats.py $stats_args $multi_args --output $output --today "$commit_date" run $loop_args > $GITOUT_DIR/logs/${commit}_run.log || exit 1
+        if [ $commit = $current_hash ]; then
+            python calculate_stats.py $stats_args $multi_args --output $output --today "$commit_date" invert > $GITOUT_DIR/logs/${commit}_invert.log
+        fi
+        exit 0
+    )
+    echo $? > $GITOUT_DIR/running/$commit.status
+}
+
+# Move the commits that have finished to $GITOUT_DIR/commits, in the order
+# they were started (i.e. commit order), and add them to the gitaggregate
+# output in batches. A commit that finishes early waits for those before it.
+running_commits=()
+collect_commits() {
+    while [ ${#running_commits[@]} -gt 0 ] && [ -f $GITOUT_DIR/running/${running_commits[0]}.status ]; do
+        local commit=${running_commits[0]}
+        running_commits=("${running_commits[@]:1}")
+        if [ `cat $GITOUT_DIR/running/$commit.status` != 0 ]; then
+            echo "Stats code failed for commit: $commit"
+            die 1
+        fi
+        rm -f $GITOUT_DIR/running/$commit.status $GITOUT_DIR/running/$commit.previous
+        for i in ${!gitout_dirs[@]}; do
+            local dir=${gitout_dirs[$i]}
+            rm -rf $dir/commits/$commit
+            mv `running_output $commit $i` $dir/commits/$commit || die $?
+            if [ "$INCREMENTAL" != "" ]; then
+                previous_outputs[$i]=$dir/commits/$commit
+            fi
+        done
+        rm -rf $GITOUT_DIR/running/$commit
+
+        batch_size=$((batch_size + 1))
+        if [ $batch_size -ge $GITAGGREGATE_BATCH ]; then
+            gitaggregate_commits
+            batch_size=0
         fi
-        #python statsrunner/hashcopy.py || exit 1
-        rm -r $GITOUT_DIR/commits/$commit
-        mv out $GITOUT_DIR/commits/$commit || exit $?
-
-        python statsrunner/gitaggregate.py
-        python statsrunner/gitaggregate.py dated
-        python statsrunner/gitaggregate-publisher.py
-        python statsrunner/gitaggregate-publisher.py dated
-        # If the commit is the latest commit then, move the resulting stats to the 'current' directory
-        if [ ! $commit = $current_hash ]; then
-            rm -r $GITOUT_DIR/commits/$commit
-        else
-            cd $GITOUT_DIR || exit $?
-            rm -r current
-            # Since we're not currently creating symlinks, we can just do a plain move here
-            mv commits/$current_hash current
-            tar -czf current.tar.gz current
-            cd .. || exit $?
+    done
+}
+
+# Whether a commit can be skipped for every gitout directory
+skip_commit() {
+    local commit=$1
+    for i in ${!gitout_dirs[@]}; do
+        if ! grep -q $commit ${commit_skip_files[$i]} && ! ( [ $GITOUT_SKIP_INCOMMITSDIR ] && [ -d ${gitout_dirs[$i]}/commits/$commit ] ); then
+            return 1
         fi
+    done
+    return 0
+}
+
+# Loop over commits and run stats code
+for commit in $commits; do
+    if skip_commit $commit; then
+        echo Skipping $commit
+    else
+        # Wait for a commit to finish if BACKFILL_COMMITS are running
+        while [ `jobs -rp | wc -l` -ge $BACKFILL_COMMITS ]; do
+            wait -n
+            collect_commits
+        done
+        collect_commits
+
+        # With INCREMENTAL, the commit uses the output of the last commit
+        # that has finished, which is kept until the commit is done
+        printf '%s\n' "${previous_outputs[@]}" > $GITOUT_DIR/running/$commit.previous
+        run_commit $commit &
+        running_commits+=($commit)
         if [ "$ALL_COMMITS" = "" ]; then
             break
         fi
     fi
 done
+while [ ${#running_commits[@]} -gt 0 ]; do
+    wait -n
+    collect_commits
+done
+gitaggregate_commits
+for i in ${!gitout_dirs[@]}; do
+    dir=${gitout_dirs[$i]}
+    if [ "${previous_outputs[$i]}" != "" ] && [ "${previous_outputs[$i]}" != "$dir/current" ]; then
+        rm -r ${previous_outputs[$i]}
+    fi
 
-cd $GITOUT_DIR || exit $?
-tar -czf gitaggregate.tar.gz gitaggregate
-tar -czf gitaggregate-dated.tar.gz gitaggregate-dated
-tar -czf gitaggregate-publisher.tar.gz gitaggregate-publisher
-tar -czf gitaggregate-publisher-dated.tar.gz gitaggregate-publisher-dated
+    # Write the gitaggregate JSON from the stores that the commits were appended to
+    GITOUT_DIR=$dir python statsrunner/gitaggregate.py both export
+    GITOUT_DIR=$dir python statsrunner/gitaggregate-publisher.py both export
+
+    (
+        cd $dir || exit $?
+        tar -czf gitaggregate.tar.gz gitaggregate
+        tar -czf gitaggregate-dated.tar.gz gitaggregate-dated
+        tar -czf gitaggregate-publisher.tar.gz gitaggregate-publisher
+        tar -czf gitaggregate-publisher-dated.tar.gz gitaggregate-publisher-dated
+    )
+done
 
@@ -3,5 +3,6 @@
 # which are used indepently by the dashboard.
 # However, the plan is to have the latter stats run depend on the former:
 # https://github.com/IATI/IATI-Dashboard/issues/223
-GITOUT_SKIP_INCOMMITSDIR=1 GITOUT_DIR=stats-blacklist COMMIT_SKIP_FILE=stats-blacklist/gitaggregate/activities_with_future_transactions.json ./git.sh --stats-module stats.activity_future_transaction_blacklist $@
-GITOUT_SKIP_INCOMMITSDIR=1 ./git.sh --stats-module stats.dashboard $@
+# Both are run together, so that each file is only parsed once, with the output
+# of each going to its own directory.
+GITOUT_SKIP_INCOMMITSDIR=1 GITOUT_DIR=stats-blacklist,gitout COMMIT_SKIP_FILE=stats-blacklist/gitaggregate/activities_with_future_transactions.json,gitout/gitaggregate/activities.json ./git.sh --stats-module stats.activity_future_transaction_blacklist,stats.dashboard $@
@@ -1,6 +1,7 @@
 import csv
 import datetime
 import re
+from lxml import etree
 
 def debug(stats, error):
     """ prints debugging information for a given stats object and error """
@@ -87,6 +88,23 @@ def planned_disbursement_year(planned_disbursement):
     else:
         return None
 
+def iterparse_discard(source, **kwargs):
+    """Yields elements from an XML file as they finish being parsed. Each element
+       is discarded once the next one is requested, so memory use does not grow
+       with the size of the file.
+
+       Input:
+         source -- filename or file object
+         kwargs -- passed to etree.iterparse, e.g. tag or schema
+       Returns:
+         generator of etree elements
+    """
+    for event, element in etree.iterparse(source, events=('end',), **kwargs):
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        yield element
+        element.clear()
+
 def get_registry_id_matches():
     """Returns a dictionary of publishers who have modified their registry ID
     Returns: Dictionary, where the key is the old registry ID, and the corresponding 
@@ -0,0 +1,153 @@
+"""
+Validators for individual elements, used by the comprehensiveness stats.
+
+The schemas are compiled once, when this module is imported, rather than on
+every call. Dates and decimals are also checked with a regular expression
+first. This decides the common, well formed cases without calling the schema
+at all. Anything the regular expressions don't cover is passed to the schema,
+so the result is always the same as validating against it. The conformance
+tests in stats/tests/test_validators.py check this.
+
+"""
+import calendar
+import re
+from lxml import etree
+
+DATE_SCHEMA = etree.XMLSchema(etree.XML('''
+    <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+        <xsd:element name="activity-date" type="dateType"/>
+        <xsd:element name="transaction-date" type="dateType"/>
+        <xsd:element name="period-start" type="dateType"/>
+        <xsd:element name="period-end" type="dateType"/>
+        <xsd:complexType name="dateType" mixed="true">
+            <xsd:sequence>
+                <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
+            </xsd:sequence>
+            <xsd:attribute name="iso-date" type="xsd:date" use="required"/>
+            <xsd:anyAttribute processContents="lax"/>
+        </xsd:complexType>
+        <xsd:element name="value">
+            <xsd:complexType mixed="true">
+                <xsd:sequence>
+                    <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
+                </xsd:sequence>
+                <xsd:attribute name="value-date" type="xsd:date" use="required"/>
+                <xsd:anyAttribute processContents="lax"/>
+            </xsd:complexType>
+        </xsd:element>
+    </xsd:schema>
+'''))
+
+URL_SCHEMA = etree.XMLSchema(etree.XML('''
+    <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+        <xsd:element name="document-link">
+            <xsd:complexType mixed="true">
+                <xsd:sequence>
+                    <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
+                </xsd:sequence>
+                <xsd:attribute name="url" type="xsd:anyURI" use="required"/>
+                <xsd:anyAttribute processContents="lax"/>
+            </xsd:complexType>
+        </xsd:element>
+        <xsd:element name="activity-website">
+            <xsd:complexType>
+                <xsd:simpleContent>
+                    <xsd:extension base="xsd:anyURI">
+                        <xsd:anyAttribute processContents="lax"/>
+                    </xsd:extension>
+                </xsd:simpleContent>
+            </xsd:complexType>
+        </xsd:element>
+    </xsd:schema>
+'''))
+
+VALUE_SCHEMA = etree.XMLSchema(etree.XML('''
+    <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+        <xsd:element name="value">
+            <xsd:complexType>
+                <xsd:simpleContent>
+                    <xsd:extension base="xsd:decimal">
+                        <xsd:anyAttribute processContents="lax"/>
+                    </xsd:extension>
+                </xsd:simpleContent>
+            </xsd:complexType>
+        </xsd:element>
+    </xsd:schema>
+'''))
+
+# The attribute that holds the date, for each element DATE_SCHEMA declares
+DATE_ATTRIBUTES = {
+    'activity-date': 'iso-date',
+    'transaction-date': 'iso-date',
+    'period-start': 'iso-date',
+    'period-end': 'iso-date',
+    'value': 'value-date',
+}
+
+# Four digit years, and timezones within +/-14:00. Other forms (e.g. negative
+# or five digit years) are left to the schema.
+simple_date_re = re.compile(r'^([0-9]{4})-([0-9]{2})-([0-9]{2})(Z|[+-](?:(?:0[0-9]|1[0-3]):[0-5][0-9]|14:00))?$')
+# Decimals with few enough digits that the schema can't reject them for precision
+simple_decimal_re = re.compile(r'^[ \t\n\r]*[+-]?([0-9]{1,15}(\.[0-9]{0,10})?|\.[0-9]{1,10})[ \t\n\r]*$')
+
+
+def _simple_element(element):
+    """ True if the element has no children, and no namespaced attributes, which the schemas may treat specially. """
+    return len(element) == 0 and not any(k.startswith('{') for k in element.attrib)
+
+
+def simple_date(value):
+    """
+    Returns True or False if value is a simple xsd:date, or None if it is not
+    simple enough to decide without the schema.
+
+    """
+    m = simple_date_re.match(value)
+    if not m:
+        return None
+    year, month, day = map(int, m.groups()[:3])
+    if year == 0:
+        return None
+    return 1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]
+
+
+def valid_date(date_element):
+    if date_element is None:
+        return False
+    if isinstance(date_element.tag, basestring) and _simple_element(date_element):
+        if date_element.tag not in DATE_ATTRIBUTES:
+            return False
+        value = date_element.attrib.get(DATE_ATTRIBUTES[date_element.tag])
+        if value is None:
+            return False
+        result = simple_date(value)
+        if result is not None:
+            return result
+    return DATE_SCHEMA.validate(date_element)
+
+
+def valid_url(element):
+    if element is None:
+        return False
+
+    if element.tag == 'document-link':
+        url = element.attrib.get('url')
+    elif element.tag == 'activity-website':
+        url = element.text
+    else:
+        return False
+
+    if url is None or url == '' or '://' not in url:
+        # Return false if it's empty or not an absolute url
+        return False
+
+    return URL_SCHEMA.validate(element)
+
+
+def valid_value(value_element):
+    if value_element is None:
+        return False
+    if value_element.tag == 'value' and _simple_element(value_element):
+        if value_element.text is not None and simple_decimal_re.match(value_element.text):
+            return True
+    return VALUE_SCHEMA.validate(value_element)
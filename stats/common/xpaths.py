@@ -0,0 +1,41 @@
+"""
+A registry of compiled XPath expressions.
+
+element.xpath(path) compiles path every time it is called, and the stats
+evaluate the same expressions for every activity. xpath() compiles each
+distinct expression once per process instead. Version specific codes are passed
+as arguments and substituted into the {} placeholders of the path, so each
+combination (e.g. each major version's transaction type codes) is compiled
+once and the string formatting is not repeated.
+
+The number of evaluations of each expression is counted in ``evaluations``.
+
+"""
+from collections import defaultdict
+from lxml import etree
+
+NAMESPACES = {'xml': 'http://www.w3.org/XML/1998/namespace'}
+
+# Maps (path, args) to (expression, etree.XPath)
+compiled = {}
+# Maps each expression to the number of times it has been evaluated
+evaluations = defaultdict(int)
+
+
+def xpath(element, path, *args):
+    """Evaluates an XPath expression on an element, the same as element.xpath(path.format(*args))
+
+       Keyword arguments:
+       element -- an etree element
+       path -- XPath expression, optionally with {} placeholders
+       args -- values to substitute into the placeholders
+    """
+    key = (path, args)
+    try:
+        expression, compiled_xpath = compiled[key]
+    except KeyError:
+        expression = path.format(*args) if args else path
+        compiled_xpath = etree.XPath(expression, namespaces=NAMESPACES)
+        compiled[key] = (expression, compiled_xpath)
+    evaluations[expression] += 1
+    return compiled_xpath(element)
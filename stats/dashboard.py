@@ -13,16 +13,32 @@ import os
 import re
 import json
 import subprocess
+import time
 import copy
 import csv
 
 from stats.common.decorators import *
 from stats.common import *
+from stats.common.validators import valid_date, valid_url, valid_value
+from stats.common.xpaths import xpath, evaluations as xpath_evaluations
 
 import iatirulesets
 from helpers.currency_conversion import get_USD_value
 from dateutil.relativedelta import relativedelta
 
+# Helper data that these stats depend on, so that changes to it invalidate statsrunner.cache
+cache_dependencies = [
+    'helpers/ckan.json',
+    'helpers/mapping-1.xml',
+    'helpers/mapping-2.xml',
+    'helpers/codelists',
+    'helpers/rulesets',
+    'helpers/schemas',
+    'helpers/transparency_indicator',
+    'helpers/registry_id_relationships.csv',
+    'helpers/currency_conversion/exchange_rates.csv',
+]
+
 
 def add_years(d, years):
     """Return a date that's `years` years before/after the date (or datetime)
@@ -150,98 +166,6 @@ def element_to_count_dict(element, path, count_dict, count_multiple=False):
     return count_dict
 
 
-def valid_date(date_element):
-    if date_element is None:
-        return False
-    schema_root = etree.XML('''
-        <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
-            <xsd:element name="activity-date" type="dateType"/>
-            <xsd:element name="transaction-date" type="dateType"/>
-            <xsd:element name="period-start" type="dateType"/>
-            <xsd:element name="period-end" type="dateType"/>
-            <xsd:complexType name="dateType" mixed="true">
-                <xsd:sequence>
-                    <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
-                </xsd:sequence>
-                <xsd:attribute name="iso-date" type="xsd:date" use="required"/>
-                <xsd:anyAttribute processContents="lax"/>
-            </xsd:complexType>
-            <xsd:element name="value">
-                <xsd:complexType mixed="true">
-                    <xsd:sequence>
-                        <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
-                    </xsd:sequence>
-                    <xsd:attribute name="value-date" type="xsd:date" use="required"/>
-                    <xsd:anyAttribute processContents="lax"/>
-                </xsd:complexType>
-            </xsd:element>
-        </xsd:schema>
-    ''')
-    schema = etree.XMLSchema(schema_root)
-    return schema.validate(date_element)
-
-
-def valid_url(element):
-    if element is None:
-        return False
-
-    if element.tag == 'document-link':
-        url = element.attrib.get('url')
-    elif element.tag == 'activity-website':
-        url = element.text
-    else:
-        return False
-
-    if url is None or url == '' or '://' not in url:
-        # Return false if it's empty or not an absolute url
-        return False
-
-    schema_root = etree.XML('''
-        <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
-            <xsd:element name="document-link">
-                <xsd:complexType mixed="true">
-                    <xsd:sequence>
-                        <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
-                    </xsd:sequence>
-                    <xsd:attribute name="url" type="xsd:anyURI" use="required"/>
-                    <xsd:anyAttribute processContents="lax"/>
-                </xsd:complexType>
-            </xsd:element>
-            <xsd:element name="activity-website">
-                <xsd:complexType>
-                    <xsd:simpleContent>
-                        <xsd:extension base="xsd:anyURI">
-                            <xsd:anyAttribute processContents="lax"/>
-                        </xsd:extension>
-                    </xsd:simpleContent>
-                </xsd:complexType>
-            </xsd:element>
-        </xsd:schema>
-    ''')
-    schema = etree.XMLSchema(schema_root)
-    return schema.validate(element)
-
-
-def valid_value(value_element):
-    if value_element is None:
-        return False
-    schema_root = etree.XML('''
-        <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
-            <xsd:element name="value">
-                <xsd:complexType>
-                    <xsd:simpleContent>
-                        <xsd:extension base="xsd:decimal">
-                            <xsd:anyAttribute processContents="lax"/>
-                        </xsd:extension>
-                    </xsd:simpleContent>
-                </xsd:complexType>
-            </xsd:element>
-        </xsd:schema>
-    ''')
-    schema = etree.XMLSchema(schema_root)
-    return schema.validate(value_element)
-
-
 def valid_coords(x):
     coords = x.split(' ')
     if len(coords) != 2:
@@ -267,8 +191,8 @@ def get_currency(iati_activity_object, budget_pd_transaction):
     currency = iati_activity_object.element.attrib.get('default-currency')
 
     # If there is a currency within the value element, overwrite the default currency
-    if budget_pd_transaction.xpath('value/@currency'):
-        currency = budget_pd_transaction.xpath('value/@currency')[0]
+    if xpath(budget_pd_transaction, 'value/@currency'):
+        currency = xpath(budget_pd_transaction, 'value/@currency')[0]
 
     # Return the currency
     return currency
@@ -279,7 +203,7 @@ def has_xml_lang(obj):
        Input: an etree XML object, for example a narrative element
        Return: True if @xml:lang is present, or False if not
     """
-    return len(obj.xpath("@xml:lang", namespaces={"xml": "http://www.w3.org/XML/1998/namespace"})) > 0
+    return len(xpath(obj, "@xml:lang")) > 0
 
 
 def get_language(major_version, iati_activity_obj, title_or_description_obj):
@@ -296,19 +220,19 @@ def get_language(major_version, iati_activity_obj, title_or_description_obj):
 
     # Get default language for this activity
     if has_xml_lang(iati_activity_obj):
-        default_lang = iati_activity_obj.xpath("@xml:lang", namespaces={"xml": "http://www.w3.org/XML/1998/namespace"})[0]
+        default_lang = xpath(iati_activity_obj, "@xml:lang")[0]
 
 
     if major_version == '2':
         for narrative_obj in title_or_description_obj.findall('narrative'):
             if has_xml_lang(narrative_obj):
-                langs.append(narrative_obj.xpath("@xml:lang", namespaces={"xml": "http://www.w3.org/XML/1998/namespace"})[0])
+                langs.append(xpath(narrative_obj, "@xml:lang")[0])
             elif has_xml_lang(iati_activity_obj):
                 langs.append(default_lang)
 
     else:
         if has_xml_lang(title_or_description_obj):
-            langs.append(title_or_description_obj.xpath("@xml:lang", namespaces={"xml": "http://www.w3.org/XML/1998/namespace"})[0])
+            langs.append(xpath(title_or_description_obj, "@xml:lang")[0])
         elif has_xml_lang(iati_activity_obj):
             langs.append(default_lang)
 
@@ -317,32 +241,77 @@ def get_language(major_version, iati_activity_obj, title_or_description_obj):
 
 
 
+# Rulesets, loaded once per process rather than for every activity
+rulesets = {}
+
+def get_ruleset(ruleset_name):
+    """Returns the named ruleset from helpers/rulesets, loading it the first time it is used."""
+    if ruleset_name not in rulesets:
+        with open('helpers/rulesets/{0}.json'.format(ruleset_name)) as fp:
+            rulesets[ruleset_name] = json.load(fp, object_pairs_hook=OrderedDict)
+    return rulesets[ruleset_name]
+
+
+class TransactionFacts(object):
+    """ The facts about a transaction that the stats use, worked out once per transaction. """
+    def __init__(self, activity_stats, transaction):
+        self.element = transaction
+        self.value_element = transaction.find('value')
+        transaction_type = transaction.find('transaction-type')
+        self.type_code = transaction_type.attrib.get('code') if transaction_type is not None else None
+        self.date = transaction_date(transaction)
+        self.year = self.date.year if self.date else None
+        self.currency = get_currency(activity_stats, transaction)
+
+    @memoize
+    def value(self):
+        """ Returns the transaction's value as a Decimal, or 0 if it has no value element. """
+        return 0 if self.value_element is None else Decimal(self.value_element.text)
+
+
 #Deals with elements that are in both organisation and activity files
 class CommonSharedElements(object):
     blank = False
 
+    @memoize
+    def _children_by_tag(self):
+        """ Groups the children of the element by tag, in one pass, for _children and _child. """
+        out = defaultdict(list)
+        for child in self.element:
+            out[child.tag].append(child)
+        return out
+
+    def _children(self, tag):
+        """ Returns the children with the given tag, the same as self.element.findall(tag) """
+        return self._children_by_tag().get(tag, [])
+
+    def _child(self, tag):
+        """ Returns the first child with the given tag, the same as self.element.find(tag) """
+        children = self._children(tag)
+        return children[0] if children else None
+
     @no_aggregation
     def iati_identifier(self):
         try:
-            return self.element.find('iati-identifier').text
+            return self._child('iati-identifier').text
         except AttributeError:
             return None
 
     @returns_numberdict
     def reporting_orgs(self):
-        return {self.element.find('reporting-org').attrib.get('ref'):1}
+        return {self._child('reporting-org').attrib.get('ref'):1}
 
     @returns_numberdict
     def participating_orgs(self):
-        return dict([ (x.attrib.get('ref'), 1) for x in self.element.findall('participating-org')])
+        return dict([ (x.attrib.get('ref'), 1) for x in self._children('participating-org')])
 
     @returns_numberdictdict
     def participating_orgs_text(self):
-        return dict([ (x.attrib.get('ref'), {x.text:1}) for x in self.element.findall('participating-org')])
+        return dict([ (x.attrib.get('ref'), {x.text:1}) for x in self._children('participating-org')])
 
     @returns_numberdictdict
     def participating_orgs_by_role(self):
-        return dict([ (x.attrib.get('role'), {x.attrib.get('ref'):1}) for x in self.element.findall('participating-org')])
+        return dict([ (x.attrib.get('role'), {x.attrib.get('ref'):1}) for x in self._children('participating-org')])
 
     @returns_numberdict
     def element_versions(self):
@@ -365,8 +334,7 @@ class CommonSharedElements(object):
     def ruleset_passes(self):
         out = {}
         for ruleset_name in ['standard']:
-            ruleset = json.load(open('helpers/rulesets/{0}.json'.format(ruleset_name)), object_pairs_hook=OrderedDict)
-            out[ruleset_name] = int(iatirulesets.test_ruleset_subelement(ruleset, self.element))
+            out[ruleset_name] = int(iatirulesets.test_ruleset_subelement(get_ruleset(ruleset_name), self.element))
         return out
 
 
@@ -378,10 +346,15 @@ class ActivityStats(CommonSharedElements):
     context = ''
     comprehensiveness_current_activity_status = None
     now = datetime.datetime.now() # TODO Add option to set this to date of git commit
+    # Stats that are calculated from other stats, for statsrunner.shared.select_stats
+    stat_dependencies = {
+        'sum_transactions_by_type_by_year_usd': ['sum_transactions_by_type_by_year'],
+        'sum_budgets_by_type_by_year_usd': ['sum_budgets_by_type_by_year'],
+    }
 
     @returns_numberdict
     def iati_identifiers(self):
-        return {self.element.find('iati-identifier').text:1}
+        return {self._child('iati-identifier').text:1}
 
     @returns_number
     def activities(self):
@@ -406,7 +379,7 @@ class ActivityStats(CommonSharedElements):
 
     @returns_numberdict
     def currencies(self):
-        currencies = [ x.find('value').get('currency') for x in self.element.findall('transaction') if x.find('value') is not None ]
+        currencies = [ t.value_element.get('currency') for t in self._transactions() if t.value_element is not None ]
         currencies = [ c if c else self.element.get('default-currency') for c in currencies ]
         return dict( (c,1) for c in currencies )
 
@@ -519,7 +492,7 @@ class ActivityStats(CommonSharedElements):
     def codelist_values(self):
         out = defaultdict(lambda: defaultdict(int))
         for path in codelist_mappings[self._major_version()]:
-            for value in self.element.xpath(path):
+            for value in xpath(self.element, path):
                 out[path][value] += 1
         return out
 
@@ -527,7 +500,7 @@ class ActivityStats(CommonSharedElements):
     def codelist_values_by_major_version(self):
         out = defaultdict(lambda: defaultdict(int))
         for path in codelist_mappings[self._major_version()]:
-            for value in self.element.xpath(path):
+            for value in xpath(self.element, path):
                 out[path][value] += 1
         return { self._major_version(): out  }
 
@@ -545,14 +518,14 @@ class ActivityStats(CommonSharedElements):
                 'result/@aggregation-status',
                 'transaction/@humanitarian'
                 ]:
-            for value in self.element.xpath(path):
+            for value in xpath(self.element, path):
                 out[path][value] += 1
         return out
 
     @returns_numberdict
     def provider_org(self):
         out = defaultdict(int)
-        for transaction in self.element.findall('transaction'):
+        for transaction in self._children('transaction'):
             provider_org = transaction.find('provider-org')
             if provider_org is not None:
                 out[provider_org.attrib.get('ref')] += 1
@@ -561,7 +534,7 @@ class ActivityStats(CommonSharedElements):
     @returns_numberdict
     def receiver_org(self):
         out = defaultdict(int)
-        for transaction in self.element.findall('transaction'):
+        for transaction in self._children('transaction'):
             receiver_org = transaction.find('receiver-org')
             if receiver_org is not None:
                 out[receiver_org.attrib.get('ref')] += 1
@@ -577,9 +550,9 @@ class ActivityStats(CommonSharedElements):
         out = defaultdict(int)
 
         # Loop over each tranaction
-        for transaction in self.element.findall('transaction'):
+        for transaction in self._children('transaction'):
             # If the transaction-type element has a code of 'IF' (v1) or 1 (v2), increment the output counter
-            if transaction.xpath('transaction-type/@code="{}"'.format(self._incoming_funds_code())):
+            if xpath(transaction, 'transaction-type/@code="{}"', self._incoming_funds_code()):
                 out['transactions_with_incoming_funds'] += 1
 
         # If there is at least one transaction within this activity with an incoming funds transaction, then increment the number of activities with incoming funds
@@ -594,8 +567,8 @@ class ActivityStats(CommonSharedElements):
         def months_ago(n):
             self.now.date() - datetime.timedelta(days=n*30)
         out = { 30:0, 60:0, 90:0, 180:0, 360:0 }
-        for transaction in self.element.findall('transaction'):
-            date = transaction_date(transaction)
+        for transaction in self._transactions():
+            date = transaction.date
             if date:
                 days = (today - date).days
                 if days < -1:
@@ -608,8 +581,8 @@ class ActivityStats(CommonSharedElements):
     @returns_numberdict
     def transaction_months(self):
         out = defaultdict(int)
-        for transaction in self.element.findall('transaction'):
-            date = transaction_date(transaction)
+        for transaction in self._transactions():
+            date = transaction.date
             if date:
                 out[date.month] += 1
         return out
@@ -617,8 +590,8 @@ class ActivityStats(CommonSharedElements):
     @returns_numberdict
     def transaction_months_with_year(self):
         out = defaultdict(int)
-        for transaction in self.element.findall('transaction'):
-            date = transaction_date(transaction)
+        for transaction in self._transactions():
+            date = transaction.date
             if date:
                 out['{}-{}'.format(date.year, str(date.month).zfill(2))] += 1
         return out
@@ -626,33 +599,28 @@ class ActivityStats(CommonSharedElements):
     @returns_numberdict
     def budget_lengths(self):
         out = defaultdict(int)
-        for budget in self.element.findall('budget'):
+        for budget in self._children('budget'):
             period_start = iso_date(budget.find('period-start'))
             period_end = iso_date(budget.find('period-end'))
             if period_start and period_end:
                 out[(period_end - period_start).days] += 1
         return out
 
-    def _transaction_year(self, transaction):
-        date = transaction_date(transaction)
-        return date.year if date else None
+    @memoize
+    def _transactions(self):
+        """ Returns a TransactionFacts for each transaction in the activity, which the transaction stats share. """
+        return [ TransactionFacts(self, transaction) for transaction in self._children('transaction') ]
 
     def _spend_currency_year(self, transactions):
         out = defaultdict(lambda: defaultdict(Decimal))
         for transaction in transactions:
-            value = transaction.find('value')
-            if (transaction.find('transaction-type') is not None and
-                    transaction.find('transaction-type').attrib.get('code') in [self._disbursement_code(), self._expenditure_code()]):
-
-                # Set transaction_value if a value exists for this transaction. Else set to 0
-                transaction_value = 0 if value is None else Decimal(value.text)
-
-                out[self._transaction_year(transaction)][get_currency(self, transaction)] += transaction_value
+            if transaction.type_code in [self._disbursement_code(), self._expenditure_code()]:
+                out[transaction.year][transaction.currency] += transaction.value()
         return out
 
     @returns_numberdictdict
     def spend_currency_year(self):
-        return self._spend_currency_year(self.element.findall('transaction'))
+        return self._spend_currency_year(self._transactions())
 
     def _is_secondary_reported(self):
         """Tests if this activity has been secondary reported. Test based on if the
@@ -663,12 +631,12 @@ class ActivityStats(CommonSharedElements):
           False -- Secondary-reporter flag not set, or evaulates to False
         """
         return bool(filter(lambda x: int(x) if str(x).isdigit() else 0,
-                     self.element.xpath('reporting-org/@secondary-reporter')))
+                     xpath(self.element, 'reporting-org/@secondary-reporter')))
 
     @returns_dict
     def activities_secondary_reported(self):
         if self._is_secondary_reported():
-            return { self.element.find('iati-identifier').text: 0}
+            return { self._child('iati-identifier').text: 0}
         else:
             return {}
 
@@ -679,7 +647,7 @@ class ActivityStats(CommonSharedElements):
         # As the forwardlooking page now only displays counts,
         # not the sums that this function calculates.
         out = defaultdict(lambda: defaultdict(Decimal))
-        budgets = self.element.findall('budget')
+        budgets = self._children('budget')
         for budget in budgets:
             value = budget.find('value')
 
@@ -696,8 +664,8 @@ class ActivityStats(CommonSharedElements):
            Output: a date object, or None if no value date found
         """
         # Get enddate. An 'actual end date' is preferred over a 'planned end date'
-        end_date_list = (self.element.xpath('activity-date[@type="{}"]'.format(self._actual_end_code())) or
-                         self.element.xpath('activity-date[@type="{}"]'.format(self._planned_end_code())))
+        end_date_list = (xpath(self.element, 'activity-date[@type="{}"]', self._actual_end_code()) or
+                         xpath(self.element, 'activity-date[@type="{}"]', self._planned_end_code()))
 
         # If there is a date, convert to a date object
         if end_date_list:
@@ -713,7 +681,7 @@ class ActivityStats(CommonSharedElements):
         # Get list of years for each of the planned-end and actual-end dates
         activity_end_years = [
             iso_date(x).year
-            for x in self.element.xpath('activity-date[@type="{}" or @type="{}"]'.format(self._planned_end_code(), self._actual_end_code()))
+            for x in xpath(self.element, 'activity-date[@type="{}" or @type="{}"]', self._planned_end_code(), self._actual_end_code())
             if iso_date(x)
         ]
         # Return boolean. True if activity_end_years is empty, or at least one of the actual/planned
@@ -734,9 +702,9 @@ class ActivityStats(CommonSharedElements):
         # Build a list of tuples, each tuple contains: (currency, value, date)
         commitment_transactions = [(
             get_currency(self, transaction),
-            transaction.xpath('value/text()')[0] if transaction.xpath('value/text()') else None,
+            xpath(transaction, 'value/text()')[0] if xpath(transaction, 'value/text()') else None,
             transaction_date(transaction)
-            ) for transaction in self.element.xpath('transaction[transaction-type/@code="{}"]'.format(self._commitment_code()))]
+            ) for transaction in xpath(self.element, 'transaction[transaction-type/@code="{}"]', self._commitment_code())]
 
         # Convert transaction values to USD and aggregate
         commitment_transactions_usd_total = sum([get_USD_value(x[0], x[1], x[2].year)
@@ -746,9 +714,9 @@ class ActivityStats(CommonSharedElements):
         # Build a list of tuples, each tuple contains: (currency, value, date)
         exp_disb_transactions = [(
             get_currency(self, transaction),
-            transaction.xpath('value/text()')[0] if transaction.xpath('value/text()') else None,
+            xpath(transaction, 'value/text()')[0] if xpath(transaction, 'value/text()') else None,
             transaction_date(transaction)
-            ) for transaction in self.element.xpath('transaction[transaction-type/@code="{}" or transaction-type/@code="{}"]'.format(self._disbursement_code(), self._expenditure_code()))]
+            ) for transaction in xpath(self.element, 'transaction[transaction-type/@code="{}" or transaction-type/@code="{}"]', self._disbursement_code(), self._expenditure_code())]
 
         # If the transaction date this year or older, convert transaction values to USD and aggregate
         exp_disb_transactions_usd_total = sum([get_USD_value(x[0], x[1], x[2].year)
@@ -798,11 +766,11 @@ class ActivityStats(CommonSharedElements):
         """
         # If there is no 'reporting-org/@ref' element, return False to avoid a 'list index out of range'
         # error in the statement that follows
-        if len(self.element.xpath('reporting-org/@ref')) < 1:
+        if len(xpath(self.element, 'reporting-org/@ref')) < 1:
             return False
 
-        return ((self.element.xpath('reporting-org/@ref')[0] in self.element.xpath("participating-org[@role='{}']/@ref|participating-org[@role='{}']/@ref".format(self._funding_code(), self._OrganisationRole_Extending_code())))
-            and (self.element.xpath('reporting-org/@ref')[0] not in self.element.xpath("participating-org[@role='{}']/@ref".format(self._OrganisationRole_Implementing_code()))))
+        return ((xpath(self.element, 'reporting-org/@ref')[0] in xpath(self.element, "participating-org[@role='{}']/@ref|participating-org[@role='{}']/@ref", self._funding_code(), self._OrganisationRole_Extending_code()))
+            and (xpath(self.element, 'reporting-org/@ref')[0] not in xpath(self.element, "participating-org[@role='{}']/@ref", self._OrganisationRole_Implementing_code())))
 
     @returns_dict
     def forwardlooking_excluded_activities(self):
@@ -814,7 +782,7 @@ class ActivityStats(CommonSharedElements):
         this_year = datetime.date.today().year
 
         # Retreive a dictionary with the activity identifier and the result for this and the next two years
-        return { self.element.find('iati-identifier').text: {year: int(self._forwardlooking_exclude_in_calculations(year))
+        return { self._child('iati-identifier').text: {year: int(self._forwardlooking_exclude_in_calculations(year))
                     for year in range(this_year, this_year+3)} }
 
 
@@ -862,7 +830,7 @@ class ActivityStats(CommonSharedElements):
         date_code_runs = date_code_runs if date_code_runs else self.now.date()
 
         this_year = int(date_code_runs.year)
-        budget_years = ([ budget_year(budget) for budget in self.element.findall('budget') ])
+        budget_years = ([ budget_year(budget) for budget in self._children('budget') ])
         return { year: int(self._forwardlooking_is_current(year) and year in budget_years and not bool(self._forwardlooking_exclude_in_calculations(year=year, date_code_runs=date_code_runs)))
                     for year in range(this_year, this_year+3) }
 
@@ -875,11 +843,11 @@ class ActivityStats(CommonSharedElements):
         """
 
         # Get the activity-code value for this activity
-        activity_status_code = self.element.xpath('activity-status/@code')
+        activity_status_code = xpath(self.element, 'activity-status/@code')
 
         # Get the end dates for this activity as lists
-        activity_planned_end_dates = [ iso_date(x) for x in self.element.xpath('activity-date[@type="{}"]'.format(self._planned_end_code())) if iso_date(x) ]
-        activity_actual_end_dates = [ iso_date(x) for x in self.element.xpath('activity-date[@type="{}"]'.format(self._actual_end_code())) if iso_date(x) ]
+        activity_planned_end_dates = [ iso_date(x) for x in xpath(self.element, 'activity-date[@type="{}"]', self._planned_end_code()) if iso_date(x) ]
+        activity_actual_end_dates = [ iso_date(x) for x in xpath(self.element, 'activity-date[@type="{}"]', self._actual_end_code()) if iso_date(x) ]
 
         # If there is no planned end date AND activity-status/@code is 2 (implementing) or 4 (post-completion), then this is a current activity
         if not(activity_planned_end_dates) and activity_status_code:
@@ -906,7 +874,7 @@ class ActivityStats(CommonSharedElements):
     @returns_dict
     def comprehensiveness_current_activities(self):
         """Outputs whether each activity is considered current for the purposes of comprehensiveness calculations"""
-        return {self.element.find('iati-identifier').text:self.comprehensiveness_current_activity_status}
+        return {self._child('iati-identifier').text:self.comprehensiveness_current_activity_status}
 
     def _is_recipient_language_used(self):
         """If there is only 1 recipient-country, test if one of the languages for that country is used
@@ -914,20 +882,20 @@ class ActivityStats(CommonSharedElements):
         """
 
         # Test only applies to activities where there is only 1 recipient-country
-        if len(self.element.findall('recipient-country')) == 1:
+        if len(self._children('recipient-country')) == 1:
             # Get list of languages for the recipient-country
             try:
-                country_langs = country_lang_map[self.element.xpath('recipient-country/@code')[0]]
+                country_langs = country_lang_map[xpath(self.element, 'recipient-country/@code')[0]]
             except (KeyError, IndexError):
                 country_langs = []
 
             # Get lists of the languages used in the title and descripton elements
             langs_in_title = []
-            for title_elem in self.element.findall('title'):
+            for title_elem in self._children('title'):
                langs_in_title.extend(get_language(self._major_version(), self.element, title_elem))
 
             langs_in_description = []
-            for descripton_elem in self.element.findall('description'):
+            for descripton_elem in self._children('description'):
                langs_in_description.extend(get_language(self._major_version(), self.element, descripton_elem))
 
 
@@ -957,11 +925,11 @@ class ActivityStats(CommonSharedElements):
             # The precise xpath needed will vary depending on the version
             if self._major_version() == '2':
                 # In v2, textual elements must be contained within child <narrative> elements
-                textFound = self.element.xpath('{}/narrative/text()'.format(elementName))
+                textFound = xpath(self.element, '{}/narrative/text()', elementName)
 
             elif self._major_version() == '1':
                 # In v1, free text is allowed without the need for child elements
-                textFound = self.element.xpath('{}/text()'.format(elementName))
+                textFound = xpath(self.element, '{}/text()', elementName)
 
             else:
                 # This is not a valid version
@@ -973,47 +941,47 @@ class ActivityStats(CommonSharedElements):
         return {
             'version': (self.element.getparent() is not None
                         and 'version' in self.element.getparent().attrib),
-            'reporting-org': (self.element.xpath('reporting-org/@ref')
+            'reporting-org': (xpath(self.element, 'reporting-org/@ref')
                         and is_text_in_element('reporting-org')),
-            'iati-identifier': self.element.xpath('iati-identifier/text()'),
-            'participating-org': self.element.find('participating-org') is not None,
+            'iati-identifier': xpath(self.element, 'iati-identifier/text()'),
+            'participating-org': self._child('participating-org') is not None,
             'title': is_text_in_element('title'),
             'description': is_text_in_element('description'),
-            'activity-status': self.element.find('activity-status') is not None,
-            'activity-date': self.element.find('activity-date') is not None,
-            'sector': self.element.find('sector') is not None or (self._major_version() != '1' and all_and_not_empty(
+            'activity-status': self._child('activity-status') is not None,
+            'activity-date': self._child('activity-date') is not None,
+            'sector': self._child('sector') is not None or (self._major_version() != '1' and all_and_not_empty(
                     (transaction.find('sector') is not None)
-                        for transaction in self.element.findall('transaction')
+                        for transaction in self._children('transaction')
                 )),
             'country_or_region': (
-                self.element.find('recipient-country') is not None
-                or self.element.find('recipient-region') is not None
+                self._child('recipient-country') is not None
+                or self._child('recipient-region') is not None
                 or (self._major_version() != '1' and all_and_not_empty(
                     (transaction.find('recipient-country') is not None or
                      transaction.find('recipient-region') is not None)
-                        for transaction in self.element.findall('transaction')
+                        for transaction in self._children('transaction')
                 ))),
-            'transaction_commitment': self.element.xpath('transaction[transaction-type/@code="{}" or transaction-type/@code="11"]'.format(self._commitment_code())),
-            'transaction_spend': self.element.xpath('transaction[transaction-type/@code="{}" or transaction-type/@code="{}"]'.format(self._disbursement_code(), self._expenditure_code())),
-            'transaction_currency': all_and_not_empty(x.xpath('value/@value-date') and x.xpath('../@default-currency|./value/@currency') for x in self.element.findall('transaction')),
-            'transaction_traceability': all_and_not_empty(x.xpath('provider-org/@provider-activity-id') for x in self.element.xpath('transaction[transaction-type/@code="{}"]'.format(self._incoming_funds_code())))
+            'transaction_commitment': xpath(self.element, 'transaction[transaction-type/@code="{}" or transaction-type/@code="11"]', self._commitment_code()),
+            'transaction_spend': xpath(self.element, 'transaction[transaction-type/@code="{}" or transaction-type/@code="{}"]', self._disbursement_code(), self._expenditure_code()),
+            'transaction_currency': all_and_not_empty(xpath(x, 'value/@value-date') and xpath(x, '../@default-currency|./value/@currency') for x in self._children('transaction')),
+            'transaction_traceability': all_and_not_empty(xpath(x, 'provider-org/@provider-activity-id') for x in xpath(self.element, 'transaction[transaction-type/@code="{}"]', self._incoming_funds_code()))
                                         or self._is_donor_publisher(),
-            'budget': self.element.findall('budget'),
+            'budget': self._children('budget'),
             'contact-info': self.element.findall('contact-info/email'),
-            'location': self.element.xpath('location/point/pos|location/name|location/description|location/location-administrative'),
-            'location_point_pos': self.element.xpath('location/point/pos'),
-            'sector_dac': self.element.xpath('sector[@vocabulary="{}" or @vocabulary="{}" or not(@vocabulary)]'.format(self._dac_5_code(), self._dac_3_code())),
-            'capital-spend': self.element.xpath('capital-spend/@percentage'),
-            'document-link': self.element.findall('document-link'),
-            'activity-website': self.element.xpath('activity-website' if self._major_version() == '1' else 'document-link[category/@code="A12"]'),
+            'location': xpath(self.element, 'location/point/pos|location/name|location/description|location/location-administrative'),
+            'location_point_pos': xpath(self.element, 'location/point/pos'),
+            'sector_dac': xpath(self.element, 'sector[@vocabulary="{}" or @vocabulary="{}" or not(@vocabulary)]', self._dac_5_code(), self._dac_3_code()),
+            'capital-spend': xpath(self.element, 'capital-spend/@percentage'),
+            'document-link': self._children('document-link'),
+            'activity-website': xpath(self.element, 'activity-website' if self._major_version() == '1' else 'document-link[category/@code="A12"]'),
             'recipient_language': self._is_recipient_language_used(),
-            'conditions_attached': self.element.xpath('conditions/@attached'),
-            'result_indicator': self.element.xpath('result/indicator'),
+            'conditions_attached': xpath(self.element, 'conditions/@attached'),
+            'result_indicator': xpath(self.element, 'result/indicator'),
             'aid_type': (
-                all_and_not_empty(self.element.xpath('default-aid-type/@code'))
-                or all_and_not_empty([transaction.xpath('aid-type/@code') for transaction in self.element.xpath('transaction')])
+                all_and_not_empty(xpath(self.element, 'default-aid-type/@code'))
+                or all_and_not_empty([xpath(transaction, 'aid-type/@code') for transaction in xpath(self.element, 'transaction')])
                 )
-            # Alternative: all(map(all_and_not_empty, [transaction.xpath('aid-type/@code') for transaction in self.element.xpath('transaction')]))
+            # Alternative: all(map(all_and_not_empty, [xpath(transaction, 'aid-type/@code') for transaction in xpath(self.element, 'transaction')]))
         }
 
     def _comprehensiveness_with_validation_bools(self):
@@ -1027,8 +995,8 @@ class ActivityStats(CommonSharedElements):
                 return element_obj.attrib.get('ref') if element_obj is not None else None
 
             bools = copy.copy(self._comprehensiveness_bools())
-            reporting_org_ref = element_ref(self.element.find('reporting-org'))
-            previous_reporting_org_refs = [element_ref(x) for x in self.element.xpath('other-identifier[@type="B1"]') if element_ref(x) is not None]
+            reporting_org_ref = element_ref(self._child('reporting-org'))
+            previous_reporting_org_refs = [element_ref(x) for x in xpath(self.element, 'other-identifier[@type="B1"]') if element_ref(x) is not None]
 
             def decimal_or_zero(value):
                 try:
@@ -1037,7 +1005,7 @@ class ActivityStats(CommonSharedElements):
                     return 0
 
             def empty_or_percentage_sum_is_100(path, by_vocab=False):
-                elements = self.element.xpath(path)
+                elements = xpath(self.element, path)
                 if not elements:
                     return True
                 else:
@@ -1059,16 +1027,16 @@ class ActivityStats(CommonSharedElements):
                     bools['iati-identifier'] and
                     (
                         # Give v1.xx data an automatic pass on this sub condition: https://github.com/IATI/IATI-Dashboard/issues/399
-                        (reporting_org_ref and self.element.find('iati-identifier').text.startswith(reporting_org_ref)) or
-                        any([self.element.find('iati-identifier').text.startswith(x) for x in previous_reporting_org_refs])
+                        (reporting_org_ref and self._child('iati-identifier').text.startswith(reporting_org_ref)) or
+                        any([self._child('iati-identifier').text.startswith(x) for x in previous_reporting_org_refs])
                         if self._major_version() is not '1' else True
                     )),
-                'participating-org': bools['participating-org'] and self._funding_code() in self.element.xpath('participating-org/@role'),
-                'activity-status': bools['activity-status'] and all_and_not_empty(x in CODELISTS[self._major_version()]['ActivityStatus'] for x in self.element.xpath('activity-status/@code')),
+                'participating-org': bools['participating-org'] and self._funding_code() in xpath(self.element, 'participating-org/@role'),
+                'activity-status': bools['activity-status'] and all_and_not_empty(x in CODELISTS[self._major_version()]['ActivityStatus'] for x in xpath(self.element, 'activity-status/@code')),
                 'activity-date': (
                     bools['activity-date'] and
-                    self.element.xpath('activity-date[@type="{}" or @type="{}"]'.format(self._planned_start_code(), self._actual_start_code())) and
-                    all_and_not_empty(map(valid_date, self.element.findall('activity-date')))
+                    xpath(self.element, 'activity-date[@type="{}" or @type="{}"]', self._planned_start_code(), self._actual_start_code()) and
+                    all_and_not_empty(map(valid_date, self._children('activity-date')))
                     ),
                 'sector': (
                     bools['sector'] and
@@ -1079,16 +1047,16 @@ class ActivityStats(CommonSharedElements):
                 'transaction_commitment': (
                     bools['transaction_commitment'] and
                     all([ valid_value(x.find('value')) for x in bools['transaction_commitment'] ]) and
-                    all_and_not_empty(any(valid_date(x) for x in t.xpath('transaction-date|value')) for t in bools['transaction_commitment'])
+                    all_and_not_empty(any(valid_date(x) for x in xpath(t, 'transaction-date|value')) for t in bools['transaction_commitment'])
                     ),
                 'transaction_spend': (
                     bools['transaction_spend'] and
                     all([ valid_value(x.find('value')) for x in bools['transaction_spend'] ]) and
-                    all_and_not_empty(any(valid_date(x) for x in t.xpath('transaction-date|value')) for t in bools['transaction_spend'])
+                    all_and_not_empty(any(valid_date(x) for x in xpath(t, 'transaction-date|value')) for t in bools['transaction_spend'])
                     ),
                 'transaction_currency': all(
                     all(map(valid_date, t.findall('value'))) and
-                    all(x in CODELISTS[self._major_version()]['Currency'] for x in t.xpath('../@default-currency|./value/@currency')) for t in self.element.findall('transaction')
+                    all(x in CODELISTS[self._major_version()]['Currency'] for x in xpath(t, '../@default-currency|./value/@currency')) for t in self._children('transaction')
                     ),
                 'budget': (
                     bools['budget'] and
@@ -1102,8 +1070,8 @@ class ActivityStats(CommonSharedElements):
                     valid_coords(x.text) for x in bools['location_point_pos']),
                 'sector_dac': (
                     bools['sector_dac'] and
-                    all(x.attrib.get('code') in CODELISTS[self._major_version()]['Sector'] for x in self.element.xpath('sector[@vocabulary="{}" or not(@vocabulary)]'.format(self._dac_5_code()))) and
-                    all(x.attrib.get('code') in CODELISTS[self._major_version()]['SectorCategory'] for x in self.element.xpath('sector[@vocabulary="{}"]'.format(self._dac_3_code())))
+                    all(x.attrib.get('code') in CODELISTS[self._major_version()]['Sector'] for x in xpath(self.element, 'sector[@vocabulary="{}" or not(@vocabulary)]', self._dac_5_code())) and
+                    all(x.attrib.get('code') in CODELISTS[self._major_version()]['SectorCategory'] for x in xpath(self.element, 'sector[@vocabulary="{}"]', self._dac_3_code()))
                     ),
                 'document-link': all_and_not_empty(
                     valid_url(x) and x.find('category') is not None and x.find('category').attrib.get('code') in CODELISTS[self._major_version()]['DocumentCategory'] for x in bools['document-link']),
@@ -1111,11 +1079,11 @@ class ActivityStats(CommonSharedElements):
                 'aid_type': (
                     bools['aid_type'] and
                     # i) Value in default-aid-type/@code is found in the codelist
-                    (all_and_not_empty([code in CODELISTS[self._major_version()]['AidType'] for code in self.element.xpath('default-aid-type/@code')])
+                    (all_and_not_empty([code in CODELISTS[self._major_version()]['AidType'] for code in xpath(self.element, 'default-aid-type/@code')])
                      # Or ii) Each transaction has a aid-type/@code which is found in the codelist
                      or all_and_not_empty(
                         [set(x).intersection(CODELISTS[self._major_version()]['AidType'])
-                        for x in [transaction.xpath('aid-type/@code') for transaction in self.element.xpath('transaction')]]
+                        for x in [xpath(transaction, 'aid-type/@code') for transaction in xpath(self.element, 'transaction')]]
                         )
                     ))
             })
@@ -1148,15 +1116,15 @@ class ActivityStats(CommonSharedElements):
     @returns_numberdict
     def comprehensiveness_denominators(self):
         if self._comprehensiveness_is_current():
-            dates = self.element.xpath('activity-date[@type="{}"]'.format(self._actual_start_code())) + self.element.xpath('activity-date[@type="{}"]'.format(self._planned_start_code()))
+            dates = xpath(self.element, 'activity-date[@type="{}"]', self._actual_start_code()) + xpath(self.element, 'activity-date[@type="{}"]', self._planned_start_code())
             if dates:
                 start_date = iso_date(dates[0])
             else:
                 start_date = None
             return {
-                'recipient_language': 1 if len(self.element.findall('recipient-country')) == 1 else 0,
+                'recipient_language': 1 if len(self._children('recipient-country')) == 1 else 0,
                 'transaction_spend': 1 if start_date and start_date < self.today and (self.today - start_date) > datetime.timedelta(days=365) else 0,
-                'transaction_traceability': 1 if (self.element.xpath('transaction[transaction-type/@code="{}"]'.format(self._incoming_funds_code()))) or self._is_donor_publisher() else 0,
+                'transaction_traceability': 1 if (xpath(self.element, 'transaction[transaction-type/@code="{}"]', self._incoming_funds_code())) or self._is_donor_publisher() else 0,
             }
         else:
             return {
@@ -1165,28 +1133,20 @@ class ActivityStats(CommonSharedElements):
                 'transaction_traceability': 0
             }
 
-    def _transaction_type_code(self, transaction):
-        type_code = None
-        transaction_type = transaction.find('transaction-type')
-        if transaction_type is not None:
-            type_code = transaction_type.attrib.get('code')
-        return type_code
-
     @returns_numberdictdict
     def transaction_dates(self):
         """Generates a dictionary of dates for reported transactions, together
            with the number of times they appear.
         """
         out = defaultdict(lambda: defaultdict(int))
-        for transaction in self.element.findall('transaction'):
-            date = transaction_date(transaction)
-            out[self._transaction_type_code(transaction)][unicode(date)] += 1
+        for transaction in self._transactions():
+            out[transaction.type_code][unicode(transaction.date)] += 1
         return out
 
     @returns_numberdictdict
     def activity_dates(self):
         out = defaultdict(lambda: defaultdict(int))
-        for activity_date in self.element.findall('activity-date'):
+        for activity_date in self._children('activity-date'):
             type_code = activity_date.attrib.get('type')
             date = iso_date(activity_date)
             out[type_code][unicode(date)] += 1
@@ -1195,22 +1155,16 @@ class ActivityStats(CommonSharedElements):
     @returns_numberdictdict
     def count_transactions_by_type_by_year(self):
         out = defaultdict(lambda: defaultdict(int))
-        for transaction in self.element.findall('transaction'):
-            out[self._transaction_type_code(transaction)][self._transaction_year(transaction)] += 1
+        for transaction in self._transactions():
+            out[transaction.type_code][transaction.year] += 1
         return out
 
     @returns_numberdictdictdict
     def sum_transactions_by_type_by_year(self):
         out = defaultdict(lambda: defaultdict(lambda: defaultdict(Decimal)))
-        for transaction in self.element.findall('transaction'):
-            value = transaction.find('value')
-            if (transaction.find('transaction-type') is not None and
-                    transaction.find('transaction-type').attrib.get('code') in [self._incoming_funds_code(), self._commitment_code(), self._disbursement_code(), self._expenditure_code()]):
-
-                # Set transaction_value if a value exists for this transaction. Else set to 0
-                transaction_value = 0 if value is None else Decimal(value.text)
-
-                out[self._transaction_type_code(transaction)][get_currency(self, transaction)][self._transaction_year(transaction)] += transaction_value
+        for transaction in self._transactions():
+            if transaction.type_code in [self._incoming_funds_code(), self._commitment_code(), self._disbursement_code(), self._expenditure_code()]:
+                out[transaction.type_code][transaction.currency][transaction.year] += transaction.value()
         return out
 
     @returns_numberdictdictdict
@@ -1229,14 +1183,14 @@ class ActivityStats(CommonSharedElements):
     @returns_numberdictdict
     def count_budgets_by_type_by_year(self):
         out = defaultdict(lambda: defaultdict(int))
-        for budget in self.element.findall('budget'):
+        for budget in self._children('budget'):
             out[budget.attrib.get('type')][budget_year(budget)] += 1
         return out
 
     @returns_numberdictdictdict
     def sum_budgets_by_type_by_year(self):
         out = defaultdict(lambda: defaultdict(lambda: defaultdict(Decimal)))
-        for budget in self.element.findall('budget'):
+        for budget in self._children('budget'):
             value = budget.find('value')
 
             # Set budget_value if a value exists for this budget. Else set to 0
@@ -1261,14 +1215,14 @@ class ActivityStats(CommonSharedElements):
     @returns_numberdict
     def count_planned_disbursements_by_year(self):
         out = defaultdict(int)
-        for pd in self.element.findall('planned-disbursement'):
+        for pd in self._children('planned-disbursement'):
             out[planned_disbursement_year(pd)] += 1
         return out
 
     @returns_numberdictdict
     def sum_planned_disbursements_by_year(self):
         out = defaultdict(lambda: defaultdict(Decimal))
-        for pd in self.element.findall('planned-disbursement'):
+        for pd in self._children('planned-disbursement'):
             value = pd.find('value')
 
             # Set disbursement_value if a value exists for this disbursement. Else set to 0
@@ -1283,8 +1237,33 @@ import json
 ckan = json.load(open('helpers/ckan.json'))
 publisher_re = re.compile('(.*)\-[^\-]')
 
+# Compiled IATI schemas, keyed by (version, schema_name), so that each is only
+# compiled once per process, rather than once per file.
+xmlschemas = {}
+xmlschema_metrics = defaultdict(float)
+
+def get_xmlschema(version, schema_name):
+    """Returns a compiled etree.XMLSchema for the given IATI version and schema filename.
+       Raises IOError if there is no schema for that version.
+    """
+    key = (version, schema_name)
+    if key in xmlschemas:
+        xmlschema, compile_seconds = xmlschemas[key]
+        xmlschema_metrics['xmlschema_cache_hits'] += 1
+        xmlschema_metrics['xmlschema_saved_seconds'] += compile_seconds
+    else:
+        start = time.time()
+        with open('helpers/schemas/{0}/{1}'.format(version, schema_name)) as f:
+            xmlschema = etree.XMLSchema(etree.parse(f))
+        compile_seconds = time.time() - start
+        xmlschemas[key] = (xmlschema, compile_seconds)
+        xmlschema_metrics['xmlschema_compiles'] += 1
+        xmlschema_metrics['xmlschema_compile_seconds'] += compile_seconds
+    return xmlschema
+
 class GenericFileStats(object):
     blank = False
+    streaming = False # (True when the file is too large to parse in full, so self.doc is not available)
 
     @returns_numberdict
     def versions(self):
@@ -1293,7 +1272,10 @@ class GenericFileStats(object):
     @returns_numberdict
     def version_mismatch(self):
         file_version = self.root.attrib.get('version')
-        element_versions = self.root.xpath('//iati-activity/@version')
+        if self.streaming:
+            element_versions = [ x.attrib['version'] for x in iterparse_discard(self.data_file.xml_source(), tag='iati-activity') if 'version' in x.attrib ]
+        else:
+            element_versions = xpath(self.root, '//iati-activity/@version')
         element_versions = list(set(element_versions))
         return {
             'true' if ( file_version is not None and len(element_versions) and [file_version] != element_versions ) else 'false'
@@ -1304,13 +1286,19 @@ class GenericFileStats(object):
         version = self.root.attrib.get('version')
         if version in [None, '1', '1.0', '1.00']: version = '1.01'
         try:
-            with open('helpers/schemas/{0}/{1}'.format(version, self.schema_name)) as f:
-                xmlschema_doc = etree.parse(f)
-                xmlschema = etree.XMLSchema(xmlschema_doc)
-                if xmlschema.validate(self.doc):
+            xmlschema = get_xmlschema(version, self.schema_name)
+            if self.streaming:
+                # Validate while parsing the file again, which raises an error at the first invalid element
+                try:
+                    for element in iterparse_discard(self.data_file.xml_source(), schema=xmlschema):
+                        pass
                     return {'pass':1}
-                else:
+                except etree.XMLSyntaxError:
                     return {'fail':1}
+            elif xmlschema.validate(self.doc):
+                return {'pass':1}
+            else:
+                return {'fail':1}
         except IOError:
             debug(self, 'Unsupported version \'{0}\' '.format(version))
             return {'fail':1}
@@ -1327,11 +1315,11 @@ class GenericFileStats(object):
 
     @returns_number
     def file_size(self):
-        return os.stat(self.inputfile).st_size
+        return self.data_file.size
 
     @returns_numberdict
     def file_size_bins(self):
-        file_size = os.stat(self.inputfile).st_size
+        file_size = self.data_file.size
         if file_size < 1*1024*1024:
             return {'<1MB': 1}
         elif file_size < 5*1024*1024:
@@ -1396,6 +1384,21 @@ class PublisherStats(object):
     blank = False
     strict = False # (Setting this to true will ignore values that don't follow the schema)
     context = ''
+    # The aggregated stats that each publisher stat uses, for statsrunner.shared.select_stats
+    stat_dependencies = {
+        'bottom_hierarchy': ['by_hierarchy'],
+        'publishers_per_version': ['versions'],
+        'publishers_validation': ['validation'],
+        'publisher_has_org_file': ['organisation_files'],
+        'publisher_unique_identifiers': ['iati_identifiers'],
+        'reference_spend_data_usd': ['reference_spend_data'],
+        'publisher_duplicate_identifiers': ['iati_identifiers'],
+        'timelag': ['transaction_months_with_year'],
+        'budget_length_median': ['budget_lengths'],
+        'date_extremes': ['activity_dates'],
+        'most_recent_transaction_date': ['transaction_dates'],
+        'latest_transaction_date': ['transaction_dates'],
+    }
 
     @returns_dict
     def bottom_hierarchy(self):
@@ -1644,6 +1647,11 @@ class OrganisationStats(CommonSharedElements):
 
 class AllDataStats(object):
     blank = False
+    # The aggregated stats that each stat uses, for statsrunner.shared.select_stats
+    stat_dependencies = {
+        'unique_identifiers': ['iati_identifiers'],
+        'duplicate_identifiers': ['iati_identifiers'],
+    }
 
     @returns_number
     def unique_identifiers(self):
@@ -1652,3 +1660,33 @@ class AllDataStats(object):
     @returns_numberdict
     def duplicate_identifiers(self):
         return {k:v for k,v in self.aggregated['iati_identifiers'].items() if v>1}
+
+
+def worker_init():
+    """Called by statsrunner.loop when each worker process starts. Loads the
+       rulesets, and compiles the schemas for every version up front.
+    """
+    try:
+        get_ruleset('standard')
+    except IOError:
+        pass
+    if not os.path.isdir('helpers/schemas'):
+        return
+    for version in os.listdir('helpers/schemas'):
+        for schema_name in [ActivityFileStats.schema_name, OrganisationFileStats.schema_name]:
+            try:
+                get_xmlschema(version, schema_name)
+            except (IOError, etree.XMLSchemaParseError):
+                pass
+
+
+def worker_metrics():
+    """Called by statsrunner.loop after each file. Returns the metrics collected
+       since the last call, which are summed and reported at the end of the run.
+    """
+    out = dict(xmlschema_metrics)
+    xmlschema_metrics.clear()
+    for expression, count in xpath_evaluations.items():
+        out['xpath_evaluations: '+expression] = count
+    xpath_evaluations.clear()
+    return out
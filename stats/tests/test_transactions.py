@@ -0,0 +1,74 @@
+from decimal import Decimal
+from lxml import etree
+import datetime
+
+from stats.dashboard import ActivityStats
+
+def test_children():
+    activity_stats = ActivityStats()
+    activity_stats.element = etree.fromstring('''
+        <iati-activity>
+            <transaction/>
+            <!-- A comment -->
+            <budget/>
+            <transaction/>
+        </iati-activity>
+    ''')
+    assert activity_stats._children('transaction') == activity_stats.element.findall('transaction')
+    assert activity_stats._children('result') == []
+    assert activity_stats._child('budget') is activity_stats.element.find('budget')
+    assert activity_stats._child('result') is None
+
+
+def test_transactions():
+    activity_stats = ActivityStats()
+    activity_stats.element = etree.fromstring('''
+        <iati-activity default-currency="GBP">
+            <transaction>
+                <transaction-type code="3"/>
+                <transaction-date iso-date="2014-02-01"/>
+                <value currency="USD" value-date="2013-01-01">10.5</value>
+            </transaction>
+            <transaction>
+                <value value-date="2013-01-01">invalid</value>
+            </transaction>
+            <transaction/>
+        </iati-activity>
+    ''')
+    first, second, third = activity_stats._transactions()
+    assert first.type_code == '3'
+    assert first.date == datetime.date(2014, 2, 1)
+    assert first.year == 2014
+    assert first.currency == 'USD'
+    assert first.value() == Decimal('10.5')
+
+    assert second.type_code is None
+    assert second.date == datetime.date(2013, 1, 1)
+    assert second.currency == 'GBP'
+
+    assert third.date is None
+    assert third.year is None
+    assert third.value() == 0
+
+    # The same objects are shared by each stat
+    assert activity_stats._transactions()[0] is first
+
+
+def test_budgets():
+    activity_stats = ActivityStats()
+    activity_stats.element = etree.fromstring('''
+        <iati-activity default-currency="GBP">
+            <budget type="1">
+                <period-start iso-date="2014-01-01"/>
+                <period-end iso-date="2014-12-31"/>
+                <value>10</value>
+            </budget>
+            <budget type="1">
+                <period-start iso-date="2014-01-01"/>
+                <value currency="USD">5</value>
+            </budget>
+        </iati-activity>
+    ''')
+    assert activity_stats.budget_lengths() == {364: 1}
+    assert activity_stats.count_budgets_by_type_by_year() == {'1': {2014: 1, None: 1}}
+    assert activity_stats.sum_budgets_by_type_by_year() == {'1': {'GBP': {2014: Decimal('10')}, 'USD': {None: Decimal('5')}}}
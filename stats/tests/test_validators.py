@@ -0,0 +1,62 @@
+# coding=utf-8
+
+"""
+Conformance tests, checking that the validators in stats.common.validators
+give the same answer as validating against the schemas.
+
+"""
+from lxml import etree
+import pytest
+
+from stats.common.validators import valid_date, valid_value, DATE_SCHEMA, VALUE_SCHEMA
+
+DATES = [
+    '2014-01-01', '2014-12-31', '2014-1-01', '2014-01-1', '2014-0101', '20140101',
+    '2014-00-01', '2014-13-01', '2014-01-00', '2014-01-32', '2014-04-31', '2014-06-30',
+    '2014-02-28', '2014-02-29', '2016-02-29', '2000-02-29', '1900-02-29', '2100-02-29',
+    '0001-01-01', '0000-01-01', '9999-12-31', '-2014-01-01', '12014-01-01', '02014-01-01',
+    '2014-01-01Z', '2014-01-01+00:00', '2014-01-01-05:00', '2014-01-01+14:00', '2014-01-01+14:01',
+    '2014-01-01+13:59', '2014-01-01+15:00', '2014-01-01+01:60', '2014-01-01+1:00', '2014-01-01z',
+    '2014-01-01T00:00:00', '2014-01-01 ', ' 2014-01-01', '\t2014-01-01\n', '2014- 01-01',
+    '2014-01-01 Z', '', ' ', '01/01/2014', '2014/01/01', 'today', '2014-01-01Z ', '+2014-01-01',
+    u'٢٠١٤-01-01', '2014-01-01\r', u'2014-01-01\xa0',
+]
+
+DECIMALS = [
+    '1', '1.0', '1.', '.1', '.', '-1', '+1', '-.5', '+.5', '1,0', '1,000', '1 000', '1e5', '1E5',
+    '', ' ', ' 1', '1 ', '\t1\n', '--1', '+-1', '0', '-0', '00001', '1.2.3', 'NaN', 'INF', '0x10',
+    '123456789012345', '1234567890123456789012345678901234567890', '0.0000000001',
+    '1.00000000000000000000000000000001', u'١', u'1\xa0', '$1',
+]
+
+
+def date_elements(value):
+    yield etree.XML('<activity-date/>')
+    for tag, attribute in [('activity-date', 'iso-date'), ('transaction-date', 'iso-date'), ('period-end', 'iso-date'), ('value', 'value-date')]:
+        element = etree.Element(tag)
+        element.attrib[attribute] = value
+        yield element
+    element = etree.Element('budget')
+    element.attrib['iso-date'] = value
+    yield element
+
+
+@pytest.mark.parametrize('value', DATES)
+def test_valid_date_conformance(value):
+    for element in date_elements(value):
+        assert valid_date(element) == DATE_SCHEMA.validate(element), element.attrib
+
+
+@pytest.mark.parametrize('value', DECIMALS)
+def test_valid_value_conformance(value):
+    element = etree.Element('value')
+    element.text = value
+    assert valid_value(element) == VALUE_SCHEMA.validate(element)
+    element.attrib['currency'] = 'GBP'
+    assert valid_value(element) == VALUE_SCHEMA.validate(element)
+
+
+def test_valid_children():
+    # Elements with children are always checked by the schema
+    assert valid_date(etree.XML('<activity-date iso-date="2014-01-01">Text<child/></activity-date>'))
+    assert not valid_value(etree.XML('<value>1.0<child/></value>'))
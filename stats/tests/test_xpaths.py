@@ -0,0 +1,34 @@
+from lxml import etree
+
+from stats.common import xpaths
+from stats.common.xpaths import xpath
+
+ACTIVITY = etree.fromstring('''
+    <iati-activity xml:lang="en">
+        <transaction><transaction-type code="3"/></transaction>
+        <transaction><transaction-type code="E"/></transaction>
+        <transaction><transaction-type code="4"/></transaction>
+    </iati-activity>
+''')
+
+
+def test_xpath_matches_element_xpath():
+    for path in ['transaction', 'transaction/transaction-type/@code', '@xml:lang', 'count(transaction)']:
+        assert xpath(ACTIVITY, path) == ACTIVITY.xpath(path)
+
+
+def test_xpath_args():
+    path = 'transaction[transaction-type/@code="{}" or transaction-type/@code="{}"]'
+    assert len(xpath(ACTIVITY, path, '3', 'D')) == 1
+    assert len(xpath(ACTIVITY, path, '4', 'E')) == 2
+    # Each combination of arguments is compiled once
+    assert (path, ('3', 'D')) in xpaths.compiled
+    assert (path, ('4', 'E')) in xpaths.compiled
+
+
+def test_xpath_evaluations():
+    xpaths.evaluations.clear()
+    xpath(ACTIVITY, 'transaction')
+    xpath(ACTIVITY, 'transaction')
+    xpath(ACTIVITY, 'transaction[transaction-type/@code="{}"]', '3')
+    assert xpaths.evaluations == {'transaction': 2, 'transaction[transaction-type/@code="3"]': 1}
@@ -1,8 +1,15 @@
 import argparse
+import copy
+import importlib
 import statsrunner.loop
 import statsrunner.aggregate
 import statsrunner.invert
+import statsrunner.packed
+import statsrunner.run
+import statsrunner.shared
+import statsrunner.source
 import datetime
+import os
 import re
 
 def parse_date(x):
@@ -13,7 +20,30 @@ def parse_date(x):
     else:
         raise ValueError
 
-def calculate_stats():
+def split_module_args(parser, args, stats_modules):
+    """
+    For several stats modules, return a copy of args for each, with the
+    matching directories from the comma separated --output and
+    --previous-output.
+
+    """
+    outputs = args.output.split(',')
+    if len(outputs) != len(stats_modules):
+        parser.error('--output must have a comma separated directory for each stats module')
+    previous_outputs = getattr(args, 'previous_output', None) and args.previous_output.split(',')
+    if previous_outputs and len(previous_outputs) != len(stats_modules):
+        parser.error('--previous-output must have a comma separated directory for each stats module')
+    module_args = []
+    for i, stats_module in enumerate(stats_modules):
+        module_args.append(copy.copy(args))
+        module_args[i].stats_module = stats_module
+        module_args[i].output = outputs[i]
+        module_args[i].module_args = None
+        if previous_outputs:
+            module_args[i].previous_output = previous_outputs[i]
+    return module_args
+
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug",
         help="Output extra debugging information",
@@ -29,8 +59,20 @@ def calculate_stats():
         default=1,
         type=int)
     parser.add_argument("--stats-module",
-        help="Python module to import stats from, defaults to stats.dashboard",
+        help="Python module to import stats from, defaults to stats.dashboard. Several comma separated modules can be given, with a comma separated --output directory for each, and loop and run then parse each file once for all of them",
         default='stats.dashboard')
+    parser.add_argument("--stats",
+        help="Comma separated list of stats to calculate, rather than all of them. Stats that these depend on are included too. With several stats modules, each calculates those of the stats that it has.",
+        type=lambda x: x.split(','))
+    parser.add_argument("--exclude-stats",
+        help="Comma separated list of stats not to calculate, from any of the stats modules",
+        type=lambda x: x.split(','))
+    parser.add_argument("--stat-timings",
+        help="Record the time taken, number of calls and number of exceptions for each stat, in metrics/stat_timings.json",
+        action="store_true")
+    parser.add_argument("--packed",
+        help="Write and read the aggregated stats as a few record files, rather than a JSON file per stat. See statsrunner/packed.py",
+        action="store_true")
     parser.add_argument("--verbose-loop",
         help="",
         action="store_true")
@@ -40,17 +82,40 @@ def calculate_stats():
         default=datetime.date.today())
     subparsers = parser.add_subparsers()
 
+    def add_loop_arguments(subparser):
+        subparser.add_argument("--folder",
+            help="Limit to a specific folder in the data")
+        subparser.add_argument("--data",
+            help="Data directory",
+            default='data')
+        subparser.add_argument("--streaming",
+            help="Parse files larger than 50MB incrementally with iterparse, rather than skipping them as toolarge",
+            action="store_true")
+        subparser.add_argument("--cache-dir",
+            help="Directory for a cache of per file results, keyed by file contents. Unchanged files are not parsed again.")
+        subparser.add_argument("--commit",
+            help="Read the data as it was at this git commit of the data directory, from git's object store, rather than the files checked out. See statsrunner/source.py")
+        subparser.add_argument("--previous-output",
+            help="Output directory of a previous run over an earlier commit of the data. The per file results of files that git reports as unchanged since then are reused. See statsrunner/incremental.py")
+        subparser.add_argument("--keep-incremental",
+            help="Write incremental.json and the exact totals of each publisher, so that this output can be a later run's --previous-output, and reuse the totals of the --previous-output",
+            action="store_true")
+
     parser_loop = subparsers.add_parser('loop',
         help='Loop over every activity organisation, and output JSON')
-    parser_loop.add_argument("--folder",
-        help="Limit to a specific folder in the data")
-    parser_loop.add_argument("--data",
-        help="Data directory",
-        default='data')
+    add_loop_arguments(parser_loop)
     parser_loop.add_argument("--new",
         help="Only create new files, don't overwrite existing ones",
         action="store_true")
-    parser_loop.set_defaults(func=statsrunner.loop.loop)
+    parser_loop.set_defaults(func=statsrunner.loop.loop, fused=False, aggregated_file=True)
+
+    parser_run = subparsers.add_parser('run',
+        help='Do the work of loop and aggregate in one pass, without writing and reading back the per file JSON')
+    add_loop_arguments(parser_run)
+    parser_run.add_argument("--aggregated-file",
+        help="Also write the per file JSON to aggregated-file",
+        action="store_true")
+    parser_run.set_defaults(func=statsrunner.run.run, fused=True, new=False)
 
     parser_aggregate = subparsers.add_parser('aggregate',
         help='Aggregate the per activity JSON into per file and per publisher JSON.')
@@ -58,8 +123,60 @@ def calculate_stats():
 
     parser_invert = subparsers.add_parser('invert',
         help="'invert' the aggregated JSON. ie. produce JSON that lists publishers and files with each value")
+    parser_invert.add_argument("--memory-budget",
+        help="Spill partial inversions to disk once they take more than this many megabytes in total (measured pickled; the file and publisher inversions get half each), and write the output one stat at a time",
+        type=int)
     parser_invert.set_defaults(func=statsrunner.invert.invert)
 
-    args = parser.parse_args()
-    args.func(args)
+    parser_export = subparsers.add_parser('export',
+        help='Write the aggregated JSON directories from the record files written with --packed')
+    parser_export.set_defaults(func=statsrunner.packed.export)
+
+    return parser
+
+def parse_args(argv=None):
+    """
+    Parse the command line (or argv), and check and fill in the arguments
+    that depend on each other.
+
+    """
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.packed and getattr(args, 'new', False):
+        parser.error('--new is not supported with --packed')
+    if args.packed and getattr(args, 'previous_output', None):
+        for previous_output, output in zip(args.previous_output.split(','), args.output.split(',')):
+            if os.path.realpath(previous_output) == os.path.realpath(output):
+                parser.error('--previous-output must be a different directory to --output with --packed')
+    if getattr(args, 'commit', None):
+        commit = statsrunner.source.resolve_commit(args.data, args.commit)
+        if commit is None:
+            parser.error('{0} is not a commit of the git repository in {1}'.format(args.commit, args.data))
+        args.commit = commit
+    args.module_args = None
+    stats_modules = args.stats_module.split(',')
+    if len(stats_modules) > 1:
+        args.module_args = split_module_args(parser, args, stats_modules)
+    modules = args.module_args or [args]
+    for module_args in modules:
+        module_args.enabled_stats = None
+    if args.stats or args.exclude_stats:
+        # The names are checked against every module's stats, and each module gets those it has
+        stats_modules = [ importlib.import_module(module_args.stats_module) for module_args in modules ]
+        try:
+            enabled_stats = statsrunner.shared.select_module_stats(stats_modules, args.stats, args.exclude_stats)
+        except ValueError, e:
+            parser.error(str(e))
+        for module_args, module_enabled_stats in zip(modules, enabled_stats):
+            module_args.enabled_stats = module_enabled_stats
+    return args
+
+def calculate_stats():
+    args = parse_args()
+    if args.module_args and args.func not in [statsrunner.loop.loop, statsrunner.run.run]:
+        # Only loop and run read the data, so the other commands are simply run for each module
+        for module_args in args.module_args:
+            args.func(module_args)
+    else:
+        args.func(args)
 
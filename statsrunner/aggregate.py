@@ -7,6 +7,9 @@ import decimal
 import argparse
 import statsrunner
 import datetime
+import time
+import statsrunner.packed
+import statsrunner.timings
 from statsrunner import common
 
 def decimal_default(obj):
@@ -18,101 +21,347 @@ def decimal_default(obj):
     else:
         return common.decimal_default(obj)
 
+# Used to sum the publisher totals exactly. Decimals from the JSON have at
+# most 17 significant digits, so this is far more than enough
+EXACT_CONTEXT = decimal.Context(prec=1000)
+
+# Values that are never changed in place, so are summed into without copying them
+ATOMIC_TYPES = (int, long, float, decimal.Decimal, str, unicode, bool, type(None))
+
+def copy_stat(value):
+    """
+    Copy a stat value, as copy.deepcopy would. Stats are almost always nested
+    dictionaries of numbers and strings, which this copies without the
+    overhead of deepcopy.
+
+    """
+    value_type = type(value)
+    if value_type in ATOMIC_TYPES:
+        return value
+    elif value_type is dict:
+        return dict((k, copy_stat(v)) for k, v in value.iteritems())
+    elif value_type is defaultdict:
+        out = defaultdict(value.default_factory)
+        for k, v in value.iteritems():
+            out[k] = copy_stat(v)
+        return out
+    else:
+        return copy.deepcopy(value)
+
+def plain_stat(value):
+    """
+    Return a copy of a stat value with its defaultdicts changed to plain
+    dictionaries, so it can be pickled (default factories are often lambdas).
+
+    """
+    if type(value) in (dict, defaultdict):
+        return dict((k, plain_stat(v)) for k, v in value.iteritems())
+    return value
+
 def dict_sum_inplace(d1, d2):
     if d1 is None: return
-    for k,v in d2.items():
-        if type(v) == dict or type(v) == defaultdict:
+    plain = type(d1) != defaultdict
+    for k,v in d2.iteritems():
+        value_type = type(v)
+        if value_type is dict or value_type is defaultdict:
             if k in d1:
                 dict_sum_inplace(d1[k], v)
             else:
-                d1[k] = copy.deepcopy(v)
-        elif (type(d1) != defaultdict and not k in d1):
-            d1[k] = copy.deepcopy(v)
-        elif d1[k] is None:
-            continue
+                d1[k] = copy_stat(v)
+        elif plain and not k in d1:
+            d1[k] = copy_stat(v)
         else:
-            d1[k] += v
+            current = d1[k]
+            if current is not None:
+                current += v
+                d1[k] = current
 
-def make_blank(stats_module):
+def make_blank(stats_module, enabled_stats=None):
     blank = {}
     for stats_object in [ stats_module.ActivityStats(), stats_module.ActivityFileStats(), stats_module.OrganisationStats(), stats_module.OrganisationFileStats(), stats_module.PublisherStats(), stats_module.AllDataStats() ]:
         stats_object.blank = True
+        statsrunner.shared.restrict_stats(stats_object, enabled_stats)
         for name, function in inspect.getmembers(stats_object, predicate=inspect.ismethod):
             if not statsrunner.shared.use_stat(stats_object, name): continue
             blank[name] = function()
     return blank
 
-def aggregate_file(stats_module, stats_json, output_dir):
-    subtotal = make_blank(stats_module) # FIXME This may be inefficient
+# Blank templates made by blank_template in this process, by stats module name and enabled stats
+blank_templates = {}
+# Number of blank templates built and copied, and the seconds spent, since blank_metrics was last called
+blank_counts = {'blank_template_builds': 0, 'blank_template_copies': 0, 'blank_template_seconds': 0.0}
+
+def blank_template(stats_module, enabled_stats=None):
+    """
+    Return a copy of make_blank(stats_module, enabled_stats). The blank is
+    only made once in each process, and copied after that, rather than
+    creating every stats object and calling every stat in blank mode again for
+    each file.
+
+    """
+    start = time.time()
+    key = (stats_module.__name__, frozenset(enabled_stats) if enabled_stats is not None else None)
+    if key not in blank_templates:
+        blank_templates[key] = make_blank(stats_module, enabled_stats)
+        blank_counts['blank_template_builds'] += 1
+    blank = copy_stat(blank_templates[key])
+    blank_counts['blank_template_copies'] += 1
+    blank_counts['blank_template_seconds'] += time.time() - start
+    return blank
+
+def blank_metrics():
+    """ Return the blank template counts and time since the last call, and reset them. """
+    metrics = dict(blank_counts)
+    for k in blank_counts:
+        blank_counts[k] = 0
+    blank_counts['blank_template_seconds'] = 0.0
+    return metrics
+
+def sum_elements(stats_module, elements, enabled_stats=None):
+    """ Sum the stats for an iterable of elements, without keeping them all in memory. """
+    total = blank_template(stats_module, enabled_stats)
+    for element_json in elements:
+        dict_sum_inplace(total, element_json)
+    return total
+
+def aggregate_file(stats_module, stats_json, output_dir, cached=None, enabled_stats=None):
+    """ Sum the stats for a file, and write them to output_dir, unless it is None. """
+    subtotal = blank_template(stats_module, enabled_stats)
     for activity_json in stats_json['elements']:
         dict_sum_inplace(subtotal, activity_json)
     dict_sum_inplace(subtotal, stats_json['file'])
+    if cached:
+        # Stats loaded from statsrunner.cache replace their blank values
+        subtotal.update(cached)
 
-    try:
-        os.makedirs(output_dir)
-    except OSError: pass
-    for aggregate_name,aggregate in subtotal.items():
-        with open(os.path.join(output_dir, aggregate_name+'.json'), 'w') as fp:
-            json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
+    if output_dir is not None:
+        try:
+            os.makedirs(output_dir)
+        except OSError: pass
+        for aggregate_name,aggregate in subtotal.items():
+            with open(os.path.join(output_dir, aggregate_name+'.json'), 'w') as fp:
+                # Cached stats are read back with their keys in the order they were
+                # written, which sorting the keys again as strings would change
+                json.dump(aggregate, fp, sort_keys=not (cached and aggregate_name in cached), indent=2, default=decimal_default)
 
     return subtotal
 
-def aggregate(args):
-    import importlib
-    stats_module = importlib.import_module(args.stats_module)
-    
-    for newdir in ['aggregated-publisher', 'aggregated-file', 'aggregated']:
+def make_output_dirs(args):
+    if args.packed:
+        newdirs = ['aggregated-file']
+        # The publisher and all data records are appended to, so start them afresh
+        statsrunner.packed.remove(os.path.join(args.output, statsrunner.packed.PUBLISHER_RECORDS))
+        statsrunner.packed.remove(os.path.join(args.output, statsrunner.packed.ALL_RECORDS))
+    else:
+        newdirs = ['aggregated-publisher', 'aggregated-file', 'aggregated']
+    for newdir in newdirs:
         try:
-            os.mkdir(os.path.join(args.output, newdir))
+            os.makedirs(os.path.join(args.output, newdir))
         except OSError: pass
 
-    blank = make_blank(stats_module)
-
-    if args.verbose_loop:
-        base_folder = os.path.join(args.output, 'loop')
-    else:
-        base_folder = os.path.join(args.output, 'aggregated-file')
-    total = copy.deepcopy(blank)
-    for folder in os.listdir(base_folder):
-        publisher_total = copy.deepcopy(blank)
-
-        for jsonfilefolder in os.listdir(os.path.join(base_folder, folder)):
-            if args.verbose_loop:
-                with open(os.path.join(base_folder, folder, jsonfilefolder)) as jsonfp:
-                    stats_json = json.load(jsonfp, parse_float=decimal.Decimal)
-                    subtotal = aggregate_file(stats_module, stats_json, os.path.join(args.output, 'aggregated-file', folder, jsonfilefolder))
-            else:
-                subtotal = copy.deepcopy(blank)
-                for jsonfile in os.listdir(os.path.join(base_folder, folder, jsonfilefolder)):
-                    with open(os.path.join(base_folder, folder, jsonfilefolder, jsonfile)) as jsonfp:
-                        stats_json = json.load(jsonfp, parse_float=decimal.Decimal)
-                        subtotal[jsonfile[:-5]] = stats_json
-
-            dict_sum_inplace(publisher_total, subtotal)
-
-        publisher_stats = stats_module.PublisherStats()
-        publisher_stats.aggregated = publisher_total
-        publisher_stats.folder = folder
-        publisher_stats.today = args.today
-        for name, function in inspect.getmembers(publisher_stats, predicate=inspect.ismethod):
-            if not statsrunner.shared.use_stat(publisher_stats, name): continue
-            publisher_total[name] = function()
+def aggregate_publisher(stats_module, publisher_total, folder, args):
+    """ Calculate the publisher stats from the sum of a publisher's file stats, and write them to aggregated-publisher. """
+    publisher_stats = stats_module.PublisherStats()
+    publisher_stats.aggregated = publisher_total
+    publisher_stats.folder = folder
+    publisher_stats.today = args.today
+    statsrunner.shared.restrict_stats(publisher_stats, args.enabled_stats)
+    for name, function in inspect.getmembers(publisher_stats, predicate=inspect.ismethod):
+        if not statsrunner.shared.use_stat(publisher_stats, name): continue
+        publisher_total[name] = statsrunner.timings.call(publisher_stats, name, function, args)
 
-        dict_sum_inplace(total, publisher_total)
-        for aggregate_name,aggregate in publisher_total.items():
-            try:
-                os.mkdir(os.path.join(args.output, 'aggregated-publisher', folder))
-            except OSError: pass
-            with open(os.path.join(args.output, 'aggregated-publisher', folder, aggregate_name+'.json'), 'w') as fp:
-                json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
+    if args.packed:
+        statsrunner.packed.append(os.path.join(args.output, statsrunner.packed.PUBLISHER_RECORDS), folder, publisher_total, decimal_default)
+        return
+    for aggregate_name,aggregate in publisher_total.items():
+        try:
+            os.mkdir(os.path.join(args.output, 'aggregated-publisher', folder))
+        except OSError: pass
+        with open(os.path.join(args.output, 'aggregated-publisher', folder, aggregate_name+'.json'), 'w') as fp:
+            json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
 
+def aggregate_all(stats_module, total, args):
+    """ Calculate the stats for all the data from the sum of every publisher's stats, and write them to aggregated. """
     all_stats = stats_module.AllDataStats()
     all_stats.aggregated = total
+    statsrunner.shared.restrict_stats(all_stats, args.enabled_stats)
     for name, function in inspect.getmembers(all_stats, predicate=inspect.ismethod):
         if not statsrunner.shared.use_stat(all_stats, name): continue
-        total[name] = function()
+        total[name] = statsrunner.timings.call(all_stats, name, function, args)
 
+    if args.packed:
+        statsrunner.packed.append(os.path.join(args.output, statsrunner.packed.ALL_RECORDS), '', total, decimal_default)
+        return
     for aggregate_name,aggregate in total.items():
         with open(os.path.join(args.output, 'aggregated', aggregate_name+'.json'), 'w') as fp:
             json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
 
+def list_publishers(args):
+    """
+    Return a list of (folder, size) for each publisher to aggregate, where
+    size is a rough measure of the work, used to schedule it with --multi.
+
+    """
+    if args.packed and not args.verbose_loop:
+        return [ (folder, os.path.getsize(path)) for folder, path in statsrunner.packed.file_records(args.output) ]
+    base_folder = publisher_base_folder(args)
+    return [ (folder, len(os.listdir(os.path.join(base_folder, folder)))) for folder in os.listdir(base_folder) ]
+
+def publisher_base_folder(args):
+    if args.verbose_loop:
+        return os.path.join(args.output, 'loop')
+    else:
+        return os.path.join(args.output, 'aggregated-file')
+
+def read_subtotals(stats_module, folder, args, exclude=()):
+    """
+    Return an iterator over the summed stats of each of a publisher's files.
+    These are read from the aggregated-file records with --packed, or else
+    from aggregated-file, or summed from the loop output for --verbose-loop.
+    Stats missing from a file are left out, rather than filled in with their
+    blank values, as adding those to a total makes no difference, as are the
+    stats in exclude.
+
+    """
+    if args.packed and not args.verbose_loop:
+        path = statsrunner.packed.file_records_path(args.output, folder)
+        return (stats for xmlfile, stats in statsrunner.packed.read_grouped(path, args.enabled_stats, exclude=exclude))
+    return folder_subtotals(stats_module, publisher_base_folder(args), folder, args, exclude)
+
+def folder_subtotals(stats_module, base_folder, folder, args, exclude=()):
+    if args.verbose_loop and args.packed:
+        statsrunner.packed.remove(statsrunner.packed.file_records_path(args.output, folder))
+    for jsonfilefolder in os.listdir(os.path.join(base_folder, folder)):
+        if args.verbose_loop:
+            with open(os.path.join(base_folder, folder, jsonfilefolder)) as jsonfp:
+                stats_json = json.load(jsonfp, parse_float=decimal.Decimal)
+            if args.packed:
+                subtotal = aggregate_file(stats_module, stats_json, None, enabled_stats=args.enabled_stats)
+                statsrunner.packed.append(statsrunner.packed.file_records_path(args.output, folder), jsonfilefolder, subtotal, decimal_default)
+            else:
+                subtotal = aggregate_file(stats_module, stats_json, os.path.join(args.output, 'aggregated-file', folder, jsonfilefolder), enabled_stats=args.enabled_stats)
+        else:
+            subtotal = {}
+            for jsonfile in os.listdir(os.path.join(base_folder, folder, jsonfilefolder)):
+                if args.enabled_stats is not None and jsonfile[:-5] not in args.enabled_stats:
+                    continue
+                if jsonfile[:-5] in exclude:
+                    continue
+                with open(os.path.join(base_folder, folder, jsonfilefolder, jsonfile)) as jsonfp:
+                    stats_json = json.load(jsonfp, parse_float=decimal.Decimal)
+                    subtotal[jsonfile[:-5]] = stats_json
+        yield subtotal
+
+def add_publisher_total(total, publisher_total):
+    """
+    Add a publisher's stats (or a sum of publishers' stats) to a total.
+    Decimals are summed exactly, rather than rounded to 28 digits, so the
+    order they are added in, which differs with --multi, makes no difference.
+
+    """
+    with decimal.localcontext(EXACT_CONTEXT):
+        dict_sum_inplace(total, publisher_total)
+
+def aggregate_folder(stats_module, blank, folder, args):
+    """ Sum a publisher's file stats, calculate its publisher stats and write them. Returns the publisher's total. """
+    import statsrunner.incremental
+    publisher_total = statsrunner.incremental.publisher_blank(blank, folder, args)
+    exclude = args.reused_stats if folder in args.reused_publishers else ()
+    for subtotal in read_subtotals(stats_module, folder, args, exclude):
+        dict_sum_inplace(publisher_total, subtotal)
+    aggregate_publisher(stats_module, publisher_total, folder, args)
+    statsrunner.incremental.write_publisher_total(publisher_total, folder, args)
+    return publisher_total
+
+def aggregate_chunk(chunk):
+    """
+    Aggregate a chunk of (folder, args, size) publishers in a worker process.
+    Returns (pid, the sum of their totals as plain dictionaries, stat timings).
+
+    """
+    import importlib
+    import statsrunner.incremental
+    args = chunk[0][1]
+    stats_module = importlib.import_module(args.stats_module)
+    blank = blank_template(stats_module, args.enabled_stats)
+    total = copy_stat(blank)
+    for folder, args, size in chunk:
+        publisher_total = aggregate_folder(stats_module, blank, folder, args)
+        add_publisher_total(total, statsrunner.incremental.total_part(publisher_total, folder, args))
+    return os.getpid(), plain_stat(total), statsrunner.timings.collect()
+
+def merge_totals((total, other)):
+    add_publisher_total(total, other)
+    return total
+
+def reduce_totals(totals, pool):
+    """ Sum a list of totals with a reduction tree, adding pairs of them in parallel until one is left. """
+    while len(totals) > 1:
+        pairs = [ (totals[i], totals[i+1]) for i in range(0, len(totals) - 1, 2) ]
+        merged = pool.map(merge_totals, pairs)
+        if len(totals) % 2:
+            merged.append(totals[-1])
+        totals = merged
+    return totals[0]
+
+def aggregate_parallel(blank, publishers, args):
+    """
+    Aggregate the publishers in args.multi worker processes, largest first.
+    Each chunk of publishers is summed in a worker, and then the chunk totals
+    are summed with a reduction tree. Returns the total.
+
+    The totals are passed between processes as plain dictionaries, and the
+    result is added to a copy of the blank, so the top level of each stat has
+    its usual type (AllDataStats only looks at the top level).
+
+    """
+    from multiprocessing import Pool
+    import statsrunner.loop
+    publishers = [ (folder, args, size) for folder, size in publishers ]
+    chunks = statsrunner.loop.schedule(publishers, args.multi, size=lambda publisher: publisher[2])
+    pool = Pool(args.multi)
+    try:
+        totals = []
+        worker_timings = defaultdict(dict)
+        for pid, chunk_total, chunk_timings in pool.imap_unordered(aggregate_chunk, chunks):
+            totals.append(chunk_total)
+            statsrunner.timings.merge_modules(worker_timings[str(pid)], chunk_timings)
+        total = copy_stat(blank)
+        if totals:
+            add_publisher_total(total, reduce_totals(totals, pool))
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    if args.stat_timings:
+        statsrunner.timings.write(args.output, args.stats_module, worker_timings, append=True)
+    return total
+
+def aggregate(args):
+    import importlib
+    import statsrunner.incremental
+    stats_module = importlib.import_module(args.stats_module)
+
+    make_output_dirs(args)
+    statsrunner.incremental.start_aggregate(stats_module, args)
+
+    blank = make_blank(stats_module, args.enabled_stats)
+
+    publishers = list_publishers(args)
+    if args.multi > 1:
+        total = aggregate_parallel(blank, publishers, args)
+    else:
+        total = copy_stat(blank)
+        for folder, size in publishers:
+            publisher_total = aggregate_folder(stats_module, blank, folder, args)
+            add_publisher_total(total, statsrunner.incremental.total_part(publisher_total, folder, args))
+    folders = [ folder for folder, size in publishers ]
+    statsrunner.incremental.update_total(blank, total, folders, args)
+    statsrunner.incremental.write_all_total(total, args)
+
+    aggregate_all(stats_module, total, args)
+    statsrunner.incremental.finish_aggregate(folders, args)
+    if args.stat_timings:
+        statsrunner.timings.write(args.output, args.stats_module, {str(os.getpid()): statsrunner.timings.collect()}, append=True)
+
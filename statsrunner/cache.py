@@ -0,0 +1,247 @@
+"""
+A content addressed cache of the per file aggregated stats produced by loop.
+
+Most files in the data directory don't change from one commit to the next, so
+rather than parsing them again, loop can reuse the output from an earlier run.
+Entries are keyed by the git blob SHA of the XML file and its path in the data
+directory (as some file stats use the filename), and are stored under a
+fingerprint of the stats module (its source, stats.common, and any helper data
+it lists in ``cache_dependencies``), so changing a stat invalidates the cache.
+Results for --stats and --strict are kept apart from the rest.
+
+Some stats depend on the date (``--today``, or the system clock). These are
+found by looking at the names each stat's code uses (see
+date_dependent_stats), and are cached in a separate entry that is also keyed
+by the date, so for a new date only they need to be recalculated. A stats class
+can list any others in ``date_dependent_stats``.
+
+Recalculating them still means parsing the file, so the cache only saves
+parsing a file for a date it has already been processed for, or for stats
+modules without date dependent stats. git.sh runs each commit with the
+commit's date as --today, so with stats.dashboard (whose activity stats include
+date dependent ones) every file is still parsed for each commit, apart from
+commits made on the same day. What is saved there is calculating the other
+stats.
+
+"""
+from collections import OrderedDict
+import datetime
+import decimal
+import dis
+import hashlib
+import inspect
+import json
+import os
+import types
+
+from statsrunner.aggregate import decimal_default
+
+_fingerprints = {}
+_date_dependent = {}
+
+
+def blob_sha(path):
+    """ Return the SHA1 git would use for the contents of the file at path. """
+    sha = hashlib.sha1('blob {0}\0'.format(os.stat(path).st_size))
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024*1024), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _hash_path(sha, path):
+    if os.path.isdir(path):
+        for dirname, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != '.git')
+            for f in sorted(files):
+                _hash_path(sha, os.path.join(dirname, f))
+    elif os.path.isfile(path):
+        sha.update(path)
+        with open(path, 'rb') as fp:
+            sha.update(fp.read())
+    else:
+        sha.update(path+' missing')
+
+
+def module_fingerprint(stats_module):
+    """ Return a hash of the code and helper data that the stats module's output depends on. """
+    if stats_module.__name__ not in _fingerprints:
+        sha = hashlib.sha1()
+        common_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stats', 'common')
+        for path in [inspect.getsourcefile(stats_module), common_dir] + list(getattr(stats_module, 'cache_dependencies', [])):
+            _hash_path(sha, path)
+        _fingerprints[stats_module.__name__] = sha.hexdigest()
+    return _fingerprints[stats_module.__name__]
+
+
+# Attributes that give the date: self.today (--today), self.now, datetime.date.today() and datetime.datetime.now()
+DATE_ATTRIBUTES = frozenset(['today', 'now'])
+
+
+def _functions(obj):
+    if isinstance(obj, (staticmethod, classmethod)):
+        obj = obj.__func__
+    elif isinstance(obj, property):
+        obj = obj.fget
+    return [obj] if isinstance(obj, types.FunctionType) else []
+
+
+def _code_names(func):
+    """
+    Return the names a function's code (including its lambdas and generator
+    expressions) may use: the global and attribute names, and the string
+    constants, which may be attribute names passed to getattr. Also returns the
+    attribute names it assigns to.
+
+    """
+    names, stored = set(), set()
+    codes = [func.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                codes.append(const)
+            elif isinstance(const, str):
+                names.add(const)
+        i, extended = 0, 0
+        while i < len(code.co_code):
+            op = ord(code.co_code[i])
+            if op < dis.HAVE_ARGUMENT:
+                i += 1
+                continue
+            arg = ord(code.co_code[i+1]) + ord(code.co_code[i+2])*256 + extended
+            extended = arg*65536 if op == dis.EXTENDED_ARG else 0
+            if op == dis.opmap['STORE_ATTR']:
+                stored.add(code.co_names[arg])
+            i += 3
+    return names, stored
+
+
+def detect_date_dependent_stats(stats_class):
+    """
+    Return the names of the methods of stats_class that may use the date.
+
+    A method uses the date if its code uses one of DATE_ATTRIBUTES, or calls a
+    method or function that does (the functions wrapped by decorators, the
+    methods named by self.<name> or a string, and the module's functions named
+    by their global name). A class attribute that such a method assigns to,
+    such as comprehensiveness_current_activity_status in stats.dashboard, is
+    then counted as using the date too.
+
+    """
+    attributes = {}
+    for cls in reversed(inspect.getmro(stats_class)):
+        attributes.update(cls.__dict__)
+    methods = dict((name, _functions(value)[0]) for name, value in attributes.items() if _functions(value))
+    state = set(attributes).difference(methods)
+
+    calls = {}
+    todo = list(methods.values())
+    while todo:
+        func = todo.pop()
+        if func not in calls:
+            names, stored = _code_names(func)
+            callees = [ f for cell in func.__closure__ or () for f in _functions(cell.cell_contents) ]
+            callees += [ methods[name] for name in names if name in methods ]
+            callees += [ f for name in names for f in _functions(func.__globals__.get(name)) ]
+            calls[func] = names, stored.intersection(state), callees
+            todo.extend(callees)
+
+    dated, dated_state = set(), set()
+    changed = True
+    while changed:
+        changed = False
+        for func, (names, stored, callees) in calls.items():
+            if func not in dated and (names & (DATE_ATTRIBUTES | dated_state) or any(f in dated for f in callees)):
+                dated.add(func)
+                dated_state.update(stored)
+                changed = True
+    return set(name for name, func in methods.items() if func in dated)
+
+
+def date_dependent_stats(stats_classes, names):
+    """
+    Return the subset of the stat names that depend on the date, for a file
+    whose stats were calculated using the given classes: those found by
+    detect_date_dependent_stats, and any the classes list in
+    date_dependent_stats.
+
+    """
+    out = set()
+    for stats_class in stats_classes:
+        if stats_class not in _date_dependent:
+            _date_dependent[stats_class] = detect_date_dependent_stats(stats_class).union(
+                getattr(stats_class, 'date_dependent_stats', []))
+        out.update(_date_dependent[stats_class])
+    return out.intersection(names)
+
+
+class StatsCache(object):
+    def __init__(self, cache_dir, stats_module, today, enabled_stats=None, strict=False):
+        self.cache_dir = os.path.join(cache_dir, module_fingerprint(stats_module))
+        if enabled_stats is not None:
+            # Results for a subset of the stats (--stats) are kept apart from complete ones
+            self.cache_dir += '-' + hashlib.sha1(','.join(sorted(enabled_stats))).hexdigest()
+        if strict:
+            # Some stats give different results with --strict
+            self.cache_dir += '-strict'
+        # The system clock is included as well as --today, as some stats use it directly
+        self.date_key = '{0}-{1}'.format(today.isoformat(), datetime.date.today().isoformat())
+
+    def _path(self, sha, name, dated):
+        key = hashlib.sha1(sha + '/' + name).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ('-' + self.date_key if dated else '') + '.json')
+
+    def _read(self, path):
+        try:
+            with open(path) as fp:
+                # Keep the order of the keys, as for statsrunner.incremental.read_previous
+                return json.load(fp, parse_float=decimal.Decimal, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        # Other processes may be writing the same entry, e.g. for another commit
+        new_path = '{0}.new{1}'.format(path, os.getpid())
+        with open(new_path, 'w') as fp:
+            json.dump(data, fp, sort_keys=True, default=decimal_default)
+        os.rename(new_path, path)
+
+    def get(self, sha, name):
+        """
+        Look up the aggregated stats for the file with the given blob SHA and
+        name (its path relative to the data directory).
+
+        Returns a tuple (subtotal, missing), or (None, None) if the file is not
+        in the cache. missing is a list of date dependent stats that need to be
+        recalculated, and merged into subtotal.
+
+        """
+        entry = self._read(self._path(sha, name, False))
+        if entry is None:
+            return None, None
+        subtotal = entry['stats']
+        if entry['date_dependent']:
+            dated = self._read(self._path(sha, name, True))
+            if dated is None:
+                return subtotal, entry['date_dependent']
+            subtotal.update(dated)
+        return subtotal, []
+
+    def put(self, sha, name, subtotal, dated_names):
+        """ Store the aggregated stats for a file, splitting out the date dependent stats. """
+        dated_names = set(dated_names)
+        self._write(self._path(sha, name, False), {
+            'stats': dict((k, v) for k, v in subtotal.items() if k not in dated_names),
+            'date_dependent': sorted(dated_names)
+        })
+        if dated_names:
+            self.put_dated(sha, name, subtotal, dated_names)
+
+    def put_dated(self, sha, name, subtotal, dated_names):
+        self._write(self._path(sha, name, True), dict((k, v) for k, v in subtotal.items() if k in dated_names))
@@ -4,7 +4,8 @@ import os
 import sys
 
 from collections import defaultdict
-from common import decimal_default
+import packed
+import timeseries
 
 GITOUT_DIR = os.environ.get('GITOUT_DIR') or 'gitout'
 
@@ -32,52 +33,97 @@ whitelisted_stats_files = [
 
 # Set bool if the 'dated' argument has been used in calling this script
 dated = len(sys.argv) > 1 and sys.argv[1] == 'dated'
+# With the 'both' argument, the dated and undated output are done in the same pass
+variants = [False, True] if 'both' in sys.argv[1:] else [dated]
+# Set bool if the 'export' argument has been used, to write the output JSON from the store
+export = 'export' in sys.argv[1:]
+
+def out_name(dated):
+    return 'gitaggregate-publisher-dated' if dated else 'gitaggregate-publisher'
 
 # Load the reference of commits to dates 
-if dated:
+if True in variants:
     gitdates = json.load(open('gitdate.json'))
 
+# The values for each commit are appended to a store, with a file for each
+# publisher, see timeseries.py
+stores = {}
+for dated in variants:
+    stores[dated] = timeseries.store_dir(GITOUT_DIR, out_name(dated))
+
+# The records to append to each publisher's store file, for all of the new
+# commits, so that each file is only written once
+new_records = defaultdict(list)
+new_commits = defaultdict(list)
+
 # Loop over folders in the 'commits' directory
 # Variable commit will be the commit hash
 for commit in os.listdir(os.path.join(GITOUT_DIR, 'commits')):
+    # Skip commits that are already in the store, and leave commits without a
+    # date until there is one in gitdate.json
+    commit_variants = [ dated for dated in variants
+        if not timeseries.is_added(stores[dated], commit) and (not dated or commit in gitdates) ]
+    if not commit_variants:
+        print "gitaggregate-publisher already done for commit {}".format(commit)
+        continue
     print "gitaggregate-publisher for commit {}".format(commit)
     
-    for publisher in os.listdir(os.path.join(GITOUT_DIR, 'commits', commit, 'aggregated-publisher')):
+    # Read the stats for this commit from aggregated-publisher.records if it was written with --packed
+    records_fname = os.path.join(GITOUT_DIR, 'commits', commit, packed.PUBLISHER_RECORDS)
+    if os.path.isfile(records_fname):
+        commit_stats = defaultdict(dict)
+        for publisher, k, v in packed.read(records_fname, whitelisted_stats_files):
+            commit_stats[publisher][k] = v
+        publishers = commit_stats.keys()
+    else:
+        commit_stats = None
+        publishers = os.listdir(os.path.join(GITOUT_DIR, 'commits', commit, 'aggregated-publisher'))
+
+    for publisher in publishers:
         print "Currently looping over publisher {}".format(publisher)
         
-        # Set output directory for this publisher and attempt to make the directory. Pass if it already exists
-        git_out_dir = os.path.join(GITOUT_DIR,'gitaggregate-publisher-dated' if dated else 'gitaggregate-publisher', publisher)
-        try:
-            os.makedirs(git_out_dir)
-        except OSError:
-            pass
-        
-        # Set an output dictionary for this publisher
-        total = defaultdict(dict)
-        
-        if os.path.isdir(git_out_dir):
-            # Loop over the existing files in the output directory for this publisher and load them into the 'total' dictionary
-            for fname in os.listdir(git_out_dir):
-                if fname.endswith('.json'):
-                    with open(os.path.join(git_out_dir, fname)) as fp:
-                        total[fname[:-5]] = json.load(fp, parse_float=decimal.Decimal)
+        # Get the current values of the whitelisted stats files
+        if commit_stats is not None:
+            stats = commit_stats[publisher]
+        else:
+            stats = {}
+            for statname in whitelisted_stats_files:
+                path = os.path.join(GITOUT_DIR, 'commits', commit, 'aggregated-publisher', publisher, statname+'.json')
+                if os.path.isfile(path):
+                    with open(path) as fp:
+                        stats[statname] = json.load(fp, parse_float=decimal.Decimal)
+
+        for dated in commit_variants:
+            new_records[(dated, publisher)].append((gitdates[commit] if dated else commit, stats))
+
+    for dated in commit_variants:
+        new_commits[dated].append(commit)
+
+for (dated, publisher), records in new_records.items():
+    # The store for each publisher starts with any existing output written
+    # before the store was used
+    git_out_dir = os.path.join(GITOUT_DIR, out_name(dated), publisher)
+    store_fname = os.path.join(stores[dated], publisher+packed.EXTENSION)
+    if not os.path.exists(store_fname) and os.path.isdir(git_out_dir):
+        timeseries.seed(store_fname, git_out_dir, [ fname[:-5] for fname in os.listdir(git_out_dir) if fname.endswith('.json') ])
+    timeseries.append(store_fname, records)
 
-        # Loop over the whitelisted states files and add current values to the 'total' dictionary
-        for statname in whitelisted_stats_files:
-            path = os.path.join(GITOUT_DIR, 'commits', commit, 'aggregated-publisher', publisher, statname+'.json')
-            if os.path.isfile(path):
-                with open(path) as fp:
-                    k = statname
-                    if not commit in total[k]:
-                        v = json.load(fp, parse_float=decimal.Decimal)
-                        if dated:
-                            if commit in gitdates:
-                                total[k][gitdates[commit]] = v
-                        else:
-                            total[k][commit] = v
+for dated, commits in new_commits.items():
+    for commit in commits:
+        timeseries.mark_added(stores[dated], commit)
 
-        # Write data from the 'total' dictionary to a temporary file, then rename
-        for k,v in total.items():
-            with open(os.path.join(git_out_dir, k+'.json.new'), 'w') as fp:
-                json.dump(v, fp, sort_keys=True, indent=2, default=decimal_default)
-            os.rename(os.path.join(git_out_dir, k+'.json.new'), os.path.join(git_out_dir, k+'.json'))
+# Write the output for every publisher from the store
+if export:
+    for dated in variants:
+        store = stores[dated]
+        for fname in os.listdir(store) if os.path.isdir(store) else []:
+            if not fname.endswith(packed.EXTENSION):
+                continue
+            publisher = fname[:-len(packed.EXTENSION)]
+            git_out_dir = os.path.join(GITOUT_DIR, out_name(dated), publisher)
+            try:
+                os.makedirs(git_out_dir)
+            except OSError:
+                pass
+            for k, v in timeseries.read(os.path.join(store, fname)).items():
+                timeseries.write_json(os.path.join(git_out_dir, k+'.json'), v)
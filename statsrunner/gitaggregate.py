@@ -1,5 +1,6 @@
 from collections import defaultdict
-from common import decimal_default
+import packed
+import timeseries
 import decimal
 import json
 import os 
@@ -10,8 +11,13 @@ GITOUT_DIR = os.environ.get('GITOUT_DIR') or 'gitout'
 
 # Set bool if the 'dated' argument has been used in calling this script
 dated = len(sys.argv) > 1 and sys.argv[1] == 'dated'
+# With the 'both' argument, the dated and undated output are done in the same pass
+variants = [False, True] if 'both' in sys.argv[1:] else [dated]
+# Set bool if the 'export' argument has been used, to write the output JSON from the store
+export = 'export' in sys.argv[1:]
 
-git_out_dir = os.path.join(GITOUT_DIR, 'gitaggregate-dated' if dated else 'gitaggregate')
+def out_name(dated):
+    return 'gitaggregate-dated' if dated else 'gitaggregate'
 
 # Exclude some json stats files from being aggregated
 # These are typically the largest stats files that would consume large amounts of 
@@ -35,57 +41,73 @@ whitelisted_stats_files = [
     ]
 
 # Load the reference of commits to dates 
-if dated:
+if True in variants:
     gitdates = json.load(open('gitdate.json'))
 
-# Make the gitout directory
-try:
-    os.makedirs(git_out_dir)
-except OSError:
-    pass
+# Make the gitout directories
+for dated in variants:
+    try:
+        os.makedirs(os.path.join(GITOUT_DIR, out_name(dated)))
+    except OSError:
+        pass
 
-# Get a list containing the names of the entries in the directory
-git_out_files = os.listdir(git_out_dir)
+# The values for each commit are appended to a store, see timeseries.py
+stores = {}
+for dated in variants:
+    stores[dated] = timeseries.store_dir(GITOUT_DIR, out_name(dated))
+
+# The records to append to each store file, for all of the new commits, so
+# that each file is only written once
+new_records = defaultdict(list)
+new_commits = defaultdict(list)
 
 # Loop over each commit in gitout/commits
 for commit in os.listdir(os.path.join(GITOUT_DIR, 'commits')):
+    # Skip commits that are already in the store, and leave commits without a
+    # date until there is one in gitdate.json
+    commit_variants = [ dated for dated in variants
+        if not timeseries.is_added(stores[dated], commit) and (not dated or commit in gitdates) ]
+    if not commit_variants:
+        print 'Already aggregated commit: {}'.format(commit)
+        continue
     print 'Aggregating for commit: {}'.format(commit)
 
-    for fname in os.listdir(os.path.join(GITOUT_DIR, 'commits', commit, 'aggregated')):
-        if not fname.endswith('.json'):
-            continue
-        
-        k = fname[:-5] # remove '.json' from the filename
-        # Ignore certain files
-        if k not in whitelisted_stats_files:
-           continue
+    # Read the stats for this commit from aggregated.records if it was written with --packed
+    records_fname = os.path.join(GITOUT_DIR, 'commits', commit, packed.ALL_RECORDS)
+    if os.path.isfile(records_fname):
+        commit_stats = dict((k, v) for name, k, v in packed.read(records_fname, whitelisted_stats_files))
+    else:
+        commit_stats = {}
+        for fname in os.listdir(os.path.join(GITOUT_DIR, 'commits', commit, 'aggregated')):
+            # Ignore certain files
+            if not fname.endswith('.json') or fname[:-5] not in whitelisted_stats_files:
+                continue
+            with open(os.path.join(GITOUT_DIR, 'commits', commit, 'aggregated', fname)) as fp:
+                commit_stats[fname[:-5]] = json.load(fp, parse_float=decimal.Decimal)
+
+    for dated in commit_variants:
+        for k, v in commit_stats.items():
+            new_records[(dated, k)].append((gitdates[commit] if dated else commit, {k: v}))
+        new_commits[dated].append(commit)
+
+for (dated, k), records in new_records.items():
+    print 'Adding to {} for file: {}'.format(out_name(dated), k+'.json')
+    # The store for each stat starts with any existing output written before
+    # the store was used
+    store_fname = os.path.join(stores[dated], k+packed.EXTENSION)
+    timeseries.seed(store_fname, os.path.join(GITOUT_DIR, out_name(dated)), [k])
+    timeseries.append(store_fname, records)
 
-        print 'Adding to {} for file: {}'.format('gitaggregate-dated' if dated else 'gitaggregate', fname)
-        
-        commit_json_fname = os.path.join(GITOUT_DIR, 'commits', commit, 'aggregated', fname)
-        
-        # Load the current file conents to memory, or set as an empty dictionary
-        if fname in git_out_files:
-            # FIXME: This is a possible cause of a memory issue in future, as the size of the aggregate file 
-            #        increases each time there is a new commit
-            with open(os.path.join(git_out_dir, fname)) as fp:
-                v = json.load(fp, parse_float=decimal.Decimal)
-        else:
-            v = {}
-        
-        # If the commit that we are looping over is not already in the data for this file, then add it to the output
-        if not commit in v:
-            with open(commit_json_fname) as fp2:
-                v2 = json.load(fp2, parse_float=decimal.Decimal)
-                if dated:
-                    if commit in gitdates:
-                        v[gitdates[commit]] = v2
-                else:
-                    v[commit] = v2
+for dated, commits in new_commits.items():
+    for commit in commits:
+        timeseries.mark_added(stores[dated], commit)
 
-            # Write output to a temporary file, then rename
-            with open(os.path.join(git_out_dir, k+'.json.new'), 'w') as fp:
-                print 'Writing data to {}'.format(k)
-                json.dump(v, fp, sort_keys=True, indent=2, default=decimal_default)
-            print 'Renaming file {} to {}'.format(k+'.json.new', k+'.json')
-            os.rename(os.path.join(git_out_dir, k+'.json.new'), os.path.join(git_out_dir, k+'.json'))
+# Write the output for every stat from the store
+if export:
+    for dated in variants:
+        store = stores[dated]
+        for fname in os.listdir(store) if os.path.isdir(store) else []:
+            if fname.endswith(packed.EXTENSION):
+                for k, v in timeseries.read(os.path.join(store, fname)).items():
+                    print 'Writing data to {}'.format(k)
+                    timeseries.write_json(os.path.join(GITOUT_DIR, out_name(dated), k+'.json'), v)
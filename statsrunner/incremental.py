@@ -0,0 +1,473 @@
+"""
+Incremental runs, which reuse the per file stats of a previous run for the
+files that haven't changed since.
+
+When loop or run are given --keep-incremental, and write aggregated-file for
+the whole data directory, they also write incremental.json, recording the git commit the data directory was at,
+a fingerprint of the stats module (see statsrunner.cache), and the options that
+change the stats (--stats and --strict). A later run
+given that output directory with --previous-output asks git which files have
+changed since that commit, and for the rest uses their stats from the previous
+aggregated-file (directories or --packed records) rather than parsing them
+again. Only files that are in the data directory now are processed, so deleted
+and renamed files, and removed publishers, drop out of the output as usual.
+
+As with statsrunner.cache, stats that depend on the date are recalculated,
+which means parsing the file, unless the previous run was for the same date
+(both --today and the system clock, recorded in incremental.json). git.sh runs
+each commit with the commit's date as --today, so with stats.dashboard (whose
+activity stats include date dependent ones) an incremental run there only
+avoids parsing the files of commits made on the same day as the previous one.
+For other commits it saves calculating the stats that don't depend on the date,
+and summing the publisher totals (below).
+
+The publisher totals are reused in the same way. With --keep-incremental, run
+and aggregate keep the
+exact totals of the per file stats that don't depend on the date, for each
+publisher in incremental-publisher/<publisher>.pickle and for all the data in
+incremental-all.pickle (the JSON output has the decimals rounded). For a
+publisher with none of its files changed, these are taken from the previous
+run, rather than summed from every file again. The publisher stats are still
+recalculated, as they use --today. The total for all the data of those stats
+that are sums of numbers is then updated from the previous run's, by
+subtracting the previous totals of the publishers that have changed and adding
+their new ones. Where the result might differ from summing every publisher (see
+subtract), and for the other stats, the total is summed in full. loop records
+the previous output and changed publishers in incremental.json, for aggregate
+to use.
+
+"""
+from collections import defaultdict, OrderedDict
+import cPickle
+import datetime
+import decimal
+import inspect
+import json
+import os
+import shutil
+import subprocess
+
+import statsrunner.aggregate
+import statsrunner.cache
+import statsrunner.packed
+import statsrunner.shared
+
+INFO_FILE = 'incremental.json'
+PUBLISHER_TOTALS = 'incremental-publisher'
+ALL_TOTAL = 'incremental-all.pickle'
+
+# Offsets of each file's records in the --packed record files of previous runs, by path
+_record_offsets = {}
+
+
+def data_commit(data_dir):
+    """ Return the commit that data_dir is checked out at, or None if it isn't a git repository. """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=data_dir, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def changed_files(data_dir, commit, to=None):
+    """
+    Return the set of paths, relative to data_dir, that differ from the given
+    commit, including untracked files, or that differ between commit and to
+    if it's given (for --commit). Renamed files are listed under both their
+    old and new paths. Returns None if git can't tell.
+
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            diff = subprocess.check_output(['git', 'diff', '--name-only', '--no-renames', '--relative', '-z', commit] + ([to] if to else []) + ['--'],
+                                           cwd=data_dir, stderr=devnull)
+            if to:
+                untracked = ''
+            else:
+                untracked = subprocess.check_output(['git', 'ls-files', '--others', '-z'], cwd=data_dir, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return frozenset(path for path in (diff + untracked).split('\0') if path)
+
+
+def run_info(stats_module, args):
+    return {
+        'commit': args.commit or data_commit(args.data),
+        'fingerprint': statsrunner.cache.module_fingerprint(stats_module),
+        'enabled_stats': sorted(args.enabled_stats) if args.enabled_stats is not None else None,
+        'strict': args.strict,
+        # As in statsrunner.cache, the system clock as well as --today
+        'today': args.today.isoformat(),
+        'system_date': datetime.date.today().isoformat(),
+    }
+
+
+def start(stats_module, args):
+    """
+    Prepare for a run, before any files are processed. Removes the output's
+    incremental.json, as its aggregated-file is about to change, and if
+    args.previous_output is given, sets args.changed_files to the files that
+    have changed since the previous run (or to None if its output can't be
+    reused). For run, also prepares to keep and reuse the publisher totals.
+
+    """
+    statsrunner.packed.remove(os.path.join(args.output, INFO_FILE))
+    args.changed_files = None
+    args.same_date = False
+    no_reuse(args)
+    if args.fused and args.keep_incremental and args.aggregated_file and not args.verbose_loop and not args.folder:
+        keep_totals(stats_module, args)
+    if not args.previous_output:
+        return
+    try:
+        with open(os.path.join(args.previous_output, INFO_FILE)) as fp:
+            previous_info = json.load(fp)
+    except (IOError, ValueError):
+        print 'No {0} in {1}, so all files will be processed'.format(INFO_FILE, args.previous_output)
+        return
+    info = run_info(stats_module, args)
+    if any(previous_info.get(key) != info[key] for key in ['fingerprint', 'enabled_stats', 'strict']):
+        print 'The stats have changed since {0} was written, so all files will be processed'.format(args.previous_output)
+        return
+    if previous_info['commit'] is None or info['commit'] is None:
+        print 'The data directory is not a git repository, so all files will be processed'
+        return
+    args.changed_files = changed_files(args.data, previous_info['commit'], args.commit)
+    args.same_date = all(previous_info.get(key) == info[key] for key in ['today', 'system_date'])
+    if args.changed_files is None:
+        print 'Could not find the changes since commit {0}, so all files will be processed'.format(previous_info['commit'])
+    else:
+        print '{0} files have changed since commit {1}'.format(len(args.changed_files), previous_info['commit'])
+        if args.reused_stats:
+            reuse_publishers(stats_module, args, changed_publishers(args.changed_files))
+
+
+def finish(stats_module, args):
+    """
+    Write incremental.json once a run with --keep-incremental has written
+    aggregated-file for every file in the data directory.
+
+    """
+    if args.keep_incremental and args.aggregated_file and not args.verbose_loop and not args.folder and not args.new:
+        info = run_info(stats_module, args)
+        if args.changed_files is not None:
+            info['previous_output'] = args.previous_output
+            info['changed_publishers'] = sorted(changed_publishers(args.changed_files))
+        with open(os.path.join(args.output, INFO_FILE), 'w') as fp:
+            json.dump(info, fp, sort_keys=True, indent=2)
+
+
+def start_aggregate(stats_module, args):
+    """
+    Prepare for aggregate to keep the publisher totals, if loop processed
+    every file, and to reuse those of the previous run that loop reused the
+    per file stats of, as recorded in incremental.json.
+
+    """
+    args.previous_output = None
+    no_reuse(args)
+    if args.verbose_loop:
+        return
+    try:
+        with open(os.path.join(args.output, INFO_FILE)) as fp:
+            info = json.load(fp)
+    except (IOError, ValueError):
+        return
+    enabled_stats = sorted(args.enabled_stats) if args.enabled_stats is not None else None
+    if (info['fingerprint'] != statsrunner.cache.module_fingerprint(stats_module) or info['enabled_stats'] != enabled_stats or
+            info.get('strict') != args.strict):
+        return
+    keep_totals(stats_module, args)
+    if 'previous_output' in info and args.reused_stats:
+        args.previous_output = info['previous_output']
+        reuse_publishers(stats_module, args, info['changed_publishers'])
+
+
+def finish_aggregate(folders, args):
+    """
+    Record the publishers that aggregate or run summed in incremental.json,
+    once their totals have been kept, so that a later run can reuse them.
+
+    """
+    path = os.path.join(args.output, INFO_FILE)
+    if not args.reused_stats or not os.path.isfile(path):
+        return
+    with open(path) as fp:
+        info = json.load(fp)
+    info['publishers'] = sorted(folders)
+    with open(path, 'w') as fp:
+        json.dump(info, fp, sort_keys=True, indent=2)
+
+
+def changed_publishers(changed_files):
+    return set(path.split('/', 1)[0] for path in changed_files)
+
+
+def no_reuse(args):
+    args.reused_publishers = frozenset()
+    args.reused_stats = frozenset()
+    args.delta_stats = frozenset()
+
+
+def keep_totals(stats_module, args):
+    """
+    Set args.reused_stats to the stats whose exact publisher and all data
+    totals are kept: the per file stats that don't depend on the date. Any
+    totals kept by an earlier run to the same output are removed.
+
+    """
+    file_classes = [stats_module.ActivityStats, stats_module.ActivityFileStats,
+                    stats_module.OrganisationStats, stats_module.OrganisationFileStats]
+    blank = statsrunner.aggregate.blank_template(stats_module, args.enabled_stats)
+    # Publisher and all data stats are calculated afresh, and replace any file stat of the same name
+    calculated = set()
+    for stats_class in [stats_module.PublisherStats, stats_module.AllDataStats]:
+        for name, function in inspect.getmembers(stats_class, predicate=inspect.ismethod):
+            if statsrunner.shared.use_stat(stats_class, name):
+                calculated.add(name)
+    args.reused_stats = frozenset(set(blank).difference(calculated, statsrunner.cache.date_dependent_stats(file_classes, blank.keys())))
+    shutil.rmtree(os.path.join(args.output, PUBLISHER_TOTALS), ignore_errors=True)
+    statsrunner.packed.remove(os.path.join(args.output, ALL_TOTAL))
+    if args.reused_stats:
+        os.makedirs(os.path.join(args.output, PUBLISHER_TOTALS))
+
+
+def reuse_publishers(stats_module, args, changed):
+    """
+    Set args.reused_publishers to the publishers of the previous run that have
+    no changed files, and args.delta_stats to the reused stats whose total for
+    all the data is updated from the previous run's.
+
+    """
+    args.reused_publishers = previous_publishers(args.previous_output).difference(changed)
+    if os.path.isfile(os.path.join(args.previous_output, ALL_TOTAL)):
+        blank = statsrunner.aggregate.blank_template(stats_module, args.enabled_stats)
+        args.delta_stats = frozenset(name for name in args.reused_stats if summable(blank[name]))
+    print 'Reusing the totals of {0} publishers for {1} stats'.format(len(args.reused_publishers), len(args.reused_stats))
+
+
+def summable(blank):
+    """ Whether a stat with this blank value is summed as numbers, or dictionaries of them. """
+    return type(blank) in (int, long, decimal.Decimal) or (type(blank) in (dict, defaultdict) and not blank)
+
+
+def previous_publishers(output_dir):
+    """
+    Return the set of publishers whose totals were kept in output_dir, as
+    recorded by finish_aggregate.
+
+    """
+    try:
+        with open(os.path.join(output_dir, INFO_FILE)) as fp:
+            return frozenset(json.load(fp).get('publishers', []))
+    except (IOError, ValueError):
+        return frozenset()
+
+
+def _write_totals(path, stats, names):
+    out = {}
+    for name in names:
+        if name in stats:
+            value = statsrunner.aggregate.plain_stat(stats[name])
+            if hasattr(value, 'value'):
+                # The largest date of a returns_date stat
+                value = value.value
+            out[name] = value
+    with open(path, 'wb') as fp:
+        cPickle.dump(out, fp, cPickle.HIGHEST_PROTOCOL)
+
+
+def _read_totals(path, names):
+    with open(path, 'rb') as fp:
+        stats = cPickle.load(fp)
+    return dict((k, v) for k, v in stats.iteritems() if k in names)
+
+
+def write_publisher_total(publisher_total, folder, args):
+    if args.reused_stats:
+        _write_totals(os.path.join(args.output, PUBLISHER_TOTALS, folder + '.pickle'), publisher_total, args.reused_stats)
+
+
+def read_publisher_total(output_dir, folder, names):
+    return _read_totals(os.path.join(output_dir, PUBLISHER_TOTALS, folder + '.pickle'), names)
+
+
+def write_all_total(total, args):
+    if args.reused_stats:
+        _write_totals(os.path.join(args.output, ALL_TOTAL), total, args.reused_stats)
+
+
+def _offsets(path):
+    if path not in _record_offsets:
+        offsets = {}
+        offset = 0
+        with open(path) as fp:
+            for line in iter(fp.readline, ''):
+                name = line.split('\t', 1)[0]
+                if name not in offsets:
+                    offsets[name] = offset
+                offset += len(line)
+        _record_offsets[path] = offsets
+    return _record_offsets[path]
+
+
+def read_previous(output_dir, folder, xmlfile):
+    """
+    Return the stats in output_dir's aggregated-file for a file, or None if
+    there are none. Dictionaries keep the order their keys were written in, so
+    that they are written out again exactly as a full run would write them
+    (e.g. with a None key before integer ones, which as JSON strings would sort
+    the other way).
+
+    """
+    records_path = statsrunner.packed.file_records_path(output_dir, folder)
+    if os.path.isfile(records_path):
+        offsets = _offsets(records_path)
+        if xmlfile not in offsets:
+            return None
+        out = {}
+        with open(records_path) as fp:
+            fp.seek(offsets[xmlfile])
+            for line in iter(fp.readline, ''):
+                name, stat, value = line.rstrip('\n').split('\t', 2)
+                if name != xmlfile:
+                    break
+                out[stat] = json.loads(value, parse_float=decimal.Decimal, object_pairs_hook=OrderedDict)
+        return out
+
+    file_dir = os.path.join(output_dir, 'aggregated-file', folder, xmlfile)
+    if not os.path.isdir(file_dir):
+        return None
+    out = {}
+    for fname in os.listdir(file_dir):
+        if fname.endswith('.json'):
+            with open(os.path.join(file_dir, fname)) as fp:
+                out[fname[:-5]] = json.load(fp, parse_float=decimal.Decimal, object_pairs_hook=OrderedDict)
+    return out
+
+
+def previous_stats(stats_module, folder, xmlfile, args):
+    """
+    Look up a file's stats from the previous run, if it hasn't changed since.
+
+    Returns a tuple (subtotal, missing) like StatsCache.get, or (None, None) if
+    the file has to be processed in full. missing is a list of date dependent
+    stats that need to be recalculated, which is empty if the previous run was
+    for the same date.
+
+    """
+    if args.changed_files is None or os.path.join(folder, xmlfile) in args.changed_files:
+        return None, None
+    subtotal = read_previous(args.previous_output, folder, xmlfile)
+    if subtotal is None:
+        return None, None
+    if args.same_date:
+        return subtotal, []
+    stats_classes = [stats_module.ActivityStats, stats_module.ActivityFileStats,
+                     stats_module.OrganisationStats, stats_module.OrganisationFileStats]
+    missing = statsrunner.cache.date_dependent_stats(stats_classes, subtotal.keys())
+    return dict((k, v) for k, v in subtotal.items() if k not in missing), sorted(missing)
+
+
+def publisher_blank(blank, folder, args):
+    """
+    Return the start of a publisher's total: a copy of blank, with the reused
+    stats filled in from the previous run if the publisher has no changed
+    files. Its files' values for those stats are then left out of the total.
+
+    """
+    publisher_total = statsrunner.aggregate.copy_stat(blank)
+    if folder in args.reused_publishers:
+        statsrunner.aggregate.dict_sum_inplace(publisher_total, read_publisher_total(args.previous_output, folder, args.reused_stats))
+    return publisher_total
+
+
+def total_part(publisher_total, folder, args):
+    """
+    Return the part of a publisher's total to add to the total for all the
+    data. The delta stats of reused publishers are already in the previous
+    total, so are left out (see update_total).
+
+    """
+    if folder not in args.reused_publishers:
+        return publisher_total
+    return dict((k, v) for k, v in publisher_total.iteritems() if k not in args.delta_stats)
+
+
+def subtract(current, old, added):
+    """
+    Return current - old, where current is a sum of stats that includes old,
+    and added is what is going to be added to the result. Dictionaries are
+    changed in place.
+
+    The result has to be what summing the other stats would give, so a
+    ValueError is raised if it might not be: if a key might only have been in
+    old, and isn't in added, or if a decimal's number of places might have
+    come from old, rather than from the others or added (the sum of decimals
+    has as many places as the most precise of them, and a sum of integers
+    stays an integer), or for values other than numbers.
+
+    """
+    old_type = type(old)
+    current_type = type(current)
+    if old_type is dict:
+        if current_type not in (dict, defaultdict):
+            raise ValueError('Can not subtract a dictionary from {0!r}'.format(current))
+        added_type = type(added)
+        for k, v in old.iteritems():
+            if k not in current:
+                raise ValueError('{0!r} is not in the total'.format(k))
+            added_value = added.get(k) if added_type in (dict, defaultdict) else None
+            result = subtract(current[k], v, added_value)
+            if added_value is None and (v == {} or (type(result) in (int, long) and result == 0)):
+                # The key might not be in any other publisher's stats
+                raise ValueError('{0!r} might be removed from the total'.format(k))
+            current[k] = result
+        return current
+    elif old_type in (int, long) and current_type in (int, long):
+        return current - old
+    elif (current_type is decimal.Decimal and current.is_finite() and
+          (old_type in (int, long) or (old_type is decimal.Decimal and old.is_finite()))):
+        places = current.as_tuple().exponent
+        old_places = old.as_tuple().exponent if old_type is decimal.Decimal else 0
+        if type(added) is decimal.Decimal and added.is_finite() and added.as_tuple().exponent <= places:
+            # The result will have added's places anyway
+            return current - old
+        if places >= 0 or old_places <= places:
+            raise ValueError('The places of {0} might come from {1}'.format(current, old))
+        return current - old
+    raise ValueError('Can not subtract {0!r} from {1!r}'.format(old, current))
+
+
+def update_total(blank, total, folders, args):
+    """
+    Add the delta stats of the reused publishers to the total, which has the
+    totals of the other publishers (the publishers in folders) added to it.
+
+    These come from the previous total, less the previous totals of the
+    publishers that aren't reused. Stats that can't be updated like that (see
+    subtract) are summed again from every publisher's kept total.
+
+    """
+    if not args.delta_stats:
+        return
+    previous_total = _read_totals(os.path.join(args.previous_output, ALL_TOTAL), args.delta_stats)
+    recalculate = set(args.delta_stats).difference(previous_total)
+    with decimal.localcontext(statsrunner.aggregate.EXACT_CONTEXT):
+        for folder in sorted(previous_publishers(args.previous_output).difference(args.reused_publishers)):
+            old = read_publisher_total(args.previous_output, folder, args.delta_stats)
+            for name, value in old.iteritems():
+                if name in recalculate:
+                    continue
+                try:
+                    previous_total[name] = subtract(previous_total[name], value, total[name])
+                except ValueError:
+                    recalculate.add(name)
+    statsrunner.aggregate.add_publisher_total(total, dict((k, v) for k, v in previous_total.iteritems() if k not in recalculate))
+
+    if recalculate:
+        print 'Summing {0} stats over every publisher again: {1}'.format(len(recalculate), ', '.join(sorted(recalculate)))
+        for name in recalculate:
+            total[name] = statsrunner.aggregate.copy_stat(blank[name])
+        for folder in folders:
+            statsrunner.aggregate.add_publisher_total(total, read_publisher_total(args.output, folder, recalculate))
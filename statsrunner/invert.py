@@ -1,41 +1,145 @@
+import cPickle
+import itertools
 import json
 import os, sys
+import shutil
 from collections import defaultdict
+import statsrunner.packed
 
-def invert_dir(basedirname, out_filename, output_dir):
+def read_dir(basedirname, output_dir, enabled_stats=None):
+    """ Yield (parent folder, stat name, value) for each json file below basedirname. """
+    for dirname, dirs, files in os.walk(os.path.join(output_dir, basedirname), followlinks=True):
+        parent_folder = os.path.basename(dirname)
+        for f in files:
+            if enabled_stats is not None and f[:-5] not in enabled_stats:
+                continue
+            with open(os.path.join(dirname, f)) as fp:
+                yield parent_folder, f[:-5], json.load(fp)
+
+def read_records(paths, enabled_stats=None):
+    """ Yield (name, stat name, value) for each record in the given --packed record files. """
+    for path in paths:
+        for record in statsrunner.packed.read(path, enabled_stats, parse_float=float):
+            yield record
+
+def invert_values(stats):
     """
-    This 'inverts' the aggregated json files produced by aggregate.py
-    ie. it creates a json file of the stats grouped by value, and then by
-    publisher.
+    This 'inverts' the aggregated stats produced by aggregate.py
+    ie. it groups the stats by value, and then by publisher.
+
+    stats is an iterable of (parent folder, stat name, value), where the
+    parent folder is the publisher or file the value is for. Returns a
+    dictionary of stat name to inverted values.
 
     """
     out = {}
 
-    for dirname, dirs, files in os.walk(os.path.join(output_dir, basedirname), followlinks=True):
-        parent_folder = os.path.basename(dirname)
-        for f in files:
-            with open(os.path.join(dirname, f)) as fp:
-                stats_name = f[:-5]
-                stats_values = json.load(fp)
-                if type(stats_values) == dict:
-                    if not stats_name in out:
-                        out[stats_name] = defaultdict(dict)
-
-                    for k,v in stats_values.items():
-                        if type(v) == dict:
-                            if not k in out[stats_name]:
-                                out[stats_name][k] = defaultdict(dict)
-                            for k2,v2 in v.items():
-                                out[stats_name][k][k2][parent_folder] = v2
-                        else:
-                            out[stats_name][k][parent_folder] = v
-
-                elif type(stats_values) == int:
-                    if not stats_name in out:
-                        out[stats_name] = defaultdict(int)
-
-                    out[stats_name][parent_folder] += stats_values
+    for parent_folder, stats_name, stats_values in stats:
+        if type(stats_values) == dict:
+            if not stats_name in out:
+                out[stats_name] = defaultdict(dict)
+
+            for k,v in stats_values.items():
+                if type(v) == dict:
+                    if not k in out[stats_name]:
+                        out[stats_name][k] = defaultdict(dict)
+                    for k2,v2 in v.items():
+                        out[stats_name][k][k2][parent_folder] = v2
+                else:
+                    out[stats_name][k][parent_folder] = v
+
+        elif type(stats_values) == int:
+            if not stats_name in out:
+                out[stats_name] = defaultdict(int)
+
+            out[stats_name][parent_folder] += stats_values
+
+    return out
+
+def merge_inverted(out, other):
+    """
+    Add the inverted stats in other to out, as if invert_values had been
+    given the stats for other after those for out.
+
+    """
+    for stats_name, inverted in other.items():
+        if not stats_name in out:
+            out[stats_name] = inverted
+        elif out[stats_name].default_factory == int:
+            for parent_folder, count in inverted.items():
+                out[stats_name][parent_folder] += count
+        else:
+            for k,v in inverted.items():
+                if not k in out[stats_name]:
+                    out[stats_name][k] = v
+                elif type(out[stats_name][k]) == defaultdict:
+                    for k2,v2 in v.items():
+                        out[stats_name][k][k2].update(v2)
+                else:
+                    out[stats_name][k].update(v)
+    return out
+
+def pack_inverted(out):
+    """ Pickle each stat of an inversion separately, so they can be spilled to disk. """
+    return dict((stats_name, cPickle.dumps(inverted, cPickle.HIGHEST_PROTOCOL)) for stats_name, inverted in out.items())
+
+class InvertedSpill(object):
+    """
+    Collects the partial inversions of one output directory, pickled by
+    pack_inverted, within a memory budget.
+
+    Partial inversions are held in memory until their total size exceeds
+    budget bytes, and are then appended to a file per stat in spill_dir. The
+    merged inversions are produced one stat at a time, so only one stat needs
+    to be held in memory in full.
+
+    """
+    def __init__(self, spill_dir, budget):
+        self.spill_dir = spill_dir
+        self.budget = budget
+        self.buffered = defaultdict(list)
+        self.size = 0
+        self.spilled = set()
+        try:
+            os.makedirs(spill_dir)
+        except OSError: pass
 
+    def add(self, packed):
+        for stats_name, data in packed.items():
+            self.buffered[stats_name].append(data)
+            self.size += len(data)
+        if self.size > self.budget:
+            self.spill()
+
+    def spill(self):
+        for stats_name, datas in self.buffered.items():
+            with open(os.path.join(self.spill_dir, stats_name), 'ab') as fp:
+                for data in datas:
+                    fp.write(data)
+            self.spilled.add(stats_name)
+        self.buffered.clear()
+        self.size = 0
+
+    def items(self):
+        """ Yield (stat name, merged inversion) for each stat, in the order the partial inversions were added. """
+        for stats_name in sorted(self.spilled | set(self.buffered)):
+            out = {}
+            if stats_name in self.spilled:
+                path = os.path.join(self.spill_dir, stats_name)
+                with open(path, 'rb') as fp:
+                    while True:
+                        try:
+                            inverted = cPickle.load(fp)
+                        except EOFError:
+                            break
+                        merge_inverted(out, {stats_name: inverted})
+                os.remove(path)
+            for data in self.buffered.pop(stats_name, []):
+                merge_inverted(out, {stats_name: cPickle.loads(data)})
+            yield stats_name, out[stats_name]
+
+def write_inverted(out, out_filename, output_dir):
+    """ Write a json file for each stat in out, which may also be an InvertedSpill. """
     for statname, inverted in out.items():
         try:
             os.mkdir(os.path.join(output_dir, out_filename))
@@ -43,16 +147,119 @@ def invert_dir(basedirname, out_filename, output_dir):
         with open(os.path.join(output_dir, out_filename, statname+'.json'), 'w') as fp:
             json.dump(inverted, fp, sort_keys=True, indent=2)
 
+def invert_stats(stats, out_filename, output_dir):
+    """ Invert an iterable of (parent folder, stat name, value), and write a json file for each stat to out_filename. """
+    write_inverted(invert_values(stats), out_filename, output_dir)
+
+def invert_dir(basedirname, out_filename, output_dir, enabled_stats=None):
+    """
+    Invert the json files below basedirname. If enabled_stats is given, only
+    those stats are inverted.
+
+    """
+    invert_stats(read_dir(basedirname, output_dir, enabled_stats), out_filename, output_dir)
+
+def invert_publisher((folder, has_files, args)):
+    """
+    Invert the stats of one publisher's files, writing them to
+    inverted-file-publisher, and its publisher stats. Each file is read once.
+    Returns the two inversions, to be merged into inverted-file and
+    inverted-publisher.
+
+    """
+    if not has_files:
+        file_out = {}
+    elif args.packed:
+        file_out = invert_values(read_records([statsrunner.packed.file_records_path(args.output, folder)], args.enabled_stats))
+    else:
+        file_out = invert_values(read_dir(os.path.join('aggregated-file', folder), args.output, args.enabled_stats))
+    if has_files:
+        try:
+            os.mkdir(os.path.join(args.output, 'inverted-file-publisher', folder))
+        except OSError: pass
+        write_inverted(file_out, os.path.join('inverted-file-publisher', folder), args.output)
+
+    if args.packed:
+        # The publisher records are all in one file, which is inverted separately
+        publisher_out = {}
+    else:
+        publisher_out = invert_values(read_dir(os.path.join('aggregated-publisher', folder), args.output, args.enabled_stats))
+    if args.memory_budget is not None:
+        return pack_inverted(file_out), pack_inverted(publisher_out)
+    return file_out, publisher_out
+
+def invert_publisher_records(args):
+    """ Yield the inversion of each publisher's stats in the aggregated-publisher records. """
+    path = os.path.join(args.output, statsrunner.packed.PUBLISHER_RECORDS)
+    for folder, stats in statsrunner.packed.read_grouped(path, args.enabled_stats, parse_float=float):
+        yield invert_values((folder, stats_name, value) for stats_name, value in stats.items())
+
 def invert(args):
+    """
+    Write inverted-publisher, inverted-file and inverted-file-publisher in a
+    single pass over the aggregated stats, one publisher at a time, using
+    args.multi processes. The inversions of each publisher are merged in the
+    order of the aggregated-file directory, so the result is the same as
+    inverting the whole directory at once.
+
+    If args.memory_budget is given, the partial inversions are spilled to disk
+    rather than held in memory once their pickled size exceeds that many
+    megabytes (half of it each for the file and the publisher inversions), and
+    are merged and written one stat at a time.
+
+    """
     for dirname in ['inverted-publisher', 'inverted-file', 'inverted-file-publisher']:
         try:
             os.mkdir(os.path.join(args.output, dirname))
         except OSError: pass
-    invert_dir('aggregated-publisher', 'inverted-publisher', args.output)
-    invert_dir('aggregated-file', 'inverted-file', args.output)
-    for folder in os.listdir(os.path.join(args.output, 'aggregated-file')):
-        try:
-            os.mkdir(os.path.join(args.output, 'inverted-file-publisher', folder))
-        except OSError: pass
-        invert_dir(os.path.join('aggregated-file', folder), os.path.join('inverted-file-publisher', folder), args.output)
 
+    if args.packed:
+        folders = [ folder for folder, path in statsrunner.packed.file_records(args.output) ]
+        publisher_folders = []
+    else:
+        folders = os.listdir(os.path.join(args.output, 'aggregated-file'))
+        publisher_folders = os.listdir(os.path.join(args.output, 'aggregated-publisher'))
+    tasks = [ (folder, True, args) for folder in folders ] + \
+            [ (folder, False, args) for folder in publisher_folders if folder not in set(folders) ]
+
+    if args.multi > 1:
+        from multiprocessing import Pool
+        pool = Pool(args.multi)
+        results = pool.imap(invert_publisher, tasks)
+    else:
+        pool = None
+        results = itertools.imap(invert_publisher, tasks)
+
+    spill_dir = os.path.join(args.output, 'invert-spill')
+    if args.memory_budget is not None:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        # The file and publisher inversions are buffered separately, so each gets half the budget
+        budget = args.memory_budget * 1024 * 1024 // 2
+        file_out = InvertedSpill(os.path.join(spill_dir, 'inverted-file'), budget)
+        publisher_out = InvertedSpill(os.path.join(spill_dir, 'inverted-publisher'), budget)
+        add = lambda out, partial: out.add(partial)
+    else:
+        file_out = {}
+        publisher_out = {}
+        add = merge_inverted
+    try:
+        for folder_file_out, folder_publisher_out in results:
+            add(file_out, folder_file_out)
+            add(publisher_out, folder_publisher_out)
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+
+    if args.packed and args.memory_budget is not None:
+        for folder_publisher_out in invert_publisher_records(args):
+            publisher_out.add(pack_inverted(folder_publisher_out))
+    elif args.packed:
+        publisher_out = invert_values(read_records([os.path.join(args.output, statsrunner.packed.PUBLISHER_RECORDS)], args.enabled_stats))
+    write_inverted(publisher_out, 'inverted-publisher', args.output)
+    write_inverted(file_out, 'inverted-file', args.output)
+    if args.memory_budget is not None:
+        shutil.rmtree(spill_dir, ignore_errors=True)
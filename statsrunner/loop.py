@@ -1,21 +1,37 @@
 import os
 from lxml import etree
 import inspect
+import itertools
 import json
 import sys
+import time
 import traceback
 import decimal
 import argparse
+from collections import defaultdict
 import statsrunner.shared
 import statsrunner.aggregate
+import statsrunner.cache
+import statsrunner.incremental
+import statsrunner.packed
+import statsrunner.source
+import statsrunner.timings
 from statsrunner.common import decimal_default
 
+# Files larger than this are skipped, or parsed incrementally with --streaming
+# Use same limit as registry https://github.com/okfn/ckanext-iati/blob/606e0919baf97552a14b7c608529192eb7a04b19/ckanext/iati/archiver.py#L23
+MAX_FILE_SIZE = 50000000
+
+# Aim for this many chunks of work per process, so that the last few chunks are
+# small enough for the processes to finish at about the same time
+CHUNKS_PER_PROCESS = 4
+
 def call_stats(this_stats, args):
     this_out = {}
     for name, function in inspect.getmembers(this_stats, predicate=inspect.ismethod):
         if not statsrunner.shared.use_stat(this_stats, name): continue
         try:
-            this_out[name] = function()
+            this_out[name] = statsrunner.timings.call(this_stats, name, function, args)
         except KeyboardInterrupt:
             exit()
         except:
@@ -25,7 +41,117 @@ def call_stats(this_stats, args):
     return this_out
 
 
+def worker_init(stats_module_names):
+    """ Run the stats modules' optional setup, once in each worker process. """
+    import importlib
+    for stats_module_name in stats_module_names:
+        stats_module = importlib.import_module(stats_module_name)
+        if hasattr(stats_module, 'worker_init'):
+            stats_module.worker_init()
+
+
+def worker_metrics(stats_module):
+    """
+    Return the metrics the stats module has collected since it was last asked,
+    along with the time spent making blank templates for aggregate_file.
+
+    """
+    metrics = statsrunner.aggregate.blank_metrics()
+    if hasattr(stats_module, 'worker_metrics'):
+        metrics.update(stats_module.worker_metrics())
+    return metrics
+
+
+def report_metrics(metrics):
+    total = defaultdict(float)
+    for file_metrics in metrics:
+        for k, v in (file_metrics or {}).items():
+            total[k] += v
+    for k, v in sorted(total.items()):
+        print '{0}: {1}'.format(k, v)
+
+
+def iterparse_root(inputfile):
+    """
+    Parse a file incrementally, for files that are too large to hold in memory.
+
+    Returns the root element (with its attributes, but not its children), and a
+    generator of the root's children. Each child is discarded once the
+    generator moves on to the next.
+
+    """
+    context = etree.iterparse(inputfile, events=('start', 'end'))
+    event, root = next(context)
+    def children():
+        depth = 1
+        for event, element in context:
+            if event == 'start':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1:
+                    while element.getprevious() is not None:
+                        del root[0]
+                    yield element
+                    element.clear()
+    return root, children()
+
+
+class ParsedFile(object):
+    """
+    Parses a file the first time its tree is asked for, so that with several
+    stats modules the file is only parsed once, and not at all if they can all
+    reuse earlier results.
+
+    """
+    def __init__(self, data_file):
+        self.data_file = data_file
+        self.doc = None
+        self.error = None
+
+    def parse(self, streaming):
+        """
+        Return (doc, root, children). For a file parsed incrementally, doc is
+        None, and it is parsed again for each call, as children can only be
+        iterated once.
+
+        """
+        if streaming:
+            root, children = iterparse_root(self.data_file.xml_source())
+            return None, root, children
+        if self.error is not None:
+            raise self.error
+        if self.doc is None:
+            try:
+                self.doc = etree.parse(self.data_file.xml_source())
+            except etree.ParseError, e:
+                self.error = e
+                raise
+        root = self.doc.getroot()
+        return self.doc, root, root
+
+
 def process_file((inputfile, output_dir, folder, xmlfile, args)):
+    """
+    Calculate the stats for a file, returning a tuple (metrics, subtotal JSON),
+    see process_files. With several stats modules (args.module_args), returns
+    a list of these, one for each module, with the file parsed once for all of
+    them.
+
+    """
+    # Blobs of files that are parsed incrementally are kept out of memory
+    data_file = statsrunner.source.data_file(inputfile, folder, xmlfile, args, MAX_FILE_SIZE)
+    parsed = ParsedFile(data_file)
+    try:
+        if args.module_args:
+            return [ process_module(inputfile, module_args.output, folder, xmlfile, module_args, data_file, parsed)
+                     for module_args in args.module_args ]
+        return process_module(inputfile, output_dir, folder, xmlfile, args, data_file, parsed)
+    finally:
+        data_file.close()
+
+
+def process_module(inputfile, output_dir, folder, xmlfile, args, data_file, parsed):
     import importlib
     stats_module = importlib.import_module(args.stats_module)
     
@@ -38,36 +164,59 @@ def process_file((inputfile, output_dir, folder, xmlfile, args)):
 
     if args.new:
         if os.path.exists(outputfile):
-            return
+            return worker_metrics(stats_module), None
 
+    cache = None
+    cached, missing = None, None
+    if args.previous_output and not args.verbose_loop:
+        # Reuse the stats from the previous run's output if the file hasn't changed
+        cached, missing = statsrunner.incremental.previous_stats(stats_module, folder, xmlfile, args)
+    if cached is None and args.cache_dir and not args.verbose_loop:
+        cache = statsrunner.cache.StatsCache(args.cache_dir, stats_module, args.today, args.enabled_stats, args.strict)
+        sha = data_file.sha()
+        cached, missing = cache.get(sha, os.path.join(folder, xmlfile))
+    if cached is not None and not missing:
+        subtotal = aggregate_file(stats_module, {'file':{}, 'elements':[]}, output_dir, folder, xmlfile, args, cached)
+        return worker_metrics(stats_module), subtotal_json(subtotal, folder, args)
+
+    stats_classes = []
     try:
-        file_size = os.stat(inputfile).st_size
-        if file_size > 50000000: # Use same limit as registry https://github.com/okfn/ckanext-iati/blob/606e0919baf97552a14b7c608529192eb7a04b19/ckanext/iati/archiver.py#L23
+        file_size = data_file.size
+        streaming = file_size > MAX_FILE_SIZE
+        if streaming and not args.streaming:
             stats_json = {'file':{'toolarge':1, 'file_size':file_size}, 'elements':[], }
         else:
-            doc = etree.parse(inputfile)
-            root = doc.getroot()
+            doc, root, children = parsed.parse(streaming)
             def process_stats_file(FileStats):
                 file_stats = FileStats()
                 file_stats.doc = doc
                 file_stats.root = root
+                file_stats.streaming = streaming
                 file_stats.strict = args.strict
                 file_stats.context = 'in '+inputfile
                 file_stats.fname = os.path.basename(inputfile)
                 file_stats.inputfile = inputfile
+                file_stats.data_file = data_file
+                if missing:
+                    file_stats.enabled_stats = missing
+                statsrunner.shared.restrict_stats(file_stats, args.enabled_stats)
                 return call_stats(file_stats, args)
 
             def process_stats_element(ElementStats, tagname=None):
-                for element in root:
+                for element in children:
                     if tagname and tagname != element.tag: continue
                     element_stats = ElementStats()
                     element_stats.element = element
                     element_stats.strict = args.strict
                     element_stats.context = 'in '+inputfile
                     element_stats.today = args.today
+                    if missing:
+                        element_stats.enabled_stats = missing
+                    statsrunner.shared.restrict_stats(element_stats, args.enabled_stats)
                     yield call_stats(element_stats, args)
 
             def process_stats(FileStats, ElementStats, tagname=None):
+                stats_classes.extend([FileStats, ElementStats])
                 file_out = process_stats_file(FileStats)
                 out = process_stats_element(ElementStats, tagname)
                 return {'file':file_out, 'elements':out}
@@ -79,9 +228,17 @@ def process_file((inputfile, output_dir, folder, xmlfile, args)):
             else:
                 stats_json = {'file':{'nonstandardroots':1}, 'elements':[]}
 
+            if streaming and not args.verbose_loop:
+                # Consume the elements now, so that a parse error part way
+                # through the file is caught below. They are summed as they go,
+                # rather than kept in a list, to keep memory use flat.
+                stats_json['elements'] = [ statsrunner.aggregate.sum_elements(stats_module, stats_json['elements'], args.enabled_stats) ]
+            elif streaming:
+                stats_json['elements'] = list(stats_json['elements'])
+
     except etree.ParseError:
         print 'Could not parse file {0}'.format(inputfile)
-        if os.path.getsize(inputfile) == 0:
+        if data_file.size == 0:
             # Assume empty files are download errors, not invalid XML
             stats_json = {'file':{'emptyfile':1}, 'elements':[]}
         else:
@@ -91,15 +248,60 @@ def process_file((inputfile, output_dir, folder, xmlfile, args)):
         with open(outputfile, 'w') as outfp:
             stats_json['elements'] = list(stats_json['elements'])
             json.dump(stats_json, outfp, sort_keys=True, indent=2, default=decimal_default)
+        return worker_metrics(stats_module), None
+    else:
+        subtotal = aggregate_file(stats_module, stats_json, output_dir, folder, xmlfile, args, cached)
+        if cache:
+            dated_names = statsrunner.cache.date_dependent_stats(stats_classes, subtotal.keys())
+            if missing:
+                cache.put_dated(sha, os.path.join(folder, xmlfile), subtotal, dated_names)
+            else:
+                cache.put(sha, os.path.join(folder, xmlfile), subtotal, dated_names)
+        return worker_metrics(stats_module), subtotal_json(subtotal, folder, args)
+
+
+def aggregate_file(stats_module, stats_json, output_dir, folder, xmlfile, args, cached=None):
+    """
+    Sum the stats for a file, writing them to aggregated-file (or its records,
+    with --packed) if args.aggregated_file is set.
+
+    """
+    if args.aggregated_file and not args.packed:
+        file_output_dir = os.path.join(output_dir, 'aggregated-file', folder, xmlfile)
+    else:
+        file_output_dir = None
+    subtotal = statsrunner.aggregate.aggregate_file(stats_module, stats_json, file_output_dir, cached=cached, enabled_stats=args.enabled_stats)
+    if args.aggregated_file and args.packed:
+        statsrunner.packed.append(statsrunner.packed.file_records_path(output_dir, folder), xmlfile, subtotal,
+                                  statsrunner.aggregate.decimal_default, cached or ())
+    return subtotal
+
+
+def subtotal_json(subtotal, folder, args):
+    """
+    For the fused run command, return the file's subtotal as JSON, to be sent
+    back to the parent process. This is the same JSON that aggregate would
+    read back from aggregated-file, so the result is the same. The stats that
+    are reused for the publisher's total are left out.
+
+    """
+    if args.fused:
+        if folder in args.reused_publishers:
+            subtotal = dict((k, v) for k, v in subtotal.iteritems() if k not in args.reused_stats)
+        return json.dumps(subtotal, default=statsrunner.aggregate.decimal_default)
     else:
-        statsrunner.aggregate.aggregate_file(stats_module, stats_json, os.path.join(output_dir, 'aggregated-file', folder, xmlfile))
+        return None
 
 
 def loop_folder(folder, args, data_dir, output_dir):
-    if not os.path.isdir(os.path.join(data_dir, folder)) or folder == '.git':
+    if args.commit:
+        xmlfiles = statsrunner.source.list_folder(data_dir, args.commit, folder)
+    elif not os.path.isdir(os.path.join(data_dir, folder)) or folder == '.git':
         return []
+    else:
+        xmlfiles = os.listdir(os.path.join(data_dir, folder))
     files = []
-    for xmlfile in os.listdir(os.path.join(data_dir, folder)):
+    for xmlfile in xmlfiles:
         try:
             files.append((os.path.join(data_dir,folder,xmlfile),
                          output_dir, folder, xmlfile, args))
@@ -108,18 +310,142 @@ def loop_folder(folder, args, data_dir, output_dir):
             continue
     return files
 
-def loop(args):
+def file_size(f):
+    try:
+        return os.path.getsize(f[0])
+    except OSError:
+        return 0
+
+def blob_size(f):
+    inputfile, output_dir, folder, xmlfile, args = f
+    return statsrunner.source.tree(args.data, args.commit)[folder][xmlfile][1]
+
+def schedule(files, processes, size=file_size):
+    """
+    Split the files into chunks of work for the worker pool, largest files
+    first. Sending the largest files first (longest processing time first
+    scheduling) means a large file is never left running on its own at the
+    end. Each chunk holds roughly an equal share of the total size, so large
+    files get a chunk to themselves, and small files are batched together.
+
+    size is a function giving the size of an item in files, by default the
+    size of the file at its first element.
+
+    """
+    sized_files = [ (size(f), f) for f in files ]
+    sized_files.sort(key=lambda x: x[0], reverse=True)
+
+    n_chunks = processes * CHUNKS_PER_PROCESS
+    max_chunk_bytes = sum(f_size for f_size, f in sized_files) / n_chunks
+    max_chunk_files = max(1, len(sized_files) / n_chunks)
+    chunks = []
+    chunk, chunk_bytes = [], 0
+    for f_size, f in sized_files:
+        if chunk and (chunk_bytes + f_size > max_chunk_bytes or len(chunk) >= max_chunk_files):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(f)
+        chunk_bytes += f_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def process_chunk(chunk):
+    """
+    Process a chunk of files, returning (pid, number of files, seconds taken,
+    list of (folder, process_file output), stat timings).
+
+    """
+    start = time.time()
+    results = [ (f[2], process_file(f)) for f in chunk ]
+    return os.getpid(), len(chunk), time.time() - start, results, statsrunner.timings.collect()
+
+
+def report_utilization(results, wall_seconds):
+    workers = defaultdict(lambda: [0, 0, 0.0])
+    for pid, n_files, seconds in results:
+        workers[pid][0] += 1
+        workers[pid][1] += n_files
+        workers[pid][2] += seconds
+    for pid, (n_chunks, n_files, seconds) in sorted(workers.items()):
+        print 'Worker {0}: {1} chunks, {2} files, {3:.1f}s busy of {4:.1f}s ({5:.0%} utilization)'.format(
+            pid, n_chunks, n_files, seconds, wall_seconds, seconds / wall_seconds if wall_seconds else 1)
+
+
+def list_files(args):
     if args.folder:
-        files = loop_folder(args.folder, args, data_dir=args.data, output_dir=args.output)
+        return loop_folder(args.folder, args, data_dir=args.data, output_dir=args.output)
     else:
         files = []
-        for folder in os.listdir(args.data):
+        for folder in (statsrunner.source.list_folders(args.data, args.commit) if args.commit else os.listdir(args.data)):
             files += loop_folder(folder, args, data_dir=args.data, output_dir=args.output)
+        return files
+
 
+def process_files(files, args):
+    """
+    Process the files using args.multi processes. Yields a tuple (folder,
+    subtotal JSON) for each file, in the order they finish. The subtotal is
+    None unless args.fused is set. With several stats modules
+    (args.module_args), it is a list of the subtotals for each module. The
+    metrics and worker utilization are printed once all the files are done.
+
+    """
+    import importlib
+    modules = args.module_args or [args]
+    stats_modules = [ importlib.import_module(module_args.stats_module) for module_args in modules ]
+    start = time.time()
+    for stats_module, module_args in zip(stats_modules, modules):
+        statsrunner.incremental.start(stats_module, module_args)
+        if module_args.packed and module_args.aggregated_file and not module_args.verbose_loop:
+            # The file records are appended to, so start them afresh
+            for folder in set(f[2] for f in files):
+                statsrunner.packed.remove(statsrunner.packed.file_records_path(module_args.output, folder))
+    chunks = schedule(files, args.multi, size=blob_size if args.commit else file_size)
+    stats_module_names = [ module_args.stats_module for module_args in modules ]
     if args.multi > 1:
         from multiprocessing import Pool
-        pool = Pool(args.multi)
-        pool.map(process_file, files)
+        pool = Pool(args.multi, initializer=worker_init, initargs=(stats_module_names,))
+        results = pool.imap_unordered(process_chunk, chunks)
     else:
-        map(process_file, files)
+        pool = None
+        worker_init(stats_module_names)
+        results = itertools.imap(process_chunk, chunks)
+
+    workers = []
+    metrics = []
+    worker_timings = defaultdict(dict)
+    try:
+        for pid, n_files, seconds, file_results, chunk_timings in results:
+            workers.append((pid, n_files, seconds))
+            statsrunner.timings.merge_modules(worker_timings[str(pid)], chunk_timings)
+            for folder, result in file_results:
+                if args.module_args:
+                    metrics.extend(file_metrics for file_metrics, subtotal in result)
+                    yield folder, [ subtotal for file_metrics, subtotal in result ]
+                else:
+                    file_metrics, subtotal = result
+                    metrics.append(file_metrics)
+                    yield folder, subtotal
+    except:
+        # Including GeneratorExit, if the caller stops early
+        if pool:
+            pool.terminate()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+    for stats_module, module_args in zip(stats_modules, modules):
+        statsrunner.incremental.finish(stats_module, module_args)
+    report_metrics(metrics)
+    report_utilization(workers, time.time() - start)
+    if args.stat_timings:
+        for module_args in modules:
+            statsrunner.timings.write(module_args.output, module_args.stats_module, worker_timings)
+
+
+def loop(args):
+    for folder, subtotal in process_files(list_files(args), args):
+        pass
 
@@ -0,0 +1,162 @@
+"""
+A packed alternative to the output directory layout, enabled with --packed.
+
+Normally loop and aggregate write a small JSON file for every stat of every
+file and publisher, which is slow to write, read back and archive. With
+--packed they write a few record files instead:
+
+    aggregated-file/<publisher>.records    the stats of each of the publisher's files
+    aggregated-publisher.records           the stats of each publisher
+    aggregated.records                     the stats for all of the data
+
+Each line is one record, "<name>\\t<stat>\\t<json>", where name is the file or
+publisher (and is empty in aggregated.records). A reader can skip the stats it
+doesn't need without parsing their JSON. aggregate, invert and the gitaggregate
+scripts read these files directly, and the export command writes the usual
+directory layout from them.
+
+This module only uses the standard library, so that the gitaggregate scripts
+can import it.
+
+"""
+from collections import OrderedDict
+import decimal
+import fcntl
+import json
+import os
+
+FILE_DIR = 'aggregated-file'
+PUBLISHER_RECORDS = 'aggregated-publisher.records'
+ALL_RECORDS = 'aggregated.records'
+EXTENSION = '.records'
+
+
+def file_records_path(output_dir, folder):
+    return os.path.join(output_dir, FILE_DIR, folder + EXTENSION)
+
+
+def format_records(name, stats, default, ordered=()):
+    if '\t' in name or '\n' in name:
+        raise ValueError('Can not pack a record for {0!r}'.format(name))
+    return ''.join('{0}\t{1}\t{2}\n'.format(name, stat, json.dumps(value, sort_keys=stat not in ordered, default=default))
+                   for stat, value in sorted(stats.items()))
+
+
+def append(path, name, stats, default, ordered=()):
+    """
+    Append the stats (a dictionary of stat name to value) for name to a record
+    file. default is passed on to json.dumps. The stats named in ordered were
+    read back from earlier output (see read), and keep the order of their keys.
+    The file is locked while the records are written, so several processes can
+    append to the same file.
+
+    """
+    append_formatted(path, format_records(name, stats, default, ordered))
+
+
+def append_formatted(path, data):
+    """ Append records already formatted by format_records to a record file. """
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    with open(path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            fp.write(data)
+            fp.flush()
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def read(path, stats=None, parse_float=decimal.Decimal, object_pairs_hook=None, exclude=()):
+    """
+    Yield (name, stat, value) for each record in a record file. If stats is
+    given, records for other stats are skipped without parsing them, as are
+    records for the stats in exclude.
+
+    """
+    with open(path) as fp:
+        for line in fp:
+            name, stat, value = line.rstrip('\n').split('\t', 2)
+            if (stats is not None and stat not in stats) or stat in exclude:
+                continue
+            yield name, stat, json.loads(value, parse_float=parse_float, object_pairs_hook=object_pairs_hook)
+
+
+def read_grouped(path, stats=None, parse_float=decimal.Decimal, object_pairs_hook=None, exclude=()):
+    """
+    Yield (name, dictionary of stat name to value) from a record file, in the
+    order the names were written.
+
+    """
+    current_name, current_stats = None, None
+    for name, stat, value in read(path, stats, parse_float, object_pairs_hook, exclude):
+        if name != current_name:
+            if current_stats is not None:
+                yield current_name, current_stats
+            current_name, current_stats = name, {}
+        current_stats[stat] = value
+    if current_stats is not None:
+        yield current_name, current_stats
+
+
+def file_records(output_dir):
+    """ Yield (folder, path) for each publisher's file record file. """
+    file_dir = os.path.join(output_dir, FILE_DIR)
+    if not os.path.isdir(file_dir):
+        return
+    for fname in os.listdir(file_dir):
+        if fname.endswith(EXTENSION):
+            yield fname[:-len(EXTENSION)], os.path.join(file_dir, fname)
+
+
+def write_json(path, value, default):
+    # The records were written with sort_keys, and are read back in order,
+    # because once the keys are JSON strings they may sort differently (e.g.
+    # None and integer keys)
+    with open(path, 'w') as fp:
+        json.dump(value, fp, indent=2, default=default)
+
+
+def export(args):
+    """
+    Write the usual aggregated-file, aggregated-publisher and aggregated
+    directories from the record files in the output directory.
+
+    """
+    from statsrunner.aggregate import decimal_default
+    for folder, path in file_records(args.output):
+        for xmlfile, stats in read_grouped(path, object_pairs_hook=OrderedDict):
+            file_dir = os.path.join(args.output, 'aggregated-file', folder, xmlfile)
+            try:
+                os.makedirs(file_dir)
+            except OSError:
+                pass
+            for stat, value in stats.items():
+                write_json(os.path.join(file_dir, stat + '.json'), value, decimal_default)
+
+    path = os.path.join(args.output, PUBLISHER_RECORDS)
+    if os.path.exists(path):
+        for folder, stat, value in read(path, object_pairs_hook=OrderedDict):
+            try:
+                os.makedirs(os.path.join(args.output, 'aggregated-publisher', folder))
+            except OSError:
+                pass
+            write_json(os.path.join(args.output, 'aggregated-publisher', folder, stat + '.json'), value, decimal_default)
+
+    path = os.path.join(args.output, ALL_RECORDS)
+    if os.path.exists(path):
+        try:
+            os.makedirs(os.path.join(args.output, 'aggregated'))
+        except OSError:
+            pass
+        for name, stat, value in read(path, object_pairs_hook=OrderedDict):
+            write_json(os.path.join(args.output, 'aggregated', stat + '.json'), value, decimal_default)
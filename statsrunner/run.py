@@ -0,0 +1,89 @@
+"""
+The run command, which does the work of loop and aggregate in one pass.
+
+Rather than writing every file's stats to aggregated-file and reading them all
+back again, the workers send each file's subtotal back to this process, which
+sums them into a total for each publisher. Once all of a publisher's files are
+done, its publisher stats are calculated and written to aggregated-publisher.
+aggregated-file is only written if --aggregated-file is given.
+
+With --previous-output, the publishers with no changed files only send back
+the stats that aren't reused from the previous run (see incremental.py).
+
+With several stats modules, the workers send back a subtotal for each module,
+and each module's totals are kept and written to its own output directory.
+
+"""
+from collections import Counter
+import decimal
+import importlib
+import json
+import os
+import statsrunner.aggregate
+import statsrunner.incremental
+import statsrunner.loop
+import statsrunner.timings
+from statsrunner.aggregate import copy_stat, dict_sum_inplace, make_blank
+
+
+class Totals(object):
+    """ The publisher totals, and the total for all the data, for one stats module. """
+    def __init__(self, args):
+        self.args = args
+        self.stats_module = importlib.import_module(args.stats_module)
+        statsrunner.aggregate.make_output_dirs(args)
+        self.blank = make_blank(self.stats_module, args.enabled_stats)
+        self.publisher_totals = {}
+        self.total = copy_stat(self.blank)
+
+    def add(self, folder, subtotal_json, done):
+        """
+        Add a file's subtotal to its publisher's total. done is True once all of
+        the publisher's files are added. The files arrive in the order the
+        workers finish them, so Decimals are summed exactly, as in
+        statsrunner.aggregate.add_publisher_total.
+
+        """
+        args = self.args
+        if folder not in self.publisher_totals:
+            self.publisher_totals[folder] = statsrunner.incremental.publisher_blank(self.blank, folder, args)
+        with decimal.localcontext(statsrunner.aggregate.EXACT_CONTEXT):
+            dict_sum_inplace(self.publisher_totals[folder], json.loads(subtotal_json, parse_float=decimal.Decimal))
+        if done:
+            publisher_total = self.publisher_totals.pop(folder)
+            statsrunner.aggregate.aggregate_publisher(self.stats_module, publisher_total, folder, args)
+            statsrunner.incremental.write_publisher_total(publisher_total, folder, args)
+            statsrunner.aggregate.add_publisher_total(self.total, statsrunner.incremental.total_part(publisher_total, folder, args))
+
+    def finish(self, folders):
+        args = self.args
+        statsrunner.incremental.update_total(self.blank, self.total, folders, args)
+        statsrunner.incremental.write_all_total(self.total, args)
+        statsrunner.aggregate.aggregate_all(self.stats_module, self.total, args)
+        statsrunner.incremental.finish_aggregate(folders, args)
+
+
+def run(args):
+    modules = args.module_args or [args]
+    if args.verbose_loop:
+        # The per activity output of --verbose-loop has to be written to disk anyway
+        statsrunner.loop.loop(args)
+        for module_args in modules:
+            statsrunner.aggregate.aggregate(module_args)
+        return
+
+    totals = [ Totals(module_args) for module_args in modules ]
+    files = statsrunner.loop.list_files(args)
+    remaining = Counter(f[2] for f in files)
+    for folder, subtotal_json in statsrunner.loop.process_files(files, args):
+        remaining[folder] -= 1
+        subtotals = subtotal_json if args.module_args else [subtotal_json]
+        for module_totals, subtotal in zip(totals, subtotals):
+            module_totals.add(folder, subtotal, remaining[folder] == 0)
+
+    for module_totals in totals:
+        module_totals.finish(remaining.keys())
+    if args.stat_timings:
+        timings = {str(os.getpid()): statsrunner.timings.collect()}
+        for module_args in modules:
+            statsrunner.timings.write(module_args.output, module_args.stats_module, timings, append=True)
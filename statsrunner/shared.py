@@ -1,5 +1,92 @@
+import inspect
+
+
 def use_stat(stats, name):
     if hasattr(stats, 'enabled_stats'):
         return name in stats.enabled_stats
     else:
         return not name.startswith('_')
+
+
+def restrict_stats(stats, enabled_stats):
+    """
+    Limit a stats object to the given stat names (as chosen by select_stats),
+    on top of any enabled_stats it already has. None means all stats.
+
+    """
+    if enabled_stats is None:
+        return
+    if hasattr(stats, 'enabled_stats'):
+        stats.enabled_stats = [ name for name in stats.enabled_stats if name in enabled_stats ]
+    else:
+        stats.enabled_stats = enabled_stats
+
+
+def stats_classes(stats_module):
+    return [ stats_module.ActivityStats, stats_module.ActivityFileStats, stats_module.OrganisationStats,
+             stats_module.OrganisationFileStats, stats_module.PublisherStats, stats_module.AllDataStats ]
+
+
+def stat_names(stats_module):
+    """ Return the set of the names of the stats in a stats module. """
+    all_names = set()
+    for stats_class in stats_classes(stats_module):
+        for name, function in inspect.getmembers(stats_class, predicate=inspect.ismethod):
+            if use_stat(stats_class, name):
+                all_names.add(name)
+    return all_names
+
+
+def select_stats(stats_module, stats=None, exclude_stats=None):
+    """
+    Return the set of stat names to calculate, given lists of stats to include
+    (None for all of them) and to exclude, or None if every stat should be
+    calculated.
+
+    Stats that the chosen stats need, listed in the ``stat_dependencies``
+    dictionary of a stats class, are always included. For example, publisher
+    stats are calculated from the aggregated activity stats. Raises a
+    ValueError for names that aren't stats in the module.
+
+    """
+    if stats is None and not exclude_stats:
+        return None
+
+    all_names = stat_names(stats_module)
+    dependencies = {}
+    for stats_class in stats_classes(stats_module):
+        for name, needs in getattr(stats_class, 'stat_dependencies', {}).items():
+            dependencies.setdefault(name, set()).update(needs)
+
+    unknown = set(stats or []).union(exclude_stats or []).difference(all_names)
+    if unknown:
+        raise ValueError('Unknown stats: {0}'.format(', '.join(sorted(unknown))))
+
+    selected = set(stats) if stats is not None else set(all_names)
+    selected.difference_update(exclude_stats or [])
+    to_check = list(selected)
+    while to_check:
+        for dependency in dependencies.get(to_check.pop(), []):
+            if dependency not in selected:
+                selected.add(dependency)
+                to_check.append(dependency)
+    return selected
+
+
+def select_module_stats(stats_modules, stats=None, exclude_stats=None):
+    """
+    select_stats for several stats modules that are run together, returning a
+    list of the result for each. The names only have to be stats of one of the
+    modules, and each module is given those that it has.
+
+    """
+    if stats is None and not exclude_stats:
+        return [ None for stats_module in stats_modules ]
+    module_names = [ stat_names(stats_module) for stats_module in stats_modules ]
+    unknown = set(stats or []).union(exclude_stats or []).difference(*module_names)
+    if unknown:
+        raise ValueError('Unknown stats: {0}'.format(', '.join(sorted(unknown))))
+    return [ select_stats(stats_module,
+                          None if stats is None else [ name for name in stats if name in names ],
+                          [ name for name in exclude_stats or [] if name in names ])
+             for stats_module, names in zip(stats_modules, module_names) ]
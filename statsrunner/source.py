@@ -0,0 +1,167 @@
+"""
+Where loop reads the XML files from.
+
+By default, these are the files in the data directory, data/<publisher>/<file>.
+If the data directory is a git repository, loop and run can be given --commit to
+read the files as they were at that commit straight from git's object store, so
+the data directory doesn't need to be checked out at each commit in turn. The
+files are listed with git ls-tree, and read through a git cat-file --batch
+process kept open in each worker. git's blob SHAs then also serve as the keys
+for statsrunner.cache, without hashing the contents again.
+
+A blob is read into memory to be parsed. Blobs too large to parse in full,
+which are parsed incrementally with --streaming, are instead written to a
+temporary file by git cat-file once, and parsed from there like a checked out
+file, so memory use stays flat, and stats that read the file again (as
+stats.dashboard does for --streaming) don't read the blob again.
+
+"""
+from cStringIO import StringIO
+import os
+import subprocess
+import tempfile
+
+import statsrunner.cache
+
+# The files at each commit, by data directory and commit
+_trees = {}
+
+# git cat-file --batch processes, by process id and data directory
+_cat_files = {}
+
+
+def resolve_commit(data_dir, commit):
+    """ Return the full SHA of the given commit in data_dir, or None if there isn't one. """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--verify', '-q', commit + '^{commit}'],
+                                           cwd=data_dir, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def tree(data_dir, commit):
+    """
+    Return a dictionary of publisher folder to a dictionary of file name to
+    (blob SHA, size), for the files data/<publisher>/<file> at the commit.
+
+    """
+    key = (data_dir, commit)
+    if key not in _trees:
+        out = {}
+        listing = subprocess.check_output(['git', 'ls-tree', '-r', '-l', '-z', commit], cwd=data_dir)
+        for line in listing.split('\0'):
+            if not line:
+                continue
+            info, path = line.split('\t', 1)
+            mode, object_type, sha, size = info.split()
+            parts = path.split('/')
+            if object_type != 'blob' or len(parts) != 2:
+                continue
+            out.setdefault(parts[0], {})[parts[1]] = (sha, int(size))
+        _trees[key] = out
+    return _trees[key]
+
+
+def list_folders(data_dir, commit):
+    return list(tree(data_dir, commit))
+
+
+def list_folder(data_dir, commit, folder):
+    return list(tree(data_dir, commit).get(folder, {}))
+
+
+class _CatFile(object):
+    def __init__(self, data_dir):
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=data_dir,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, sha):
+        self.process.stdin.write(sha + '\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3 or header[1] != 'blob':
+            raise IOError('Could not read blob {0}: {1}'.format(sha, ' '.join(header)))
+        data = self.process.stdout.read(int(header[2]))
+        # The contents are followed by a newline
+        self.process.stdout.read(1)
+        return data
+
+
+def read_blob(data_dir, sha):
+    """ Return the contents of the blob with the given SHA, using a git cat-file process for this process. """
+    key = (os.getpid(), data_dir)
+    if key not in _cat_files:
+        _cat_files[key] = _CatFile(data_dir)
+    return _cat_files[key].read(sha)
+
+
+def spool_blob(data_dir, sha):
+    """ Write the blob with the given SHA to a temporary file, without reading it into memory, and return its path. """
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    with os.fdopen(fd, 'wb') as fp:
+        returncode = subprocess.call(['git', 'cat-file', 'blob', sha], cwd=data_dir, stdout=fp)
+    if returncode:
+        os.remove(path)
+        raise IOError('Could not read blob {0}'.format(sha))
+    return path
+
+
+class DiskFile(object):
+    """ A file in the data directory. """
+    def __init__(self, path):
+        self.path = path
+        self.size = os.stat(path).st_size
+
+    def sha(self):
+        return statsrunner.cache.blob_sha(self.path)
+
+    def xml_source(self):
+        """ Return something lxml can parse: here, the file name. """
+        return self.path
+
+    def close(self):
+        pass
+
+
+class GitBlob(object):
+    """
+    A file at a commit of the data directory, read from git's object store.
+    Blobs larger than spool_size are written to a temporary file, which is
+    removed by close().
+
+    """
+    def __init__(self, data_dir, commit, folder, xmlfile, spool_size=None):
+        self.data_dir = data_dir
+        self.path = os.path.join(data_dir, folder, xmlfile)
+        self.blob, self.size = tree(data_dir, commit)[folder][xmlfile]
+        self.spool_size = spool_size
+        self.spooled = None
+
+    def sha(self):
+        return self.blob
+
+    def xml_source(self):
+        """ Return something lxml can parse: here, a file object of the blob's contents, or the temporary file's name. """
+        if self.spool_size is not None and self.size > self.spool_size:
+            if self.spooled is None:
+                self.spooled = spool_blob(self.data_dir, self.blob)
+            return self.spooled
+        return StringIO(read_blob(self.data_dir, self.blob))
+
+    def close(self):
+        if self.spooled is not None:
+            os.remove(self.spooled)
+            self.spooled = None
+
+
+def data_file(inputfile, folder, xmlfile, args, spool_size=None):
+    """
+    Return the DiskFile or GitBlob for a file in the data directory, depending
+    on args.commit. Call its close() once the file has been processed.
+
+    """
+    if args.commit:
+        return GitBlob(args.data, args.commit, folder, xmlfile, spool_size)
+    else:
+        return DiskFile(inputfile)
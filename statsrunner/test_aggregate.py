@@ -0,0 +1,60 @@
+from collections import defaultdict
+from decimal import Decimal
+import shutil
+import stats.countonly
+import statsrunner.aggregate
+import statsrunner.loop
+from statsrunner.test_run import ACTIVITY_XML, read_tree
+from statsrunner.testing import make_args
+
+
+def test_blank_template():
+    statsrunner.aggregate.blank_metrics()
+    blank = statsrunner.aggregate.blank_template(stats.countonly)
+    assert blank == statsrunner.aggregate.make_blank(stats.countonly)
+    blank['activities'] += 1
+    assert statsrunner.aggregate.blank_template(stats.countonly) == statsrunner.aggregate.make_blank(stats.countonly)
+
+    metrics = statsrunner.aggregate.blank_metrics()
+    assert metrics['blank_template_builds'] <= 1
+    assert metrics['blank_template_copies'] == 2
+    assert statsrunner.aggregate.blank_metrics()['blank_template_copies'] == 0
+
+
+def test_dict_sum_inplace():
+    total = {'count': 1, 'none': None, 'codes': defaultdict(int, {'a': 1}), 'nested': {'x': {'y': 1}}, 'decimal': Decimal('1.5')}
+    new = {'count': 2, 'none': 3, 'codes': {'a': 1, 'b': 2}, 'nested': {'x': {'y': 1, 'z': [1]}, 'w': {'v': 1}}, 'decimal': Decimal('0.25'), 'extra': [1]}
+    statsrunner.aggregate.dict_sum_inplace(total, new)
+    assert total == {'count': 3, 'none': None, 'codes': {'a': 2, 'b': 2}, 'nested': {'x': {'y': 2, 'z': [1]}, 'w': {'v': 1}}, 'decimal': Decimal('1.75'), 'extra': [1]}
+    assert type(total['codes']) == defaultdict
+
+    # New values are copied, rather than shared with the dictionary that was added
+    total['nested']['x']['z'].append(2)
+    total['nested']['w']['v'] += 1
+    total['extra'] += [2]
+    assert new == {'count': 2, 'none': 3, 'codes': {'a': 1, 'b': 2}, 'nested': {'x': {'y': 1, 'z': [1]}, 'w': {'v': 1}}, 'decimal': Decimal('0.25'), 'extra': [1]}
+
+
+def test_copy_stat():
+    value = {'a': defaultdict(int, {'b': 1}), 'c': [{'d': 1}], 'e': None}
+    copied = statsrunner.aggregate.copy_stat(value)
+    assert copied == value
+    assert type(copied['a']) == defaultdict and copied['a']['missing'] == 0
+    assert copied['a'] is not value['a'] and copied['c'] is not value['c'] and copied['c'][0] is not value['c'][0]
+
+
+def test_aggregate_parallel(tmpdir):
+    for i in range(5):
+        tmpdir.join('data').join('pub{0}'.format(i)).join('0.xml').write(ACTIVITY_XML.format('pub' + str(i)), ensure=True)
+    sequential = tmpdir.join('sequential')
+    args = make_args(tmpdir, sequential)
+    statsrunner.loop.loop(args)
+    parallel = tmpdir.join('parallel')
+    shutil.copytree(sequential.strpath, parallel.strpath)
+
+    statsrunner.aggregate.aggregate(args)
+    args = make_args(tmpdir, parallel)
+    args.multi = 2
+    statsrunner.aggregate.aggregate(args)
+    assert read_tree(parallel) == read_tree(sequential)
+    assert len(parallel.join('aggregated-publisher').listdir()) == 5
@@ -0,0 +1,95 @@
+import datetime
+import json
+from mock import patch
+import statsrunner.cache
+import statsrunner.loop
+from stats.common.decorators import memoize, returns_number, returns_numberdict
+from statsrunner.testing import make_args
+
+ACTIVITY_XML = '''<iati-activities version="2.01">
+    <iati-activity>
+        <iati-identifier>AAA-1</iati-identifier>
+        <transaction><transaction-date iso-date="2015-06-01"/></transaction>
+    </iati-activity>
+</iati-activities>'''
+
+
+def this_year():
+    return datetime.date.today().year
+
+
+class DatedStats(object):
+    blank = False
+    status = None
+
+    @returns_number
+    def undated(self):
+        return 1
+
+    @returns_numberdict
+    def today_attribute(self):
+        return {self.today.year: 1}
+
+    @returns_number
+    def module_function(self):
+        return this_year()
+
+    @memoize
+    def _is_current(self):
+        self.status = self.now.year
+        return True
+
+    @returns_number
+    def helper(self):
+        return 1 if self._is_current() else 0
+
+    @returns_numberdict
+    def by_name(self):
+        return dict((stat, getattr(self, stat)()) for stat in ['undated', 'helper'])
+
+    @returns_number
+    def state(self):
+        return self.status
+
+
+def run_loop(tmpdir, args):
+    inputfile = tmpdir.join('data').join('test_publisher').join('test.xml')
+    statsrunner.loop.process_file((inputfile.strpath, args.output, 'test_publisher', 'test.xml', args))
+    with open(tmpdir.join('out').join('aggregated-file').join('test_publisher').join('test.xml').join('activities_with_future_transactions.json').strpath) as fp:
+        return json.load(fp)
+
+
+def test_cache(tmpdir):
+    tmpdir.join('data').join('test_publisher').join('test.xml').write(ACTIVITY_XML, ensure=True)
+
+    args = make_args(tmpdir, tmpdir.join('out'), 'loop', ['--cache-dir', tmpdir.join('cache').strpath], today='2015-01-01')
+    assert run_loop(tmpdir, args) == {'AAA-1': 1}
+
+    # The same file on the same day should not be parsed again
+    with patch('statsrunner.loop.etree.parse', side_effect=AssertionError):
+        assert run_loop(tmpdir, args) == {'AAA-1': 1}
+
+    # Results with --strict are kept apart
+    args.strict = True
+    with patch('statsrunner.loop.etree.parse', wraps=statsrunner.loop.etree.parse) as parse:
+        assert run_loop(tmpdir, args) == {'AAA-1': 1}
+    assert parse.called
+
+    # Date dependent stats must be recalculated for a different day
+    args = make_args(tmpdir, tmpdir.join('out'), 'loop', ['--cache-dir', tmpdir.join('cache').strpath], today='2016-01-01')
+    assert run_loop(tmpdir, args) == {}
+
+    # A changed file must not use the cache
+    tmpdir.join('data').join('test_publisher').join('test.xml').write(ACTIVITY_XML.replace('AAA-1', 'AAA-2'))
+    args = make_args(tmpdir, tmpdir.join('out'), 'loop', ['--cache-dir', tmpdir.join('cache').strpath], today='2015-01-01')
+    assert run_loop(tmpdir, args) == {'AAA-2': 1}
+
+
+def test_date_dependent_stats():
+    names = ['undated', 'today_attribute', 'module_function', 'helper', 'by_name', 'state', 'missing']
+    assert statsrunner.cache.date_dependent_stats([DatedStats], names) == set(
+        ['today_attribute', 'module_function', 'helper', 'by_name', 'state'])
+
+    class ListedStats(DatedStats):
+        date_dependent_stats = ['undated']
+    assert 'undated' in statsrunner.cache.date_dependent_stats([ListedStats], names)
@@ -7,7 +7,7 @@ from mock import patch
 
 def test_gitaggregate(tmpdir):
     gitout = tmpdir.join('gitout')
-    sys.argv = ['', '--dated']
+    sys.argv = ['', '--dated', 'export']
     with patch.dict('os.environ', GITOUT_DIR=gitout.strpath):
         gitout.join('commits').join('AAA').join('aggregated').join('teststat.json').write('3', ensure=True)
         execfile('statsrunner/gitaggregate.py')
@@ -29,7 +29,7 @@ def test_gitaggregate(tmpdir):
 
 def test_gitaggregate_dated(tmpdir):
     gitout = tmpdir.join('gitout')
-    sys.argv = ['', 'dated']
+    sys.argv = ['', 'dated', 'export']
     with open('gitdate.json', 'w') as fp:
         fp.write('{"AAA":"1","BBB":"2","CCC":"3"}')
     with patch.dict('os.environ', GITOUT_DIR=gitout.strpath):
@@ -53,7 +53,7 @@ def test_gitaggregate_dated(tmpdir):
 
 def test_gitaggregate_publisher(tmpdir):
     gitout = tmpdir.join('gitout')
-    sys.argv = ['', '--dated']
+    sys.argv = ['', '--dated', 'export']
     with patch.dict('os.environ', GITOUT_DIR=gitout.strpath):
         gitout.join('commits').join('AAA').join('aggregated-publisher').join('testpublisher').join('activities.json').write('3', ensure=True)
         execfile('statsrunner/gitaggregate-publisher.py')
@@ -80,7 +80,7 @@ def test_gitaggregate_publisher(tmpdir):
 
 def test_gitaggregate_publisher_dated(tmpdir):
     gitout = tmpdir.join('gitout')
-    sys.argv = ['', 'dated']
+    sys.argv = ['', 'dated', 'export']
     with open('gitdate.json', 'w') as fp:
         fp.write('{"AAA":"1","BBB":"2","CCC":"3"}')
     with patch.dict('os.environ', GITOUT_DIR=gitout.strpath):
@@ -104,3 +104,63 @@ def test_gitaggregate_publisher_dated(tmpdir):
         pubdir = gitout.join('gitaggregate-publisher-dated').join('testpublisher')
         assert pubdir.listdir() == [pubdir.join('activities.json')]
         assert pubdir.join('activities.json').read() == '{\n  "1": 3, \n  "2": "test", \n  "3": {}\n}'
+
+
+def test_gitaggregate_packed(tmpdir):
+    gitout = tmpdir.join('gitout')
+    sys.argv = ['', '--dated', 'export']
+    with patch.dict('os.environ', GITOUT_DIR=gitout.strpath):
+        gitout.join('commits').join('AAA').join('aggregated.records').write('\tteststat\t3\n\tnotwhitelisted\t4\n', ensure=True)
+        gitout.join('commits').join('AAA').join('aggregated-publisher.records').write(
+            'testpublisher\tactivities\t1.5\ntestpublisher\tnotwhitelisted\t4\n', ensure=True)
+        execfile('statsrunner/gitaggregate.py')
+        execfile('statsrunner/gitaggregate-publisher.py')
+        assert gitout.join('gitaggregate').listdir() == [gitout.join('gitaggregate').join('teststat.json')]
+        assert gitout.join('gitaggregate').join('teststat.json').read() == '{\n  "AAA": 3\n}'
+        pubdir = gitout.join('gitaggregate-publisher').join('testpublisher')
+        assert pubdir.listdir() == [pubdir.join('activities.json')]
+        assert pubdir.join('activities.json').read() == '{\n  "AAA": 1.5\n}'
+
+
+def test_gitaggregate_store(tmpdir):
+    gitout = tmpdir.join('gitout')
+    # Output from before the store was used
+    gitout.join('gitaggregate').join('teststat.json').write('{\n  "AAA": 3\n}', ensure=True)
+    gitout.join('gitaggregate-publisher').join('testpublisher').join('activities.json').write('{\n  "AAA": 1\n}', ensure=True)
+    with patch.dict('os.environ', GITOUT_DIR=gitout.strpath):
+        gitout.join('commits').join('BBB').join('aggregated').join('teststat.json').write('4', ensure=True)
+        gitout.join('commits').join('BBB').join('aggregated-publisher').join('testpublisher').join('activities.json').write('2', ensure=True)
+        # Without export, the values are only appended to the store, and
+        # commits that are already in the store are skipped
+        sys.argv = ['']
+        for i in range(2):
+            execfile('statsrunner/gitaggregate.py')
+            execfile('statsrunner/gitaggregate-publisher.py')
+        assert gitout.join('gitaggregate-store').join('teststat.records').read() == 'AAA\tteststat\t3\nBBB\tteststat\t4\n'
+        assert gitout.join('gitaggregate-publisher-store').join('testpublisher.records').read() == 'AAA\tactivities\t1\nBBB\tactivities\t2\n'
+        assert gitout.join('gitaggregate').join('teststat.json').read() == '{\n  "AAA": 3\n}'
+
+        sys.argv = ['', 'export']
+        execfile('statsrunner/gitaggregate.py')
+        execfile('statsrunner/gitaggregate-publisher.py')
+        assert gitout.join('gitaggregate').join('teststat.json').read() == '{\n  "AAA": 3, \n  "BBB": 4\n}'
+        pubdir = gitout.join('gitaggregate-publisher').join('testpublisher')
+        assert pubdir.join('activities.json').read() == '{\n  "AAA": 1, \n  "BBB": 2\n}'
+
+
+def test_gitaggregate_both(tmpdir):
+    gitout = tmpdir.join('gitout')
+    with open('gitdate.json', 'w') as fp:
+        fp.write('{"AAA":"1","BBB":"2"}')
+    with patch.dict('os.environ', GITOUT_DIR=gitout.strpath):
+        for commit, value in [('AAA', '3'), ('BBB', '4')]:
+            gitout.join('commits').join(commit).join('aggregated').join('teststat.json').write(value, ensure=True)
+            gitout.join('commits').join(commit).join('aggregated-publisher').join('testpublisher').join('activities.json').write(value, ensure=True)
+        # Both commits are added to the dated and undated output in one pass
+        sys.argv = ['', 'both', 'export']
+        execfile('statsrunner/gitaggregate.py')
+        execfile('statsrunner/gitaggregate-publisher.py')
+        assert gitout.join('gitaggregate').join('teststat.json').read() == '{\n  "AAA": 3, \n  "BBB": 4\n}'
+        assert gitout.join('gitaggregate-dated').join('teststat.json').read() == '{\n  "1": 3, \n  "2": 4\n}'
+        assert gitout.join('gitaggregate-publisher').join('testpublisher').join('activities.json').read() == '{\n  "AAA": 3, \n  "BBB": 4\n}'
+        assert gitout.join('gitaggregate-publisher-dated').join('testpublisher').join('activities.json').read() == '{\n  "1": 3, \n  "2": 4\n}'
@@ -0,0 +1,156 @@
+import cPickle
+from decimal import Decimal
+import json
+import subprocess
+import pytest
+from mock import patch
+import statsrunner.aggregate
+import statsrunner.incremental
+import statsrunner.loop
+import statsrunner.run
+from statsrunner.test_run import ACTIVITY_XML, read_tree
+from statsrunner.testing import make_args
+
+# The future transactions stat depends on the date, and the others don't, so
+# their publisher totals can be reused
+STATS_MODULE = '''
+from stats.common.decorators import returns_number, returns_numberdict
+from stats.activity_future_transaction_blacklist import ActivityStats as FutureStats
+from stats.activity_future_transaction_blacklist import ActivityFileStats, OrganisationStats, OrganisationFileStats, AllDataStats
+
+class ActivityStats(FutureStats):
+    @returns_number
+    def activities(self):
+        return 1
+
+    @returns_numberdict
+    def identifiers(self):
+        return {self.element.find('iati-identifier').text: 1}
+
+    @returns_numberdict
+    def years(self):
+        # None sorts before the years, but "null" after them
+        return {None: 1, 2015: 1}
+
+class PublisherStats(object):
+    blank = False
+
+    @returns_number
+    def publisher_identifiers(self):
+        return len(self.aggregated['identifiers'])
+'''
+
+
+def git(data, *args):
+    subprocess.check_call(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] + list(args), cwd=data.strpath)
+
+
+def unpickle(tree):
+    """ The kept totals are pickled dictionaries, which may be in any order. """
+    return dict((path, cPickle.loads(value) if path.endswith('.pickle') else value) for path, value in tree.items())
+
+
+def run(tmpdir, output, fused, packed, previous_output=None, today='2015-01-01'):
+    options = ['--keep-incremental'] + (['--previous-output', previous_output.strpath] if previous_output else [])
+    if fused:
+        args = make_args(tmpdir, output, 'run', ['--aggregated-file'] + options, today, 'incremental_test_stats')
+    else:
+        args = make_args(tmpdir, output, 'loop', options, today, 'incremental_test_stats')
+    args.packed = packed
+    if fused:
+        statsrunner.run.run(args)
+    else:
+        statsrunner.loop.loop(args)
+        statsrunner.aggregate.aggregate(args)
+    return args
+
+
+def test_incremental(tmpdir, monkeypatch):
+    tmpdir.join('stats').join('incremental_test_stats.py').write(STATS_MODULE, ensure=True)
+    monkeypatch.syspath_prepend(tmpdir.join('stats').strpath)
+    data = tmpdir.join('data')
+    for path, identifier in [('pub1/a.xml', 'a'), ('pub1/b.xml', 'b'), ('pub2/c.xml', 'c'), ('pub3/d.xml', 'd'), ('pub4/f.xml', 'f')]:
+        data.join(path).write(ACTIVITY_XML.format(identifier), ensure=True)
+    git(data, 'init', '-q')
+    git(data, 'add', '.')
+    git(data, 'commit', '-q', '-m', 'First')
+    for fused in [False, True]:
+        for packed in [False, True]:
+            run(tmpdir, tmpdir.join('previous', str(fused), str(packed)), fused, packed)
+
+    # A changed file, a renamed file, a new file and a removed publisher
+    data.join('pub1/a.xml').write(ACTIVITY_XML.format('a2'))
+    git(data, 'mv', 'pub1/b.xml', 'pub1/b2.xml')
+    data.join('pub2/e.xml').write(ACTIVITY_XML.format('e'))
+    git(data, 'rm', '-q', '-r', 'pub3')
+    git(data, 'add', '.')
+    git(data, 'commit', '-q', '-m', 'Second')
+    assert statsrunner.incremental.changed_files(data.strpath, 'HEAD~1') == set(['pub1/a.xml', 'pub1/b.xml', 'pub1/b2.xml', 'pub2/e.xml', 'pub3/d.xml'])
+
+    reused = []
+    previous_stats = statsrunner.incremental.previous_stats
+    def spy(stats_module, folder, xmlfile, args):
+        subtotal, missing = previous_stats(stats_module, folder, xmlfile, args)
+        if subtotal is not None:
+            reused.append(folder + '/' + xmlfile)
+        return subtotal, missing
+    monkeypatch.setattr(statsrunner.incremental, 'previous_stats', spy)
+
+    for fused in [False, True]:
+        for packed in [False, True]:
+            full = tmpdir.join('full', str(fused), str(packed))
+            incremental = tmpdir.join('incremental', str(fused), str(packed))
+            run(tmpdir, full, fused, packed)
+            del reused[:]
+            # The previous run was for the same date, so only the changed files are parsed
+            with patch('statsrunner.loop.etree.parse', wraps=statsrunner.loop.etree.parse) as parse:
+                args = run(tmpdir, incremental, fused, packed, tmpdir.join('previous', str(fused), str(packed)))
+            assert parse.call_count == 3
+            assert sorted(reused) == ['pub2/c.xml', 'pub4/f.xml']
+            assert args.reused_publishers == set(['pub4'])
+            assert args.reused_stats == set(['activities', 'identifiers', 'years'])
+            assert args.delta_stats == set(['activities', 'identifiers', 'years'])
+
+            info = json.loads(incremental.join('incremental.json').read())
+            assert info['changed_publishers'] == ['pub1', 'pub2', 'pub3']
+            assert info['publishers'] == ['pub1', 'pub2', 'pub4']
+            incremental.join('incremental.json').remove()
+            full.join('incremental.json').remove()
+            assert unpickle(read_tree(incremental)) == unpickle(read_tree(full))
+
+            # For another date, the date dependent stats are recalculated
+            full = tmpdir.join('full-2016', str(fused), str(packed))
+            incremental = tmpdir.join('incremental-2016', str(fused), str(packed))
+            run(tmpdir, full, fused, packed, today='2016-01-01')
+            with patch('statsrunner.loop.etree.parse', wraps=statsrunner.loop.etree.parse) as parse:
+                run(tmpdir, incremental, fused, packed, tmpdir.join('previous', str(fused), str(packed)), '2016-01-01')
+            assert parse.call_count == 5
+            assert read_tree(full) != read_tree(tmpdir.join('full', str(fused), str(packed)))
+            incremental.join('incremental.json').remove()
+            full.join('incremental.json').remove()
+            assert unpickle(read_tree(incremental)) == unpickle(read_tree(full))
+
+
+def test_subtract():
+    subtract = statsrunner.incremental.subtract
+    assert subtract(5, 2, None) == 3
+    assert subtract(Decimal('1.25'), Decimal('0.5'), None) == Decimal('0.75')
+    assert subtract(Decimal('1.25'), 1, None) == Decimal('0.25')
+    # added has at least as many places as the sum
+    assert subtract(Decimal('1.25'), Decimal('0.25'), Decimal('0.05')) == Decimal('1.00')
+    assert subtract({'a': 2, 'b': {'c': 1}}, {'a': 1, 'b': {'c': 1}}, {'b': {'c': 1}}) == {'a': 1, 'b': {'c': 0}}
+    for current, old, added in [
+            # A key that might only have been in old
+            ({'a': 1}, {'a': 1}, {}),
+            ({'a': {}}, {'a': {}}, None),
+            ({'a': 1}, {'b': 1}, None),
+            # The sum might have had fewer decimal places, or been an integer, without old
+            (Decimal('1.25'), Decimal('0.25'), None),
+            (Decimal('3'), 1, None),
+            (2, Decimal('1.5'), None),
+            # Not a sum of numbers
+            (u'ab', u'b', None),
+            (True, True, None),
+            ]:
+        with pytest.raises(ValueError):
+            subtract(current, old, added)
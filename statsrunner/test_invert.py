@@ -0,0 +1,92 @@
+import os
+import shutil
+import statsrunner.aggregate
+import statsrunner.invert
+import statsrunner.loop
+from statsrunner.test_run import ACTIVITY_XML, read_tree
+from statsrunner.testing import make_args
+
+
+def test_invert_values():
+    stats = [
+        ('a.xml', 'activities', 2),
+        ('a.xml', 'codes', {'x': 1, 'y': {'z': 2}}),
+        ('b.xml', 'activities', 1),
+        ('b.xml', 'codes', {'x': 3, 'y': {'z': 4}}),
+        ('a.xml', 'activities', 5),
+        ('a.xml', 'codes', {'x': 6}),
+    ]
+    out = statsrunner.invert.invert_values(stats)
+    assert out == {
+        'activities': {'a.xml': 7, 'b.xml': 1},
+        'codes': {'x': {'a.xml': 6, 'b.xml': 3}, 'y': {'z': {'a.xml': 2, 'b.xml': 4}}},
+    }
+    merged = statsrunner.invert.merge_inverted(
+        statsrunner.invert.invert_values(stats[:3]),
+        statsrunner.invert.invert_values(stats[3:]))
+    assert merged == out
+
+
+def test_invert(tmpdir):
+    # The publishers have files with the same names
+    for publisher in ['pub1', 'pub2', 'pub3']:
+        for i in range(3):
+            tmpdir.join('data').join(publisher).join('{0}.xml'.format(i)).write(
+                ACTIVITY_XML.format(publisher + str(i)), ensure=True)
+
+    single = tmpdir.join('single')
+    args = make_args(tmpdir, single)
+    statsrunner.loop.loop(args)
+    statsrunner.aggregate.aggregate(args)
+    multi = tmpdir.join('multi')
+    shutil.copytree(single.strpath, multi.strpath)
+    spilled = tmpdir.join('spilled')
+    shutil.copytree(single.strpath, spilled.strpath)
+    expected = tmpdir.join('expected')
+    shutil.copytree(single.strpath, expected.strpath)
+
+    statsrunner.invert.invert(args)
+    args = make_args(tmpdir, multi)
+    args.multi = 2
+    statsrunner.invert.invert(args)
+    # Spill after every publisher
+    args = make_args(tmpdir, spilled)
+    args.multi = 2
+    args.memory_budget = 0
+    statsrunner.invert.invert(args)
+    assert not spilled.join('invert-spill').check()
+
+    # Inverting each directory in turn, as invert used to
+    statsrunner.invert.invert_dir('aggregated-publisher', 'inverted-publisher', expected.strpath)
+    statsrunner.invert.invert_dir('aggregated-file', 'inverted-file', expected.strpath)
+    os.mkdir(expected.join('inverted-file-publisher').strpath)
+    for folder in expected.join('aggregated-file').listdir():
+        expected.join('inverted-file-publisher').join(folder.basename).ensure(dir=True)
+        statsrunner.invert.invert_dir(folder.relto(expected), os.path.join('inverted-file-publisher', folder.basename), expected.strpath)
+
+    for dirname in ['inverted-publisher', 'inverted-file', 'inverted-file-publisher']:
+        assert read_tree(expected.join(dirname))
+        assert read_tree(single.join(dirname)) == read_tree(expected.join(dirname))
+        assert read_tree(multi.join(dirname)) == read_tree(expected.join(dirname))
+        assert read_tree(spilled.join(dirname)) == read_tree(expected.join(dirname))
+
+
+def test_memory_budget_shared(tmpdir, monkeypatch):
+    tmpdir.join('data').join('pub1').join('a.xml').write(ACTIVITY_XML.format('pub1'), ensure=True)
+    output = tmpdir.join('output')
+    args = make_args(tmpdir, output)
+    statsrunner.loop.loop(args)
+    statsrunner.aggregate.aggregate(args)
+
+    budgets = []
+    class InvertedSpill(statsrunner.invert.InvertedSpill):
+        def __init__(self, spill_dir, budget):
+            budgets.append(budget)
+            super(InvertedSpill, self).__init__(spill_dir, budget)
+    monkeypatch.setattr(statsrunner.invert, 'InvertedSpill', InvertedSpill)
+    args = make_args(tmpdir, output)
+    args.memory_budget = 2
+    statsrunner.invert.invert(args)
+    # The file and publisher inversions together stay within the budget
+    assert len(budgets) == 2
+    assert sum(budgets) == 2 * 1024 * 1024
@@ -0,0 +1,111 @@
+import json
+import os
+import subprocess
+from mock import patch
+import statsrunner.loop
+import statsrunner.source
+from statsrunner.testing import make_args
+
+ACTIVITY_XML = '''<iati-activities version="2.01">
+    <iati-activity>
+        <iati-identifier>AAA-1</iati-identifier>
+        <transaction><transaction-date iso-date="2015-06-01"/></transaction>
+        <transaction><transaction-date iso-date="2015-07-01"/></transaction>
+    </iati-activity>
+    <!-- A comment -->
+    <iati-activity>
+        <iati-identifier>AAA-2</iati-identifier>
+        <transaction><transaction-date iso-date="2016-06-01"/></transaction>
+    </iati-activity>
+</iati-activities>'''
+
+
+def run_loop(tmpdir, xml, streaming):
+    tmpdir.join('data').join('test_publisher').join('test.xml').write(xml, ensure=True)
+    output_dir = tmpdir.mkdtemp()
+    args = make_args(tmpdir, output_dir, 'loop', ['--streaming'] if streaming else [])
+    inputfile = tmpdir.join('data').join('test_publisher').join('test.xml')
+    statsrunner.loop.process_file((inputfile.strpath, args.output, 'test_publisher', 'test.xml', args))
+    out = output_dir.join('aggregated-file').join('test_publisher').join('test.xml')
+    return dict((f.basename, json.loads(f.read())) for f in out.listdir())
+
+
+def test_iterparse_root(tmpdir):
+    tmpdir.join('test.xml').write(ACTIVITY_XML)
+    root, children = statsrunner.loop.iterparse_root(tmpdir.join('test.xml').strpath)
+    assert root.attrib['version'] == '2.01'
+    identifiers = []
+    for element in children:
+        identifiers.append(element.find('iati-identifier').text)
+        # Previous elements should have been discarded
+        assert element.getprevious() is None
+    assert identifiers == ['AAA-1', 'AAA-2']
+
+
+def test_streaming(tmpdir):
+    with patch('statsrunner.loop.MAX_FILE_SIZE', 0):
+        out = run_loop(tmpdir, ACTIVITY_XML, streaming=False)
+        assert out['toolarge.json'] == 1
+        assert out['activities_with_future_transactions.json'] == {}
+
+        out = run_loop(tmpdir, ACTIVITY_XML, streaming=True)
+        assert 'toolarge.json' not in out
+        assert out['activities_with_future_transactions.json'] == {'AAA-1': 2, 'AAA-2': 1}
+
+        # A parse error part way through the file should be reported as invalid XML
+        out = run_loop(tmpdir, ACTIVITY_XML[:-10], streaming=True)
+        assert out['invalidxml.json'] == 1
+        assert out['activities_with_future_transactions.json'] == {}
+
+    out = run_loop(tmpdir, ACTIVITY_XML, streaming=False)
+    assert out['activities_with_future_transactions.json'] == {'AAA-1': 2, 'AAA-2': 1}
+
+
+def test_schedule(tmpdir):
+    files = []
+    for name, size in [('small1.xml', 10), ('large.xml', 1000), ('small2.xml', 20), ('medium.xml', 300), ('small3.xml', 30)]:
+        tmpdir.join(name).write('x' * size)
+        files.append((tmpdir.join(name).strpath, None, 'folder', name, None))
+    files.append((tmpdir.join('missing.xml').strpath, None, 'folder', 'missing.xml', None))
+
+    with patch('statsrunner.loop.CHUNKS_PER_PROCESS', 1):
+        chunks = statsrunner.loop.schedule(files, 2)
+    # Largest first, with no more than half the total size, or half the files, in each chunk
+    assert [[f[3] for f in chunk] for chunk in chunks] == [
+        ['large.xml'], ['medium.xml', 'small3.xml', 'small2.xml'], ['small1.xml', 'missing.xml']]
+
+
+def test_commit(tmpdir):
+    data = tmpdir.join('data')
+    data.join('test_publisher').join('test.xml').write(ACTIVITY_XML, ensure=True)
+    data.join('README').write('Not in a publisher folder')
+    git = ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com']
+    subprocess.check_call(git + ['init', '-q'], cwd=data.strpath)
+    subprocess.check_call(git + ['add', '.'], cwd=data.strpath)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'First'], cwd=data.strpath)
+    commit = statsrunner.source.resolve_commit(data.strpath, 'HEAD')
+    assert statsrunner.source.resolve_commit(data.strpath, 'missing') is None
+    # The checked out files should be ignored
+    data.join('test_publisher').join('test.xml').write(ACTIVITY_XML.replace('AAA', 'BBB'))
+    data.join('test_publisher').join('new.xml').write(ACTIVITY_XML)
+
+    for streaming in [False, True]:
+        output_dir = tmpdir.mkdtemp()
+        args = make_args(tmpdir, output_dir, 'loop', ['--commit', 'HEAD'] + (['--streaming'] if streaming else []))
+        assert args.commit == commit
+        spooled = []
+        spool_blob = statsrunner.source.spool_blob
+        def spy(data_dir, sha):
+            spooled.append(spool_blob(data_dir, sha))
+            return spooled[-1]
+        with patch('statsrunner.loop.MAX_FILE_SIZE', 0 if streaming else statsrunner.loop.MAX_FILE_SIZE), \
+                patch('statsrunner.source.spool_blob', side_effect=spy), \
+                patch('statsrunner.source.read_blob', side_effect=AssertionError if streaming else statsrunner.source.read_blob):
+            files = statsrunner.loop.list_files(args)
+            assert [f[2:4] for f in files] == [('test_publisher', 'test.xml')]
+            statsrunner.loop.loop(args)
+        out = output_dir.join('aggregated-file').join('test_publisher').join('test.xml')
+        assert json.loads(out.join('activities_with_future_transactions.json').read()) == {'AAA-1': 2, 'AAA-2': 1}
+        # Blobs parsed incrementally are written to a temporary file, which is removed afterwards
+        assert len(spooled) == (1 if streaming else 0)
+        assert not any(os.path.exists(path) for path in spooled)
@@ -0,0 +1,65 @@
+import decimal
+import pytest
+import statsrunner.aggregate
+import statsrunner.invert
+import statsrunner.loop
+import statsrunner.packed
+import statsrunner.run
+from statsrunner.test_run import ACTIVITY_XML, read_tree
+from statsrunner.testing import make_args
+
+
+def test_records(tmpdir):
+    path = tmpdir.join('out').join('pub.records').strpath
+    statsrunner.packed.append(path, 'a.xml', {'activities': 2, 'sum': decimal.Decimal('1.50')}, statsrunner.aggregate.decimal_default)
+    statsrunner.packed.append(path, 'b.xml', {'activities': 1, 'codes': {'x': 1}}, statsrunner.aggregate.decimal_default)
+    assert list(statsrunner.packed.read_grouped(path)) == [
+        ('a.xml', {'activities': 2, 'sum': decimal.Decimal('1.50')}),
+        ('b.xml', {'activities': 1, 'codes': {'x': 1}}),
+    ]
+    assert list(statsrunner.packed.read(path, stats=['codes'])) == [('b.xml', 'codes', {'x': 1})]
+
+    with pytest.raises(ValueError):
+        statsrunner.packed.append(path, 'tab\t.xml', {}, statsrunner.aggregate.decimal_default)
+
+
+def test_packed(tmpdir):
+    for publisher in ['pub1', 'pub2']:
+        for i in range(3):
+            tmpdir.join('data').join(publisher).join('{0}.xml'.format(i)).write(
+                ACTIVITY_XML.format(publisher + str(i)), ensure=True)
+
+    separate = tmpdir.join('separate')
+    args = make_args(tmpdir, separate)
+    statsrunner.loop.loop(args)
+    statsrunner.aggregate.aggregate(args)
+    statsrunner.invert.invert(args)
+
+    packed = tmpdir.join('packed')
+    args = make_args(tmpdir, packed)
+    args.packed = True
+    statsrunner.loop.loop(args)
+    # Running again starts the records afresh, rather than adding to them
+    statsrunner.loop.loop(args)
+    statsrunner.aggregate.aggregate(args)
+    statsrunner.invert.invert(args)
+    assert sorted(packed.join('aggregated-file').listdir()) == [
+        packed.join('aggregated-file').join('pub1.records'), packed.join('aggregated-file').join('pub2.records')]
+    for dirname in ['inverted-publisher', 'inverted-file', 'inverted-file-publisher']:
+        assert read_tree(packed.join(dirname)) == read_tree(separate.join(dirname))
+    args.memory_budget = 0
+    statsrunner.invert.invert(args)
+    for dirname in ['inverted-publisher', 'inverted-file', 'inverted-file-publisher']:
+        assert read_tree(packed.join(dirname)) == read_tree(separate.join(dirname))
+
+    statsrunner.packed.export(args)
+    for dirname in ['aggregated-file', 'aggregated-publisher', 'aggregated']:
+        exported = read_tree(packed.join(dirname))
+        assert dict((k, v) for k, v in exported.items() if not k.endswith('.records')) == read_tree(separate.join(dirname))
+
+    fused = tmpdir.join('fused')
+    args = make_args(tmpdir, fused, 'run', ['--aggregated-file'])
+    args.packed = True
+    statsrunner.run.run(args)
+    for fname in ['aggregated-publisher.records', 'aggregated.records']:
+        assert sorted(fused.join(fname).readlines()) == sorted(packed.join(fname).readlines())
@@ -0,0 +1,127 @@
+import copy
+from decimal import Decimal
+import json
+import os
+from mock import patch
+import statsrunner.aggregate
+import statsrunner.incremental
+import statsrunner.loop
+import statsrunner.run
+from statsrunner.testing import make_args
+
+ACTIVITY_XML = '''<iati-activities version="2.01">
+    <iati-activity>
+        <iati-identifier>{0}-1</iati-identifier>
+        <transaction><transaction-date iso-date="2015-06-01"/></transaction>
+        <transaction><transaction-date iso-date="2015-07-01"/></transaction>
+    </iati-activity>
+    <iati-activity>
+        <iati-identifier>{0}-2</iati-identifier>
+        <transaction><transaction-date iso-date="2014-06-01"/></transaction>
+    </iati-activity>
+</iati-activities>'''
+
+
+def read_tree(directory):
+    return dict((f.relto(directory), f.read()) for f in directory.visit() if f.isfile())
+
+
+def test_run(tmpdir):
+    for publisher in ['pub1', 'pub2']:
+        for i in range(3):
+            tmpdir.join('data').join(publisher).join('{0}.xml'.format(i)).write(
+                ACTIVITY_XML.format(publisher + str(i)), ensure=True)
+    tmpdir.join('data').join('pub2').join('invalid.xml').write('<iati-activities>')
+
+    separate = tmpdir.join('separate')
+    args = make_args(tmpdir, separate)
+    statsrunner.loop.loop(args)
+    statsrunner.aggregate.aggregate(args)
+
+    fused = tmpdir.join('fused')
+    statsrunner.run.run(make_args(tmpdir, fused, 'run', ['--aggregated-file']))
+
+    assert read_tree(fused) == read_tree(separate)
+    # Nothing is kept for incremental runs unless asked for
+    for output in [fused, separate]:
+        assert not [f for f in output.listdir() if f.basename.startswith('incremental')]
+    assert '"pub10-1": 2' in fused.join('aggregated').join('activities_with_future_transactions.json').read()
+
+    # The per file output is optional
+    fused_only = tmpdir.join('fused_only')
+    args = make_args(tmpdir, fused_only, 'run')
+    statsrunner.run.run(args)
+    assert fused_only.join('aggregated-file').listdir() == []
+    assert read_tree(fused_only.join('aggregated')) == read_tree(separate.join('aggregated'))
+    assert read_tree(fused_only.join('aggregated-publisher')) == read_tree(separate.join('aggregated-publisher'))
+
+
+def test_totals_exact(tmpdir):
+    # Summed in the default context, these would round differently in each order
+    subtotals = ['{"sum": 1e20}', '{"sum": 1.00000001}', '{"sum": -1e20}']
+    for order in [subtotals, subtotals[::-1]]:
+        args = make_args(tmpdir, tmpdir.join('output'), 'run')
+        statsrunner.incremental.no_reuse(args)
+        totals = statsrunner.run.Totals(args)
+        for subtotal in order:
+            totals.add('pub1', subtotal, False)
+        assert totals.publisher_totals['pub1']['sum'] == Decimal('1.00000001')
+
+
+def test_stat_timings(tmpdir):
+    tmpdir.join('data').join('pub1').join('1.xml').write(ACTIVITY_XML.format('pub1'), ensure=True)
+    # An activity without an identifier, which makes the stat raise an exception
+    tmpdir.join('data').join('pub1').join('2.xml').write(ACTIVITY_XML.format('pub2').replace('<iati-identifier>pub2-1</iati-identifier>', ''), ensure=True)
+    output = tmpdir.join('out')
+    args = make_args(tmpdir, output)
+    args.stat_timings = True
+    statsrunner.loop.loop(args)
+    statsrunner.aggregate.aggregate(args)
+
+    timings = json.loads(output.join('metrics').join('stat_timings.json').read())
+    stat = timings['total']['ActivityStats']['activities_with_future_transactions']
+    assert stat['calls'] == 4
+    assert stat['exceptions'] == 1
+    assert stat['seconds'] > 0
+    # loop and aggregate ran in this process
+    assert timings['workers'].keys() == [str(os.getpid())]
+
+
+def test_several_stats_modules(tmpdir):
+    for i in range(3):
+        tmpdir.join('data').join('pub1').join('{0}.xml'.format(i)).write(ACTIVITY_XML.format('pub1' + str(i)), ensure=True)
+    tmpdir.join('data').join('pub1').join('invalid.xml').write('<iati-activities>')
+
+    for streaming in [False, True]:
+        outputs = []
+        args = make_args(tmpdir, tmpdir.join('unused'), 'run', ['--aggregated-file'])
+        args.streaming = streaming
+        args.module_args = []
+        for stats_module in ['stats.activity_future_transaction_blacklist', 'stats.countonly']:
+            separate = tmpdir.join('separate', stats_module, str(streaming))
+            module_args = make_args(tmpdir, separate, 'run', ['--aggregated-file'])
+            module_args.stats_module = stats_module
+            module_args.streaming = streaming
+            with patch('statsrunner.loop.MAX_FILE_SIZE', 0 if streaming else statsrunner.loop.MAX_FILE_SIZE):
+                statsrunner.run.run(module_args)
+            module_args = copy.copy(module_args)
+            module_args.output = tmpdir.join('together', stats_module, str(streaming)).strpath
+            args.module_args.append(module_args)
+            outputs.append((separate, tmpdir.join('together', stats_module, str(streaming))))
+
+        # Each file is parsed once for both modules
+        with patch('statsrunner.loop.etree.parse', wraps=statsrunner.loop.etree.parse) as parse:
+            with patch('statsrunner.loop.MAX_FILE_SIZE', 0 if streaming else statsrunner.loop.MAX_FILE_SIZE):
+                statsrunner.run.run(args)
+        assert parse.call_count == (0 if streaming else 4)
+        for separate, together in outputs:
+            assert read_tree(together) == read_tree(separate)
+
+    # Each module's output only has the timings of its own stats
+    args.stat_timings = True
+    for module_args in args.module_args:
+        module_args.stat_timings = True
+    statsrunner.run.run(args)
+    for stats_module, stat in [('stats.activity_future_transaction_blacklist', 'activities_with_future_transactions'), ('stats.countonly', 'activities')]:
+        timings = json.loads(tmpdir.join('together', stats_module, 'True').join('metrics').join('stat_timings.json').read())
+        assert timings['total']['ActivityStats'].keys() == [stat]
@@ -0,0 +1,89 @@
+import pytest
+import statsrunner
+from statsrunner.shared import select_stats, select_module_stats, restrict_stats
+
+
+class ActivityStats(object):
+    stat_dependencies = {'total_usd': ['total']}
+    def total(self): pass
+    def total_usd(self): pass
+    def count(self): pass
+    def _helper(self): pass
+
+class PublisherStats(object):
+    stat_dependencies = {'median': ['lengths']}
+    def median(self): pass
+
+class ActivityFileStats(object):
+    def lengths(self): pass
+
+class OrganisationFileStats(object):
+    pass
+
+class OrganisationStats(object):
+    pass
+
+class AllDataStats(object):
+    enabled_stats = ['everything']
+    def everything(self): pass
+    def ignored(self): pass
+
+
+class StatsModule(object):
+    pass
+
+stats_module = StatsModule()
+for stats_class in [ActivityStats, PublisherStats, ActivityFileStats, OrganisationFileStats, OrganisationStats, AllDataStats]:
+    setattr(stats_module, stats_class.__name__, stats_class)
+
+
+def test_select_stats():
+    assert select_stats(stats_module) is None
+    assert select_stats(stats_module, ['count']) == set(['count'])
+    # Dependencies are pulled in, even when excluded
+    assert select_stats(stats_module, ['total_usd', 'median']) == set(['total_usd', 'total', 'median', 'lengths'])
+    assert select_stats(stats_module, exclude_stats=['total', 'count']) == set(['total', 'total_usd', 'median', 'lengths', 'everything'])
+    with pytest.raises(ValueError):
+        select_stats(stats_module, ['_helper'])
+    with pytest.raises(ValueError):
+        select_stats(stats_module, exclude_stats=['ignored'])
+    # None of the module's stats
+    assert select_stats(stats_module, []) == set()
+
+
+def test_select_module_stats():
+    class OtherActivityStats(object):
+        def other(self): pass
+    other_module = StatsModule()
+    other_module.__dict__.update(stats_module.__dict__)
+    other_module.ActivityStats = OtherActivityStats
+    other_module.PublisherStats = OrganisationStats
+    both = [stats_module, other_module]
+    assert select_module_stats(both) == [None, None]
+    # A stat that only one of the modules has
+    assert select_module_stats(both, ['count', 'other']) == [set(['count']), set(['other'])]
+    assert select_module_stats(both, ['other']) == [set(), set(['other'])]
+    assert select_module_stats(both, exclude_stats=['other', 'median']) == [
+        set(['total', 'total_usd', 'count', 'lengths', 'everything']), set(['lengths', 'everything'])]
+    with pytest.raises(ValueError):
+        select_module_stats(both, ['missing'])
+
+
+def test_parse_stats():
+    argv = ['--stats-module', 'stats.activity_future_transaction_blacklist,stats.countonly', '--output', 'a,b']
+    args = statsrunner.parse_args(argv + ['--stats', 'activities', 'loop'])
+    assert [module_args.enabled_stats for module_args in args.module_args] == [set(), set(['activities'])]
+    args = statsrunner.parse_args(argv + ['--exclude-stats', 'activities', 'loop'])
+    assert [module_args.enabled_stats for module_args in args.module_args] == [None, set()]
+
+
+def test_restrict_stats():
+    activity_stats = ActivityStats()
+    restrict_stats(activity_stats, None)
+    assert not hasattr(activity_stats, 'enabled_stats')
+    restrict_stats(activity_stats, set(['count']))
+    assert activity_stats.enabled_stats == set(['count'])
+
+    all_stats = AllDataStats()
+    restrict_stats(all_stats, set(['count']))
+    assert all_stats.enabled_stats == []
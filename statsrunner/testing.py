@@ -0,0 +1,26 @@
+"""
+Helpers for the tests.
+
+"""
+import statsrunner
+
+
+def make_args(tmpdir, output, command='loop', options=(), today='2015-01-01',
+              stats_module='stats.activity_future_transaction_blacklist'):
+    """
+    Return the args that calculate_stats.py would run command with, over the
+    data in tmpdir/data, writing to output, with the given command options.
+    The other commands' defaults are filled in too, so the same args can also
+    be passed to aggregate and invert, as the tests do after loop.
+
+    """
+    argv = ['--today', today, '--stats-module', stats_module, '--output', str(output), command]
+    if command in ['loop', 'run']:
+        argv += ['--data', tmpdir.join('data').strpath]
+    args = statsrunner.parse_args(argv + list(options))
+    parser = statsrunner.make_parser()
+    for other in ['loop', 'run', 'aggregate', 'invert']:
+        for key, value in vars(parser.parse_args([other])).items():
+            if not hasattr(args, key):
+                setattr(args, key, value)
+    return args
@@ -0,0 +1,87 @@
+"""
+Append-only stores of the stats over time, for the gitaggregate scripts.
+
+The gitaggregate output has a JSON file for each stat, mapping each commit (or
+its date) to the value of the stat for that commit. Adding a commit by loading
+and rewriting these files takes longer with every commit. Instead, the
+gitaggregate scripts append the new values to a store, and the JSON is only
+written from the store when they are called with the export argument.
+
+A store is a directory of packed record files (see packed.py), with a record
+"<commit or date>\\t<stat>\\t<json>" for each value, and an empty file in
+commits/ for each commit that has been added.
+
+This module only uses the standard library, so that the gitaggregate scripts
+can import it.
+
+"""
+from collections import defaultdict
+import decimal
+import json
+import os
+
+from common import decimal_default
+import packed
+
+
+def store_dir(gitout_dir, name):
+    """ The store for the gitaggregate output directory called name. """
+    return os.path.join(gitout_dir, name + '-store')
+
+
+def is_added(store, commit):
+    return os.path.exists(os.path.join(store, 'commits', commit))
+
+
+def mark_added(store, commit):
+    try:
+        os.makedirs(os.path.join(store, 'commits'))
+    except OSError:
+        pass
+    open(os.path.join(store, 'commits', commit), 'w').close()
+
+
+def append(path, records):
+    """
+    Append records to a store file, where each record is a commit or date, and
+    a dictionary of stat name to value.
+
+    """
+    packed.append_formatted(path, ''.join(packed.format_records(key, stats, decimal_default) for key, stats in records))
+
+
+def seed(path, json_dir, stats):
+    """
+    Start the store file at path with any values in the existing JSON files
+    for the given stats in json_dir, written before the store was used. Does
+    nothing if the store file already exists.
+
+    """
+    if os.path.exists(path):
+        return
+    for stat in stats:
+        json_path = os.path.join(json_dir, stat + '.json')
+        if os.path.isfile(json_path):
+            with open(json_path) as fp:
+                values = json.load(fp, parse_float=decimal.Decimal)
+            append(path, [ (key, {stat: value}) for key, value in sorted(values.items()) ])
+
+
+def read(path):
+    """
+    Return a dictionary of stat name to the dictionary of commit or date to
+    value, as in the gitaggregate JSON. Later values for the same key replace
+    earlier ones.
+
+    """
+    out = defaultdict(dict)
+    for key, stat, value in packed.read(path):
+        out[stat][key] = value
+    return out
+
+
+def write_json(path, value):
+    """ Write the gitaggregate JSON for a stat to a temporary file, then rename it. """
+    with open(path + '.new', 'w') as fp:
+        json.dump(value, fp, sort_keys=True, indent=2, default=decimal_default)
+    os.rename(path + '.new', path)
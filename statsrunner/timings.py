@@ -0,0 +1,94 @@
+"""
+Optional instrumentation of the stats functions, enabled with --stat-timings.
+
+Each process records the number of calls, total wall time and number of
+exceptions for each stat, by stats module and class. loop collects these from
+its workers, and writes them to metrics/stat_timings.json in the output
+directory, both for each worker process (by pid) and in total. aggregate adds
+the timings of the publisher and all data stats to the same file. With several
+stats modules, each module's output gets only the timings of its own stats.
+
+"""
+from collections import defaultdict
+import json
+import os
+import time
+
+# Maps stats module name to stats class name to stat name to [calls, seconds, exceptions], for this process
+timings = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: [0, 0.0, 0])))
+
+
+def call(stats_object, name, function, args):
+    """
+    Call a stats function of args.stats_module, recording how long it took and
+    whether it raised an exception, if args.stat_timings is set.
+
+    """
+    if not args.stat_timings:
+        return function()
+    record = timings[args.stats_module][type(stats_object).__name__][name]
+    start = time.time()
+    try:
+        return function()
+    except:
+        record[2] += 1
+        raise
+    finally:
+        record[0] += 1
+        record[1] += time.time() - start
+
+
+def collect():
+    """ Return the timings recorded in this process since the last call, by stats module, and reset them. """
+    out = {}
+    for module_name, classes in timings.items():
+        out[module_name] = {}
+        for class_name, stats in classes.items():
+            out[module_name][class_name] = dict((name, {'calls': calls, 'seconds': seconds, 'exceptions': exceptions})
+                                                for name, (calls, seconds, exceptions) in stats.items())
+    timings.clear()
+    return out
+
+
+def merge_modules(total, collected):
+    """ Add the timings returned by collect to another set of them, in place. """
+    for module_name, module_timings in collected.items():
+        merge(total.setdefault(module_name, {}), module_timings)
+    return total
+
+
+def merge(total, worker_timings):
+    """ Add one stats module's timings to another's, in place. """
+    for class_name, stats in worker_timings.items():
+        for name, record in stats.items():
+            total_record = total.setdefault(class_name, {}).setdefault(name, {'calls': 0, 'seconds': 0.0, 'exceptions': 0})
+            for k in total_record:
+                total_record[k] += record[k]
+    return total
+
+
+def write(output_dir, stats_module, workers, append=False):
+    """
+    Write the timings of stats_module's stats for each worker (a dictionary of
+    worker name to collected timings) to metrics/stat_timings.json, along with
+    their total. If append is set, the workers are added to those already in
+    the file.
+
+    """
+    path = os.path.join(output_dir, 'metrics', 'stat_timings.json')
+    data = {'workers': {}}
+    if append and os.path.exists(path):
+        with open(path) as fp:
+            data = json.load(fp)
+    for worker, worker_timings in workers.items():
+        merge(data['workers'].setdefault(worker, {}), worker_timings.get(stats_module, {}))
+    data['total'] = {}
+    for worker_timings in data['workers'].values():
+        merge(data['total'], worker_timings)
+
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    with open(path, 'w') as fp:
+        json.dump(data, fp, sort_keys=True, indent=2)